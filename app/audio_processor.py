@@ -1,97 +1,508 @@
 """Audio downloading, validation, and splitting for LINE voice memo processing."""
 
+import glob
+import json
 import logging
-import tempfile
+import math
 import os
+import subprocess
+import tempfile
+from dataclasses import dataclass
+from typing import Callable, Iterator
 
-from pydub import AudioSegment
+import httpx
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
+FFMPEG_BINARY = "ffmpeg"
+FFPROBE_BINARY = "ffprobe"
+
+# Whisper rejects uploads over 25 MB; keep chunks a little under that so
+# container overhead at the cut points cannot push one over.
+WHISPER_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+CHUNK_BYTE_SAFETY_RATIO = 0.95
+
+# Silence analysis runs on a downsampled mono signal: 8 kHz is plenty to
+# tell speech from pauses and keeps each analysis window small.
+ANALYSIS_SAMPLE_RATE = 8000
+ENERGY_WINDOW_SECONDS = 0.05
+MIN_PAUSE_SECONDS = 0.3
+QUIET_RATIO = 0.1
+ANALYSIS_READ_FRAMES = 200
+
+# Container extension for each encoder the upload transcoder supports; all
+# of them are formats Whisper accepts.
+UPLOAD_CODEC_EXTENSIONS = {"libopus": ".ogg", "aac": ".m4a", "libmp3lame": ".mp3"}
+
+LINE_CONTENT_URL = "https://api-data.line.me/v2/bot/message/{message_id}/content"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class AudioValidationError(ValueError):
+    """Raised when a recording is unusable: empty, too large or unreadable."""
+
+
+def _size_limit_error(size: int, max_size_mb: int) -> AudioValidationError:
+    max_size_bytes = max_size_mb * 1024 * 1024
+    return AudioValidationError(
+        f"Audio size ({size} bytes) is too large. "
+        f"Maximum allowed: {max_size_bytes} bytes ({max_size_mb} MB)"
+    )
+
 
-def download_audio(message_id: str, blob_api) -> bytes:
-    """Download audio content from LINE using MessagingApiBlob.
+async def stream_audio_to_file(
+    message_id: str,
+    access_token: str,
+    dest_path: str,
+    max_size_mb: int,
+    http_client: httpx.AsyncClient | None = None,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    on_chunk: Callable[[bytes], None] | None = None,
+) -> int:
+    """Stream audio content from LINE straight into a file.
+
+    The body is never held in memory as a whole: chunks are written to
+    dest_path as they arrive, and the download is aborted as soon as the
+    byte count passes max_size_mb. A partially written file is removed on
+    failure.
 
     Args:
         message_id: The LINE message ID to fetch audio for.
-        blob_api: An instance of linebot.v3.messaging.MessagingApiBlob.
+        access_token: The LINE channel access token.
+        dest_path: Path of the file to write the audio to.
+        max_size_mb: Maximum allowed size in megabytes.
+        http_client: Optional async httpx client to reuse; a short-lived
+            one is created when omitted.
+        chunk_size: Number of bytes to read per chunk.
+        on_chunk: Called with each chunk as it is written, e.g. the update
+            method of a hash so the file is fingerprinted without being
+            read back.
 
     Returns:
-        The raw audio bytes.
+        The number of bytes written to dest_path.
+
+    Raises:
+        AudioValidationError: If the audio is empty or exceeds the size limit.
+        httpx.HTTPStatusError: If LINE responds with a non-2xx status.
     """
-    logger.info("[DOWNLOAD] Fetching message content for message_id=%s", message_id)
-    response = blob_api.get_message_content(message_id)
-    logger.info("[DOWNLOAD] Response type=%s, has content attr=%s", type(response).__name__, hasattr(response, 'content'))
-    # LINE SDK v3 get_message_content returns bytes directly or response object
-    if isinstance(response, bytes):
-        logger.info("[DOWNLOAD] Response is raw bytes, length=%d", len(response))
-        return response
-    elif hasattr(response, 'content'):
-        logger.info("[DOWNLOAD] Response.content length=%d", len(response.content))
-        return response.content
-    elif hasattr(response, 'read'):
-        data = response.read()
-        logger.info("[DOWNLOAD] Response.read() length=%d", len(data))
-        return data
-    else:
-        logger.error("[DOWNLOAD] Unknown response type: %s, dir=%s", type(response), dir(response))
-        raise TypeError(f"Unexpected response type from LINE API: {type(response)}")
-
-
-def validate_audio(audio_data: bytes, max_size_mb: int) -> None:
-    """Validate audio data for size constraints.
+    url = LINE_CONTENT_URL.format(message_id=message_id)
+    headers = {"Authorization": f"Bearer {access_token}"}
+    max_size_bytes = max_size_mb * 1024 * 1024
+    owns_client = http_client is None
+    client = http_client or httpx.AsyncClient(timeout=httpx.Timeout(30.0, read=120.0))
+
+    logger.info("[DOWNLOAD] Streaming message content for message_id=%s", message_id)
+    written = 0
+    try:
+        async with client.stream("GET", url, headers=headers) as response:
+            response.raise_for_status()
+
+            content_length = response.headers.get("Content-Length")
+            if content_length and int(content_length) > max_size_bytes:
+                raise _size_limit_error(int(content_length), max_size_mb)
+
+            # Writes of one network chunk land in the page cache and return
+            # in microseconds, so they are done inline on the event loop.
+            with open(dest_path, "wb") as f:
+                async for chunk in response.aiter_bytes(chunk_size):
+                    written += len(chunk)
+                    if written > max_size_bytes:
+                        raise _size_limit_error(written, max_size_mb)
+                    f.write(chunk)
+                    if on_chunk is not None:
+                        on_chunk(chunk)
+
+        if written == 0:
+            raise AudioValidationError("Audio data is empty")
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    finally:
+        if owns_client:
+            await client.aclose()
+
+    logger.info("[DOWNLOAD] Streamed %d bytes to %s", written, dest_path)
+    return written
+
+
+@dataclass(frozen=True)
+class AudioInfo:
+    """Container-level metadata for an audio file, read without decoding."""
+
+    duration_seconds: float
+    size_bytes: int
+    codec: str | None = None
+    bit_rate: int | None = None
+
+
+@dataclass(frozen=True)
+class AudioChunk:
+    """One piece of a recording and where it sits in the original file."""
+
+    path: str
+    start_seconds: float
+    end_seconds: float
+
+
+def probe_audio(audio_path: str) -> AudioInfo:
+    """Read duration, codec and bitrate from the container headers via ffprobe.
 
     Args:
-        audio_data: The raw audio bytes to validate.
-        max_size_mb: Maximum allowed size in megabytes.
+        audio_path: Path to the audio file.
+
+    Returns:
+        An AudioInfo describing the first audio stream.
 
     Raises:
-        ValueError: If audio data is empty or exceeds the size limit.
+        AudioValidationError: If ffprobe cannot read the file or reports no
+            duration.
     """
-    if not audio_data:
-        raise ValueError("Audio data is empty")
+    cmd = [
+        FFPROBE_BINARY, "-v", "error",
+        "-select_streams", "a:0",
+        "-show_entries", "format=duration,bit_rate:stream=codec_name,bit_rate",
+        "-of", "json",
+        audio_path,
+    ]
+    try:
+        proc = subprocess.run(cmd, check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        raise AudioValidationError(
+            f"Unable to read audio metadata: {(e.stderr or b'').decode(errors='replace').strip()}"
+        ) from e
 
-    max_size_bytes = max_size_mb * 1024 * 1024
-    if len(audio_data) > max_size_bytes:
-        raise ValueError(
-            f"Audio size ({len(audio_data)} bytes) is too large. "
-            f"Maximum allowed: {max_size_bytes} bytes ({max_size_mb} MB)"
+    data = json.loads(proc.stdout or b"{}")
+    fmt = data.get("format", {})
+    stream = (data.get("streams") or [{}])[0]
+
+    duration = fmt.get("duration")
+    if duration in (None, "N/A"):
+        raise AudioValidationError("Unable to read audio metadata: duration is unknown")
+
+    bit_rate = stream.get("bit_rate") or fmt.get("bit_rate")
+    info = AudioInfo(
+        duration_seconds=float(duration),
+        size_bytes=os.path.getsize(audio_path),
+        codec=stream.get("codec_name"),
+        bit_rate=int(bit_rate) if bit_rate not in (None, "N/A") else None,
+    )
+    logger.info(
+        "[PROBE] %s: %.1fs, codec=%s, bit_rate=%s, %d bytes",
+        audio_path, info.duration_seconds, info.codec, info.bit_rate, info.size_bytes,
+    )
+    return info
+
+
+def plan_chunk_boundaries(
+    info: AudioInfo,
+    max_chunk_seconds: float,
+    max_chunk_bytes: int = WHISPER_MAX_UPLOAD_BYTES,
+    slack_seconds: float = 0.0,
+) -> list[float]:
+    """Pick cut points that keep every chunk under both a duration and a byte cap.
+
+    The byte rate is taken from the file size over its duration, which
+    includes container overhead. Chunks are sized evenly so the last one is
+    not a short remainder.
+
+    Args:
+        info: Metadata of the file to split.
+        max_chunk_seconds: Maximum duration per chunk.
+        max_chunk_bytes: Maximum size per chunk.
+        slack_seconds: Headroom subtracted from each planned chunk, so that
+            cut points can later be moved by up to half of it in either
+            direction without breaking the caps.
+
+    Returns:
+        Cut points in seconds from the start of the file, in ascending order.
+        An empty list means the file does not need splitting.
+    """
+    duration = info.duration_seconds
+    if duration <= 0:
+        return []
+
+    bytes_per_second = info.size_bytes / duration
+    chunk_seconds = max_chunk_seconds
+    if bytes_per_second > 0:
+        chunk_seconds = min(
+            chunk_seconds, max_chunk_bytes * CHUNK_BYTE_SAFETY_RATIO / bytes_per_second
         )
 
+    if duration <= chunk_seconds and info.size_bytes <= max_chunk_bytes:
+        return []
+
+    chunk_seconds = max(chunk_seconds - slack_seconds, 1.0)
+    num_chunks = max(2, math.ceil(duration / chunk_seconds))
+    step = duration / num_chunks
+    return [round(step * i, 3) for i in range(1, num_chunks)]
+
+
+def frame_rms(samples: np.ndarray, frame_size: int) -> np.ndarray:
+    """Compute the RMS energy of consecutive non-overlapping frames.
+
+    Trailing samples that do not fill a whole frame are ignored.
+    """
+    num_frames = len(samples) // frame_size
+    if num_frames == 0:
+        return np.empty(0, dtype=np.float32)
+    frames = samples[: num_frames * frame_size].astype(np.float32).reshape(num_frames, frame_size)
+    return np.sqrt(np.mean(np.square(frames), axis=1))
+
+
+def find_quiet_frame(energy: np.ndarray, target: int, pause_frames: int) -> int:
+    """Return the index of the pause closest to target in an energy envelope.
+
+    The envelope is smoothed over pause_frames so that a single quiet frame
+    inside a word does not count as a pause. A frame is quiet when its
+    smoothed energy is within QUIET_RATIO of the way from the window's
+    minimum to its median; the quiet frame nearest to target wins.
+    """
+    if len(energy) == 0:
+        return target
+    pause_frames = max(1, min(pause_frames, len(energy)))
+    kernel = np.ones(pause_frames, dtype=np.float32) / pause_frames
+    smoothed = np.convolve(energy, kernel, mode="same")
+    floor = smoothed.min()
+    threshold = floor + QUIET_RATIO * (np.median(smoothed) - floor)
+    candidates = np.flatnonzero(smoothed <= threshold)
+    return int(candidates[np.argmin(np.abs(candidates - target))])
+
 
-def split_audio_if_needed(
-    audio_path: str, max_chunk_minutes: int = 15
-) -> list[str]:
-    """Split audio into chunks if it exceeds the maximum duration.
+def compute_energy_envelope(
+    audio_path: str, start: float = 0.0, duration: float | None = None
+) -> np.ndarray:
+    """Decode audio_path to 8 kHz mono PCM and return its RMS envelope.
+
+    Each value covers ENERGY_WINDOW_SECONDS. ffmpeg seeks in the container
+    and decodes only the requested window (the whole file when duration is
+    None); its output is consumed in blocks of ANALYSIS_READ_FRAMES frames
+    so memory stays bounded regardless of the window length.
+    """
+    frame_size = int(ANALYSIS_SAMPLE_RATE * ENERGY_WINDOW_SECONDS)
+    block_bytes = frame_size * ANALYSIS_READ_FRAMES * 2
+    window_args = ["-ss", f"{start:.3f}"]
+    if duration is not None:
+        window_args += ["-t", f"{duration:.3f}"]
+    cmd = [
+        FFMPEG_BINARY, "-nostdin", "-hide_banner", "-loglevel", "error",
+        *window_args,
+        "-i", audio_path,
+        "-map", "0:a:0", "-ac", "1", "-ar", str(ANALYSIS_SAMPLE_RATE),
+        "-f", "s16le", "-",
+    ]
+    envelopes = []
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        while True:
+            block = proc.stdout.read(block_bytes)
+            if not block:
+                break
+            samples = np.frombuffer(block[: len(block) - len(block) % 2], dtype=np.int16)
+            envelopes.append(frame_rms(samples, frame_size))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return np.concatenate(envelopes) if envelopes else np.empty(0, dtype=np.float32)
+
+
+def snap_boundaries_to_silence(
+    audio_path: str, boundaries: list[float], tolerance_seconds: float
+) -> list[float]:
+    """Move each cut point to the nearest pause within tolerance_seconds.
+
+    Only the audio around each boundary is decoded. Boundaries whose window
+    cannot be analysed are kept as planned.
 
     Args:
         audio_path: Path to the audio file.
-        max_chunk_minutes: Maximum duration per chunk in minutes.
+        boundaries: Planned cut points in seconds, ascending.
+        tolerance_seconds: Maximum distance a cut point may move.
 
     Returns:
-        A list of file paths. If no split is needed, returns [audio_path].
-        Otherwise returns paths to the individual chunk files.
+        The adjusted cut points, still strictly ascending.
     """
-    audio = AudioSegment.from_file(audio_path)
-    max_chunk_ms = max_chunk_minutes * 60 * 1000
+    if tolerance_seconds <= 0:
+        return list(boundaries)
+
+    pause_frames = int(MIN_PAUSE_SECONDS / ENERGY_WINDOW_SECONDS)
+    snapped = []
+    for boundary in boundaries:
+        start = max(0.0, boundary - tolerance_seconds)
+        try:
+            energy = compute_energy_envelope(audio_path, start, boundary + tolerance_seconds - start)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning("[SPLIT] Silence analysis failed near %.1fs: %s", boundary, e)
+            energy = np.empty(0, dtype=np.float32)
 
-    if len(audio) <= max_chunk_ms:
-        return [audio_path]
+        target = int((boundary - start) / ENERGY_WINDOW_SECONDS)
+        cut = boundary
+        if len(energy):
+            frame = find_quiet_frame(energy, min(target, len(energy) - 1), pause_frames)
+            cut = round(start + (frame + 0.5) * ENERGY_WINDOW_SECONDS, 3)
 
-    chunks = []
-    temp_dir = tempfile.mkdtemp()
+        if snapped and cut <= snapped[-1]:
+            cut = boundary
+        snapped.append(cut)
 
-    start = 0
-    chunk_index = 0
-    while start < len(audio):
-        end = min(start + max_chunk_ms, len(audio))
-        chunk = audio[start:end]
+    logger.info("[SPLIT] Snapped cut points %s -> %s", boundaries, snapped)
+    return snapped
 
-        chunk_path = os.path.join(temp_dir, f"chunk_{chunk_index}.m4a")
-        chunk.export(chunk_path, format="ipod")
-        chunks.append(chunk_path)
 
-        start = end
-        chunk_index += 1
+def iter_audio_chunks(
+    audio_path: str,
+    max_chunk_minutes: int = 15,
+    max_chunk_bytes: int = WHISPER_MAX_UPLOAD_BYTES,
+    snap_tolerance_seconds: float = 0.0,
+    output_dir: str | None = None,
+) -> Iterator[AudioChunk]:
+    """Yield chunks of audio_path as soon as each one is written.
+
+    The file is probed from its container headers first, so short files are
+    yielded untouched without being decoded. Longer files are cut at the
+    container level with ffmpeg's segment muxer in stream-copy mode, so the
+    recording is never decoded to PCM or re-encoded. If the source codec
+    cannot be copied into the output container, the segmenter falls back to
+    a streaming AAC re-encode. With a snap tolerance, each cut point is
+    moved to the nearest pause so chunks do not end mid-sentence.
+
+    Args:
+        audio_path: Path to the audio file.
+        max_chunk_minutes: Maximum duration per chunk in minutes.
+        max_chunk_bytes: Maximum size per chunk in bytes.
+        snap_tolerance_seconds: How far a cut point may move to reach a
+            pause. 0 keeps the evenly planned cut points.
+        output_dir: Directory to write chunk files to. The caller owns it
+            and is responsible for cleaning it up; when omitted a new
+            temporary directory is created and left behind.
+
+    Yields:
+        An AudioChunk covering the whole of audio_path if no split is
+        needed, otherwise one AudioChunk per chunk file in playback order.
+        Start and end times are the cut points in the original recording.
+    """
+    info = probe_audio(audio_path)
+    boundaries = plan_chunk_boundaries(
+        info, max_chunk_minutes * 60, max_chunk_bytes, slack_seconds=2 * snap_tolerance_seconds
+    )
+    if not boundaries:
+        yield AudioChunk(audio_path, 0.0, info.duration_seconds)
+        return
+    boundaries = snap_boundaries_to_silence(audio_path, boundaries, snap_tolerance_seconds)
+    starts = [0.0, *boundaries]
+    ends = [*boundaries, info.duration_seconds]
+
+    temp_dir = output_dir or tempfile.mkdtemp()
+    extension = os.path.splitext(audio_path)[1] or ".m4a"
+    pattern = os.path.join(temp_dir, f"chunk_%d{extension}")
+    logger.info("[SPLIT] Splitting %s into %d chunk(s) at %s", audio_path, len(boundaries) + 1, boundaries)
+
+    produced = 0
+    try:
+        for chunk_path in _run_segmenter(audio_path, pattern, boundaries, stream_copy=True):
+            yield AudioChunk(chunk_path, starts[produced], ends[produced])
+            produced += 1
+    except subprocess.CalledProcessError as e:
+        # Copy failures surface on the first packet; once chunks have been
+        # handed out there is no clean way to restart.
+        if produced:
+            raise
+        logger.warning(
+            "[SPLIT] Stream copy failed for %s, re-encoding instead: %s",
+            audio_path, (e.stderr or b"").decode(errors="replace").strip(),
+        )
+        for path in glob.glob(os.path.join(temp_dir, "chunk_*")):
+            os.remove(path)
+        for i, chunk_path in enumerate(_run_segmenter(audio_path, pattern, boundaries, stream_copy=False)):
+            yield AudioChunk(chunk_path, starts[i], ends[i])
+
+
+def _run_segmenter(
+    audio_path: str, pattern: str, boundaries: list[float], stream_copy: bool
+) -> Iterator[str]:
+    """Run ffmpeg's segment muxer over audio_path, cutting at the given times.
+
+    ffmpeg prints each segment to the flat segment list on stdout once the
+    segment is complete, so chunks are yielded while later ones are still
+    being written.
+    """
+    codec_args = ["-c:a", "copy"] if stream_copy else ["-c:a", "aac", "-b:a", "64k"]
+    cmd = [
+        FFMPEG_BINARY, "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        "-i", audio_path,
+        "-map", "0:a:0", "-vn",
+        *codec_args,
+        "-f", "segment",
+        "-segment_times", ",".join(f"{t:.3f}" for t in boundaries),
+        "-segment_list", "pipe:1",
+        "-segment_list_type", "flat",
+        "-reset_timestamps", "1",
+        pattern,
+    ]
+    output_dir = os.path.dirname(pattern)
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+        try:
+            for line in proc.stdout:
+                name = line.decode().strip()
+                if name:
+                    yield os.path.join(output_dir, os.path.basename(name))
+        except GeneratorExit:
+            proc.kill()
+            raise
+        stderr = proc.stderr.read()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+
+
+def transcode_for_upload(
+    audio_path: str,
+    codec: str = "libopus",
+    bitrate_kbps: int = 24,
+    sample_rate: int = 16000,
+) -> str:
+    """Re-encode audio to a compact mono speech profile if that shrinks it.
+
+    Args:
+        audio_path: Path to the audio file.
+        codec: ffmpeg encoder name, one of UPLOAD_CODEC_EXTENSIONS.
+        bitrate_kbps: Target bitrate in kbit/s.
+        sample_rate: Target sample rate in Hz.
+
+    Returns:
+        The path of the re-encoded file, or audio_path when re-encoding
+        would not make the upload smaller.
+
+    Raises:
+        ValueError: If codec is not supported.
+        subprocess.CalledProcessError: If ffmpeg fails.
+    """
+    if codec not in UPLOAD_CODEC_EXTENSIONS:
+        raise ValueError(f"Unsupported upload codec: {codec}")
+
+    root, _ = os.path.splitext(audio_path)
+    output_path = f"{root}_upload{UPLOAD_CODEC_EXTENSIONS[codec]}"
+    cmd = [
+        FFMPEG_BINARY, "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        "-i", audio_path,
+        "-map", "0:a:0", "-vn",
+        "-ac", "1", "-ar", str(sample_rate),
+        "-c:a", codec, "-b:a", f"{bitrate_kbps}k",
+        output_path,
+    ]
+    subprocess.run(cmd, check=True, capture_output=True)
+
+    original_size = os.path.getsize(audio_path)
+    output_size = os.path.getsize(output_path)
+    if output_size >= original_size:
+        os.remove(output_path)
+        logger.info(
+            "[TRANSCODE] Keeping %s (%d bytes); %s at %dk would be %d bytes",
+            audio_path, original_size, codec, bitrate_kbps, output_size,
+        )
+        return audio_path
 
-    return chunks
+    logger.info(
+        "[TRANSCODE] %s: %d -> %d bytes (saved %d bytes, %.0f%%)",
+        audio_path, original_size, output_size, original_size - output_size,
+        100 * (original_size - output_size) / original_size,
+    )
+    return output_path
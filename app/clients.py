@@ -0,0 +1,120 @@
+"""Process-wide API clients with keep-alive connection pools."""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import anthropic
+import httpx
+import openai
+from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, Configuration
+
+from app.rate_limit import ANTHROPIC, OPENAI, response_hook
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Clients:
+    """Long-lived clients shared by every pipeline run.
+
+    Each async client keeps its own connection pool, so repeated calls to
+    the same upstream reuse TLS connections instead of handshaking per
+    request. audio_executor runs the blocking ffmpeg and numpy work of all
+    jobs off the event loop.
+    """
+
+    http: httpx.AsyncClient
+    openai: openai.AsyncOpenAI
+    anthropic: anthropic.AsyncAnthropic
+    line_api_client: AsyncApiClient
+    messaging_api: AsyncMessagingApi
+    audio_executor: ThreadPoolExecutor
+
+    async def aclose(self) -> None:
+        for name, close in (
+            ("http", self.http.aclose),
+            ("openai", self.openai.close),
+            ("anthropic", self.anthropic.close),
+            ("line", self.line_api_client.close),
+        ):
+            try:
+                await close()
+            except Exception as e:
+                logger.warning("[CLIENTS] Failed to close %s client: %s", name, e)
+        self.audio_executor.shutdown(wait=False, cancel_futures=True)
+
+
+_clients: Clients | None = None
+
+
+def build_clients(settings) -> Clients:
+    """Create the shared clients with pools sized from settings.
+
+    Must be called from a running event loop: the LINE client opens its
+    aiohttp session on construction.
+    """
+    limits = httpx.Limits(
+        max_connections=settings.client_pool_size,
+        max_keepalive_connections=settings.client_pool_size,
+        keepalive_expiry=settings.client_keepalive_seconds,
+    )
+
+    # With rate limiting on, app.rate_limit does the retrying: SDK retries
+    # would bypass its budget and back off on their own.
+    sdk_retries = 0 if settings.rate_limit_enabled else 2
+
+    configuration = Configuration(access_token=settings.line_channel_access_token)
+    configuration.connection_pool_maxsize = settings.client_pool_size
+    line_api_client = AsyncApiClient(configuration)
+
+    return Clients(
+        http=httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(30.0, read=120.0)),
+        openai=openai.AsyncOpenAI(
+            api_key=settings.openai_api_key,
+            max_retries=sdk_retries,
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=limits, event_hooks={"response": [response_hook(OPENAI)]}
+            ),
+        ),
+        anthropic=anthropic.AsyncAnthropic(
+            api_key=settings.anthropic_api_key,
+            max_retries=sdk_retries,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=limits, event_hooks={"response": [response_hook(ANTHROPIC)]}
+            ),
+        ),
+        line_api_client=line_api_client,
+        messaging_api=AsyncMessagingApi(line_api_client),
+        audio_executor=ThreadPoolExecutor(
+            max_workers=settings.audio_max_workers, thread_name_prefix="audio"
+        ),
+    )
+
+
+def init_clients(settings) -> Clients:
+    """Build the shared clients; called once at application startup."""
+    global _clients
+    if _clients is not None:
+        return _clients
+    _clients = build_clients(settings)
+    logger.info(
+        "[CLIENTS] Shared clients ready (pool size=%d, audio workers=%d)",
+        settings.client_pool_size, settings.audio_max_workers,
+    )
+    return _clients
+
+
+def get_clients() -> Clients | None:
+    """Return the shared clients, or None outside a running application."""
+    return _clients
+
+
+async def close_clients() -> None:
+    """Close every shared client; called once at application shutdown."""
+    global _clients
+    if _clients is None:
+        return
+    clients, _clients = _clients, None
+    await clients.aclose()
+    logger.info("[CLIENTS] Shared clients closed")
@@ -10,6 +10,63 @@ class Settings(BaseSettings):
     max_audio_size_mb: int = 100
     claude_model: str = "claude-sonnet-4-5-20250929"
     claude_max_tokens: int = 4096
+    chunk_max_minutes: int = 15
+    chunk_max_mb: int = 25
+    chunk_snap_tolerance_seconds: int = 30
+    vad_enabled: bool = False
+    vad_min_silence_seconds: float = 2.0
+    upload_transcode_enabled: bool = True
+    upload_codec: str = "libopus"
+    upload_bitrate_kbps: int = 24
+    upload_sample_rate: int = 16000
+    transcribe_max_concurrency: int = 4
+    transcribe_max_retries: int = 2
+    summarize_max_concurrency: int = 2
+    merge_token_budget: int = 12000
+    transcript_token_budget: int = 100000
+    stream_notes_enabled: bool = True
+    preview_enabled: bool = False
+    preview_model: str = "claude-haiku-4-5-20251001"
+    preview_max_tokens: int = 300
+    model_routing_enabled: bool = True
+    fast_model: str = "claude-haiku-4-5-20251001"
+    fast_max_tokens: int = 2048
+    fast_route_max_tokens: int = 4000
+    high_priority_users: str = ""
+    low_priority_users: str = ""
+    stage_queue_size: int = 2
+    client_pool_size: int = 20
+    client_keepalive_seconds: float = 30.0
+    audio_max_workers: int = 4
+    rate_limit_enabled: bool = True
+    rate_limit_max_retries: int = 4
+    rate_limit_max_delay_seconds: float = 60.0
+    openai_rpm: int = 500
+    anthropic_rpm: int = 1000
+    anthropic_tpm: int = 450000
+    line_rpm: int = 60000
+    job_db_path: str = "data/jobs.db"
+    job_workers: int = 4
+    job_max_pending: int = 50
+    job_max_attempts: int = 3
+    job_poll_seconds: float = 1.0
+    job_node_id: str = ""
+    job_lease_seconds: float = 60.0
+    job_heartbeat_seconds: float = 15.0
+    job_retry_delay_seconds: float = 30.0
+    job_fast_lane_workers: int = 1
+    job_fast_lane_max_seconds: float = 300.0
+    job_retention_hours: float = 168.0
+    batch_window_seconds: float = 3.0
+    batch_max_size: int = 10
+    batch_summarize_together: bool = False
+    workspace_dir: str = "data/workspaces"
+    workspace_max_age_hours: float = 72.0
+    result_cache_enabled: bool = True
+    result_cache_path: str = "data/results.db"
+    result_cache_max_mb: int = 50
+    idempotency_db_path: str = "data/idempotency.db"
+    idempotency_ttl_hours: float = 24.0
 
     model_config = {"env_file": ".env", "env_file_encoding": "utf-8"}
 
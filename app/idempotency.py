@@ -0,0 +1,87 @@
+"""Persistent record of webhook events already acted on, for deduplication."""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS seen_expires_at ON seen (expires_at)",
+)
+
+# Expired keys are deleted at most this often, not on every webhook.
+PURGE_INTERVAL_SECONDS = 60.0
+
+
+class IdempotencyStore:
+    """Keys of webhook events and messages seen within the last ttl_seconds.
+
+    LINE redelivers a webhook when the first delivery times out, and the
+    same recording can also arrive in two events. Recording both the
+    webhookEventId and the message ID lets the webhook acknowledge either
+    kind of duplicate without scheduling a second pipeline run. Keys are
+    kept in SQLite so a restart between a delivery and its redelivery does
+    not forget them.
+
+    Args:
+        db_path: SQLite file to store keys in (":memory:" for tests).
+        ttl_seconds: How long a key is remembered.
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: float):
+        if db_path != ":memory:" and os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.duplicates = 0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def first_seen(self, *keys: str) -> bool:
+        """Record keys, reporting whether none of them had been seen.
+
+        Check and record happen in one transaction, so of two concurrent
+        deliveries of the same event exactly one gets True. Duplicates are
+        counted.
+        """
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so replicas sharing
+            # the file cannot both read "unseen" for the same key.
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if now - self._purged_at >= PURGE_INTERVAL_SECONDS:
+                    self._conn.execute("DELETE FROM seen WHERE expires_at < ?", (now,))
+                    self._purged_at = now
+                placeholders = ", ".join("?" * len(keys))
+                (seen,) = self._conn.execute(
+                    f"SELECT COUNT(*) FROM seen WHERE key IN ({placeholders}) AND expires_at >= ?", (*keys, now)
+                ).fetchone()
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO seen (key, expires_at) VALUES (?, ?)",
+                    [(key, now + self.ttl_seconds) for key in keys],
+                )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            if seen:
+                self.duplicates += 1
+        return not seen
+
+    def stats(self) -> dict:
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM seen").fetchone()
+        return {"duplicates": self.duplicates, "entries": entries}
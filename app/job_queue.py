@@ -0,0 +1,587 @@
+"""Durable SQLite-backed job queue and the worker pool that drains it."""
+
+import asyncio
+import functools
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+TRANSCRIBING = "transcribing"
+SUMMARIZING = "summarizing"
+SENT = "sent"
+FAILED = "failed"
+
+ACTIVE_STATES = (DOWNLOADING, TRANSCRIBING, SUMMARIZING)
+JOB_STATES = (QUEUED, *ACTIVE_STATES, SENT, FAILED)
+
+_SCHEMA = (
+    """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    message_id TEXT NOT NULL UNIQUE,
+    priority TEXT NOT NULL DEFAULT 'normal',
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+""",
+    "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)",
+)
+
+# Columns added after the first release; existing databases are migrated
+# in place on open.
+_MIGRATIONS = {
+    "lease_owner": "ALTER TABLE jobs ADD COLUMN lease_owner TEXT",
+    "lease_expires_at": "ALTER TABLE jobs ADD COLUMN lease_expires_at REAL",
+    "available_at": "ALTER TABLE jobs ADD COLUMN available_at REAL NOT NULL DEFAULT 0",
+    "batch_id": "ALTER TABLE jobs ADD COLUMN batch_id INTEGER",
+    "duration_seconds": "ALTER TABLE jobs ADD COLUMN duration_seconds REAL",
+    "claimed_at": "ALTER TABLE jobs ADD COLUMN claimed_at REAL",
+}
+
+# Jobs queued before batching existed become batches of one.
+_POST_MIGRATION = (
+    "UPDATE jobs SET batch_id = id WHERE batch_id IS NULL",
+    "CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id)",
+    "CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, claimed_at)",
+    "CREATE INDEX IF NOT EXISTS jobs_user_state ON jobs (user_id, state)",
+)
+
+# Finished jobs past their retention are deleted at most this often, by
+# whichever claim comes first.
+PURGE_INTERVAL_SECONDS = 60.0
+
+_ROW_COLUMNS = "user_id, message_id, priority, state, attempts"
+_ACTIVE = ", ".join(f"'{state}'" for state in ACTIVE_STATES)
+
+# Claim order among runnable jobs: users with the fewest jobs running
+# first, then the user served longest ago, then the oldest job. Every
+# user with work waiting is served in turn, however much one of them
+# has queued.
+_FAIR_ORDER = f"""
+    (SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.state IN ({_ACTIVE}) AND r.lease_expires_at >= :now),
+    (SELECT COALESCE(MAX(r.claimed_at), 0) FROM jobs r WHERE r.user_id = j.user_id),
+    j.id
+"""
+
+# A batch's estimated length; recordings of unknown length never count as
+# short.
+_BATCH_DURATION = f"""
+    (SELECT SUM(COALESCE(d.duration_seconds, 1e12)) FROM jobs d
+     WHERE d.batch_id = j.batch_id AND d.state NOT IN ('{SENT}', '{FAILED}'))
+"""
+
+
+class QueueFullError(Exception):
+    """Raised when admission control turns a new job away."""
+
+
+@dataclass(frozen=True)
+class Job:
+    """Recordings from one user waiting for, or going through, the pipeline.
+
+    Recordings sent together are queued as one batch and run as one job;
+    id is the batch's ID, message_ids lists the recordings in it and
+    message_id is the first of them.
+    """
+
+    id: int
+    user_id: str
+    message_id: str
+    priority: str
+    state: str
+    attempts: int
+    message_ids: tuple[str, ...] = ()
+
+
+JobHandler = Callable[[Job, Callable[[str], None]], Awaitable[bool]]
+
+
+def default_node_id() -> str:
+    """Identify this process among the replicas sharing a job store."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobQueue:
+    """Persistent queue of pipeline jobs, shared by every replica.
+
+    A node claims a job by taking a lease on it for lease_seconds and keeps
+    it by renewing the lease with heartbeat(). If the node dies, the lease
+    runs out and the next claim() from any node picks the job up again, so
+    work is spread over whichever replicas have free workers and a crashed
+    replica's jobs are not lost. A job whose lease has expired
+    max_attempts times is failed rather than retried forever.
+
+    Claims run in a BEGIN IMMEDIATE transaction, so two processes can never
+    take the same job. Several processes can share one database file as
+    long as it sits on a filesystem with working file locks (a local disk
+    or a volume shared by containers on one host, not NFS). Each message_id
+    is queued at most once, so a redelivered webhook does not create a
+    second job.
+
+    Recordings can be batched: one enqueued with the batch_id of a job
+    that has not started yet joins that job, and with batch_window_seconds
+    set, every new job waits that long for more recordings from the same
+    user to join it. A batch is claimed, leased and retried as one job,
+    but each recording keeps its own row, so admission control counts
+    recordings and a recording finished early stays finished when the
+    rest of its batch is retried.
+
+    Jobs are not claimed strictly in arrival order but fairly between
+    users, so one user's backlog of long recordings does not hold up
+    everyone else. A claim can also be limited to jobs whose estimated
+    duration is short, which is how WorkerPool keeps a fast lane open.
+
+    Finished jobs are kept for retention_seconds, for /stats and so a
+    late redelivery of their messages is still recognised, then deleted
+    so the table (and the per-user lookups of the fair order) stays small.
+
+    Args:
+        db_path: SQLite file to store jobs in (":memory:" for tests).
+        max_pending: Admission limit on queued plus in-flight jobs.
+        max_attempts: Times a job is started before it is given up on.
+        node_id: Lease owner name for this process; defaults to
+            hostname and pid.
+        lease_seconds: How long a claim lasts without a heartbeat.
+        batch_window_seconds: How long a new job waits for further
+            recordings from the same user.
+        batch_max_size: Most recordings in one batch.
+        retention_seconds: How long sent and failed jobs are kept.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_pending: int = 50,
+        max_attempts: int = 3,
+        node_id: str | None = None,
+        lease_seconds: float = 60.0,
+        batch_window_seconds: float = 0.0,
+        batch_max_size: int = 10,
+        retention_seconds: float = 7 * 24 * 3600,
+    ):
+        if db_path != ":memory:" and os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.node_id = node_id or default_node_id()
+        self.lease_seconds = lease_seconds
+        self.batch_window_seconds = batch_window_seconds
+        self.batch_max_size = max(1, batch_max_size)
+        self.retention_seconds = retention_seconds
+        self._purged_at = 0.0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.Lock()
+        self._added = asyncio.Event()
+        with self._transaction():
+            for statement in _SCHEMA:
+                self._conn.execute(statement)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column, statement in _MIGRATIONS.items():
+                if column not in columns:
+                    self._conn.execute(statement)
+            for statement in _POST_MIGRATION:
+                self._conn.execute(statement)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def enqueue(
+        self,
+        user_id: str,
+        message_id: str,
+        priority: str = "normal",
+        batch_id: int | None = None,
+        duration_seconds: float | None = None,
+    ) -> Job:
+        """Add a recording, or return the job already holding the same message.
+
+        The recording joins batch_id if that job is still waiting to start
+        and has room, or else an open batching window of the same user's;
+        otherwise it starts a job of its own. duration_seconds is the
+        recording's estimated length, if known.
+
+        Raises:
+            QueueFullError: If max_pending recordings are already queued or
+                running.
+        """
+        now = time.time()
+        with self._transaction():
+            existing = self._conn.execute(
+                "SELECT batch_id FROM jobs WHERE message_id = ?", (message_id,)
+            ).fetchone()
+            if existing is not None:
+                return self._load(existing[0])
+
+            (pending,) = self._conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE state = ? OR state IN ({_ACTIVE})", (QUEUED,)
+            ).fetchone()
+            if pending >= self.max_pending:
+                raise QueueFullError(f"{pending} jobs pending (limit {self.max_pending})")
+
+            batch = self._open_batch(user_id, priority, batch_id, now)
+            available_at = batch[1] if batch else now + self.batch_window_seconds
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (user_id, message_id, priority, state, available_at, batch_id, "
+                "duration_seconds, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    user_id, message_id, priority, QUEUED, available_at, batch[0] if batch else None,
+                    duration_seconds, now, now,
+                ),
+            )
+            if batch is None:
+                self._conn.execute("UPDATE jobs SET batch_id = id WHERE id = ?", (cursor.lastrowid,))
+            job = self._load(batch[0] if batch else cursor.lastrowid)
+
+        logger.debug(
+            "[QUEUE] Queued message_id=%s as job %d (%d recording(s), %d ahead)",
+            message_id, job.id, len(job.message_ids), pending,
+        )
+        self._added.set()
+        return job
+
+    def _open_batch(self, user_id: str, priority: str, batch_id: int | None, now: float) -> tuple | None:
+        """The (batch_id, available_at) a new recording should join, if any."""
+        if batch_id is not None:
+            condition, params = "batch_id = ?", (batch_id,)
+        elif self.batch_window_seconds > 0:
+            condition, params = "available_at > ?", (now,)
+        else:
+            return None
+        return self._conn.execute(
+            f"SELECT batch_id, MAX(available_at) FROM jobs "
+            f"WHERE {condition} AND user_id = ? AND priority = ? AND state = ? AND attempts = 0 "
+            f"GROUP BY batch_id HAVING COUNT(*) < ? ORDER BY batch_id DESC LIMIT 1",
+            (*params, user_id, priority, QUEUED, self.batch_max_size),
+        ).fetchone()
+
+    def claim(self, max_duration_seconds: float | None = None) -> Job | None:
+        """Lease the next job that is queued or whose lease has expired.
+
+        Jobs are taken in fair order between users. Every unfinished
+        recording in the job's batch is marked as downloading and leased
+        to this node for lease_seconds.
+
+        Args:
+            max_duration_seconds: Only take a job whose recordings are
+                estimated to last at most this long in total.
+        """
+        now = time.time()
+        with self._transaction():
+            expired = self._conn.execute(
+                f"UPDATE jobs SET state = ?, error = ?, lease_owner = NULL, updated_at = ? "
+                f"WHERE state IN ({_ACTIVE}) AND lease_expires_at < ? AND attempts >= ?",
+                (FAILED, "lease expired too many times", now, now, self.max_attempts),
+            ).rowcount
+            purged = 0
+            if now - self._purged_at >= PURGE_INTERVAL_SECONDS:
+                purged = self._purge_finished(now)
+                self._purged_at = now
+            lane = f"AND {_BATCH_DURATION} <= :max_duration" if max_duration_seconds is not None else ""
+            row = self._conn.execute(
+                f"SELECT j.batch_id, j.state, j.lease_owner FROM jobs j "
+                f"WHERE ((j.state = :queued AND j.available_at <= :now) "
+                f"OR (j.state IN ({_ACTIVE}) AND j.lease_expires_at < :now)) {lane} "
+                f"ORDER BY {_FAIR_ORDER} LIMIT 1",
+                {"queued": QUEUED, "now": now, "max_duration": max_duration_seconds},
+            ).fetchone()
+            if row is None:
+                job = None
+            else:
+                batch_id, previous_state, previous_owner = row
+                rows = self._conn.execute(
+                    f"SELECT {_ROW_COLUMNS} FROM jobs "
+                    f"WHERE batch_id = ? AND (state = ? OR state IN ({_ACTIVE})) ORDER BY id",
+                    (batch_id, QUEUED),
+                ).fetchall()
+                self._conn.execute(
+                    f"UPDATE jobs SET state = ?, attempts = attempts + 1, lease_owner = ?, "
+                    f"lease_expires_at = ?, claimed_at = ?, updated_at = ? "
+                    f"WHERE batch_id = ? AND (state = ? OR state IN ({_ACTIVE}))",
+                    (DOWNLOADING, self.node_id, now + self.lease_seconds, now, now, batch_id, QUEUED),
+                )
+                user_id, message_id, priority = rows[0][:3]
+                job = Job(
+                    batch_id, user_id, message_id, priority, DOWNLOADING,
+                    max(r[4] for r in rows) + 1, tuple(r[1] for r in rows),
+                )
+
+        if expired:
+            logger.warning("[QUEUE] Gave up on %d job(s) whose leases kept expiring", expired)
+        if purged:
+            logger.info("[QUEUE] Purged %d finished job(s) past retention", purged)
+        if job is not None and previous_state != QUEUED:
+            logger.warning(
+                "[QUEUE] Reclaimed job %d from %s after its lease expired", job.id, previous_owner
+            )
+        return job
+
+    def heartbeat(self, job_id: int) -> bool:
+        """Extend this node's lease on a running job.
+
+        Returns:
+            False if the lease was lost to another node.
+        """
+        with self._transaction():
+            renewed = self._conn.execute(
+                f"UPDATE jobs SET lease_expires_at = ? "
+                f"WHERE batch_id = ? AND lease_owner = ? AND state IN ({_ACTIVE})",
+                (time.time() + self.lease_seconds, job_id, self.node_id),
+            ).rowcount
+        return renewed > 0
+
+    def set_state(
+        self, job_id: int, state: str, error: str | None = None, message_id: str | None = None
+    ) -> bool:
+        """Record progress on a job this node holds the lease for.
+
+        Recordings of the job that already finished keep their state. With
+        message_id, only that recording of the batch is updated.
+
+        Returns:
+            False if the lease was lost to another node and nothing changed.
+        """
+        if state not in JOB_STATES:
+            raise ValueError(f"Unknown job state: {state}")
+        query = (
+            f"UPDATE jobs SET state = ?, error = ?, updated_at = ? "
+            f"WHERE batch_id = ? AND lease_owner = ? AND state IN ({_ACTIVE})"
+        )
+        params = (state, error, time.time(), job_id, self.node_id)
+        if message_id is not None:
+            query += " AND message_id = ?"
+            params += (message_id,)
+        with self._transaction():
+            updated = self._conn.execute(query, params).rowcount
+        logger.debug("[QUEUE] Job %d is %s%s", job_id, state, f" for message_id={message_id}" if message_id else "")
+        return updated > 0
+
+    def retry(self, job_id: int, error: str, delay_seconds: float) -> None:
+        """Put a failed job back in the queue to run again after delay_seconds."""
+        with self._transaction():
+            self._conn.execute(
+                f"UPDATE jobs SET state = ?, error = ?, lease_owner = NULL, lease_expires_at = NULL, "
+                f"available_at = ?, updated_at = ? WHERE batch_id = ? AND lease_owner = ? AND state IN ({_ACTIVE})",
+                (QUEUED, error, time.time() + delay_seconds, time.time(), job_id, self.node_id),
+            )
+
+    def release(self, job_id: int) -> None:
+        """Hand a job this node is shutting down on back to the queue.
+
+        The interrupted run does not count as an attempt, since the job was
+        not at fault.
+        """
+        with self._transaction():
+            self._conn.execute(
+                f"UPDATE jobs SET state = ?, attempts = MAX(attempts - 1, 0), lease_owner = NULL, "
+                f"lease_expires_at = NULL, updated_at = ? "
+                f"WHERE batch_id = ? AND lease_owner = ? AND state IN ({_ACTIVE})",
+                (QUEUED, time.time(), job_id, self.node_id),
+            )
+        logger.info("[QUEUE] Released job %d back to the queue", job_id)
+
+    def get(self, job_id: int) -> Job | None:
+        with self._lock:
+            return self._load(job_id)
+
+    def counts(self) -> dict[str, int]:
+        """Number of jobs in each state."""
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = dict.fromkeys(JOB_STATES, 0)
+        counts.update(rows)
+        return counts
+
+    async def wait(self, timeout: float) -> None:
+        """Wait until a job may be available, or timeout seconds pass.
+
+        Only jobs queued by this process wake the wait early; jobs queued
+        by other replicas are found on the next poll.
+        """
+        # asyncio.timeout rather than wait_for: wait_for can swallow a
+        # cancellation that lands as the timeout fires, which would leave a
+        # worker running after WorkerPool.stop().
+        try:
+            async with asyncio.timeout(timeout):
+                await self._added.wait()
+        except TimeoutError:
+            pass
+        self._added.clear()
+
+    def _purge_finished(self, now: float) -> int:
+        """Delete sent and failed rows past retention whose batch is done."""
+        return self._conn.execute(
+            "DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ? AND NOT EXISTS "
+            "(SELECT 1 FROM jobs u WHERE u.batch_id = jobs.batch_id AND u.state NOT IN (?, ?))",
+            (SENT, FAILED, now - self.retention_seconds, SENT, FAILED),
+        ).rowcount
+
+    def _load(self, batch_id: int) -> Job | None:
+        """A batch as a Job, in the state of its first unfinished recording."""
+        rows = self._conn.execute(
+            f"SELECT {_ROW_COLUMNS} FROM jobs WHERE batch_id = ? ORDER BY id", (batch_id,)
+        ).fetchall()
+        if not rows:
+            return None
+        state = next((r[3] for r in rows if r[3] not in (SENT, FAILED)), rows[0][3])
+        user_id, message_id, priority = rows[0][:3]
+        return Job(
+            batch_id, user_id, message_id, priority, state, max(r[4] for r in rows), tuple(r[1] for r in rows)
+        )
+
+    @contextmanager
+    def _transaction(self):
+        """Hold the connection lock inside an IMMEDIATE (write-locked) transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+
+class WorkerPool:
+    """A fixed number of tasks running leased jobs one at a time each.
+
+    handler is awaited with the job and a callback that records its
+    progress; it returns True once the result has reached the user, and
+    raises to ask for the job to be retried. A job is retried after
+    retry_delay_seconds, doubling with each attempt, until the queue's
+    max_attempts is reached; then it is failed. While
+    it runs, the job's lease is renewed every heartbeat_seconds. If a
+    renewal finds the lease taken by another node, the local run is
+    cancelled so the job is not processed twice. Jobs still running when
+    the pool stops are released back to the queue for any node to resume.
+
+    fast_lane_workers of the workers only take jobs estimated to last at
+    most fast_lane_max_seconds, so a short memo starts promptly even while
+    the other workers are all busy with long recordings. At least one
+    worker always takes any job.
+
+    Args:
+        queue: Queue to take jobs from.
+        handler: Coroutine function that runs one job.
+        workers: Number of jobs run at once.
+        poll_seconds: How often idle workers recheck the queue.
+        heartbeat_seconds: How often running jobs renew their lease; keep
+            it well under the queue's lease_seconds.
+        retry_delay_seconds: Wait before the first retry of a failed job.
+        fast_lane_workers: Workers reserved for short jobs.
+        fast_lane_max_seconds: Longest estimated duration of a short job.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handler: JobHandler,
+        workers: int = 4,
+        poll_seconds: float = 1.0,
+        heartbeat_seconds: float = 15.0,
+        retry_delay_seconds: float = 30.0,
+        fast_lane_workers: int = 0,
+        fast_lane_max_seconds: float = 300.0,
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.poll_seconds = poll_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.retry_delay_seconds = retry_delay_seconds
+        self.fast_lane_workers = min(max(0, fast_lane_workers), self.workers - 1)
+        self.fast_lane_max_seconds = fast_lane_max_seconds
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(
+                self._work(self.fast_lane_max_seconds if n < self.fast_lane_workers else None),
+                name=f"job-worker-{n}",
+            )
+            for n in range(self.workers)
+        ]
+        logger.info(
+            "[QUEUE] Started %d job worker(s) (%d fast lane) as node %s",
+            self.workers, self.fast_lane_workers, self.queue.node_id,
+        )
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("[QUEUE] Job workers stopped")
+
+    async def _work(self, max_duration_seconds: float | None = None) -> None:
+        while True:
+            job = self.queue.claim(max_duration_seconds)
+            if job is None:
+                await self.queue.wait(self.poll_seconds)
+                continue
+
+            logger.info(
+                "[QUEUE] Running job %d for message_id=%s (%d recording(s), attempt %d)",
+                job.id, job.message_id, len(job.message_ids), job.attempts,
+            )
+            try:
+                sent = await self._run_leased(job)
+            except Exception as e:
+                if job.attempts < self.queue.max_attempts:
+                    delay = self.retry_delay_seconds * 2 ** (job.attempts - 1)
+                    logger.warning(
+                        "[QUEUE] Job %d failed on attempt %d/%d, retrying in %.0fs: %s",
+                        job.id, job.attempts, self.queue.max_attempts, delay, e,
+                    )
+                    self.queue.retry(job.id, str(e), delay)
+                else:
+                    logger.exception("[QUEUE] Job %d failed on its last attempt: %s", job.id, e)
+                    self.queue.set_state(job.id, FAILED, error=str(e))
+                continue
+
+            if sent is None:
+                logger.warning("[QUEUE] Lost the lease on job %d; another node took it over", job.id)
+                continue
+            if sent:
+                self.queue.set_state(job.id, SENT)
+            else:
+                self.queue.set_state(job.id, FAILED, error="pipeline reported failure")
+            logger.info("[QUEUE] Job %d finished: %s", job.id, SENT if sent else FAILED)
+
+    async def _run_leased(self, job: Job) -> bool | None:
+        """Run the handler while renewing the lease; None if the lease was lost."""
+        task = asyncio.create_task(
+            self.handler(job, functools.partial(self.queue.set_state, job.id)), name=f"job-{job.id}"
+        )
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=self.heartbeat_seconds)
+                if done:
+                    return task.result()
+                if not self.queue.heartbeat(job.id):
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    return None
+        except asyncio.CancelledError:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self.queue.release(job.id)
+            raise
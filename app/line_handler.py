@@ -4,22 +4,82 @@ import logging
 
 from linebot.v3.webhooks import MessageEvent, AudioMessageContent
 
-from app import config, pipeline
+from app.job_queue import QueueFullError
 
 logger = logging.getLogger(__name__)
 
+QUEUE_BUSY_MESSAGE = "⏳ 目前處理中的語音訊息過多，請稍後再傳送一次。"
 
-def handle_audio_message(event, reply_func, background_tasks) -> None:
-    """Handle an incoming LINE audio message event."""
-    user_id = event.source.user_id
-    message_id = event.message.id
+# Bitrate assumed when a shared audio file's length is guessed from its
+# size; 128 kbps is typical of phone voice recorders.
+ASSUMED_FILE_BYTES_PER_SECOND = 16_000
 
-    logger.info("[HANDLER] Processing audio message_id=%s from user_id=%s", message_id, user_id)
 
-    logger.info("[HANDLER] Sending immediate reply...")
-    reply_func("🎙️ 已收到語音訊息，正在處理中，請稍候...")
-    logger.info("[HANDLER] Immediate reply done")
+def estimate_duration_seconds(message) -> float | None:
+    """Guess a recording's length from the webhook, before downloading it.
 
-    logger.info("[HANDLER] Scheduling background task...")
-    background_tasks.add_task(pipeline.process_audio_pipeline, user_id, message_id)
-    logger.info("[HANDLER] Background task scheduled for message_id=%s", message_id)
+    LINE reports the duration of audio messages; for a shared file only
+    its size is known, so the length is estimated from a typical bitrate.
+    """
+    duration = getattr(message, "duration", None)
+    if isinstance(duration, (int, float)):
+        return duration / 1000
+    file_size = getattr(message, "file_size", None)
+    if isinstance(file_size, (int, float)):
+        return file_size / ASSUMED_FILE_BYTES_PER_SECOND
+    return None
+
+
+def job_priority(user_id: str, settings) -> str:
+    """Priority of a user's jobs, from the HIGH/LOW_PRIORITY_USERS settings.
+
+    The priority picks the model tier the notes are routed to.
+    """
+    for priority, users in (("high", settings.high_priority_users), ("low", settings.low_priority_users)):
+        if user_id in {u.strip() for u in users.split(",") if u.strip()}:
+            return priority
+    return "normal"
+
+
+def handle_audio_messages(events, reply_func, job_queue, priority: str = "normal") -> int:
+    """Queue audio message events from one user as a single job.
+
+    The recordings are queued for the worker pool rather than processed in
+    the request, so they survive a restart, and as one batch, so the
+    worker downloads them together. Their estimated length decides whether
+    the batch can take the fast lane. The user gets one acknowledgement for
+    all of them; recordings turned away because the queue is full are
+    counted in it. reply_func must not block: it runs on the webhook's
+    request path.
+
+    Returns:
+        The number of recordings queued.
+    """
+    user_id = events[0].source.user_id
+    batch_id = None
+    queued = 0
+
+    for event in events:
+        try:
+            job = job_queue.enqueue(
+                user_id, event.message.id, priority, batch_id=batch_id,
+                duration_seconds=estimate_duration_seconds(event.message),
+            )
+        except QueueFullError as e:
+            logger.warning("[HANDLER] Queue full, turning away message_id=%s: %s", event.message.id, e)
+            continue
+        batch_id = job.id
+        queued += 1
+        logger.debug("[HANDLER] Job %d queued for message_id=%s from user_id=%s", job.id, event.message.id, user_id)
+
+    turned_away = len(events) - queued
+    if not queued:
+        reply_func(QUEUE_BUSY_MESSAGE)
+    elif len(events) == 1:
+        reply_func("🎙️ 已收到語音訊息，正在處理中，請稍候...")
+    else:
+        text = f"🎙️ 已收到 {queued} 則語音訊息，正在處理中，請稍候..."
+        if turned_away:
+            text += f"\n⏳ 目前處理中的語音訊息過多，另有 {turned_away} 則未能受理，請稍後再傳送一次。"
+        reply_func(text)
+    return queued
@@ -1,8 +1,11 @@
 """LINE message sending with automatic text splitting for long messages."""
 
 import logging
+import uuid
 
-from linebot.v3.messaging import MessagingApi, PushMessageRequest, TextMessage
+from linebot.v3.messaging import ApiException, PushMessageRequest, ReplyMessageRequest, TextMessage
+
+from app.rate_limit import LINE, rate_limited
 
 logger = logging.getLogger(__name__)
 
@@ -56,7 +59,7 @@ def split_text(text: str, max_length: int = LINE_MESSAGE_MAX_LENGTH) -> list[str
     return segments
 
 
-def send_text_to_user(user_id: str, text: str, messaging_api) -> None:
+async def send_text_to_user(user_id: str, text: str, messaging_api) -> None:
     """Send a text message to a LINE user, splitting long messages automatically.
 
     Messages are split if they exceed LINE's 5000-character limit.
@@ -66,7 +69,7 @@ def send_text_to_user(user_id: str, text: str, messaging_api) -> None:
     Args:
         user_id: The LINE user ID to send to.
         text: The text message content.
-        messaging_api: An instance of linebot.v3.messaging.MessagingApi.
+        messaging_api: An instance of linebot.v3.messaging.AsyncMessagingApi.
     """
     segments = split_text(text)
 
@@ -80,18 +83,57 @@ def send_text_to_user(user_id: str, text: str, messaging_api) -> None:
 
     # Send in batches of LINE_MAX_MESSAGES_PER_PUSH
     for batch_start in range(0, len(segments), LINE_MAX_MESSAGES_PER_PUSH):
-        batch = segments[batch_start:batch_start + LINE_MAX_MESSAGES_PER_PUSH]
-        messages = [TextMessage(text=segment) for segment in batch]
+        await push_messages(user_id, segments[batch_start:batch_start + LINE_MAX_MESSAGES_PER_PUSH], messaging_api)
+
+
+async def push_messages(user_id: str, texts: list[str], messaging_api) -> None:
+    """Push up to five texts to a LINE user in one push, as they are.
+
+    Every attempt carries the same X-Line-Retry-Key, so when the rate
+    limiter retries a push whose earlier attempt did reach LINE, LINE
+    answers 409 instead of delivering the messages twice. Errors are
+    logged rather than raised, like send_text_to_user.
+
+    Args:
+        user_id: The LINE user ID to send to.
+        texts: Message texts, each within LINE_MESSAGE_MAX_LENGTH.
+        messaging_api: An instance of linebot.v3.messaging.AsyncMessagingApi.
+    """
+    messages = [TextMessage(text=text) for text in texts]
+    request = PushMessageRequest(to=user_id, messages=messages)
+    retry_key = str(uuid.uuid4())
 
+    async def push() -> None:
         try:
-            messaging_api.push_message(
-                PushMessageRequest(to=user_id, messages=messages)
-            )
-            logger.info(
-                "[PUSH] Pushed %d message(s) to user %s (batch starting at %d)",
-                len(batch),
-                user_id,
-                batch_start,
-            )
-        except Exception as e:
-            logger.exception("[PUSH] Failed to push messages to user %s: %s", user_id, e)
+            await messaging_api.push_message(request, x_line_retry_key=retry_key)
+        except ApiException as e:
+            if e.status != 409:
+                raise
+            logger.info("[PUSH] Push %s was already accepted by an earlier attempt", retry_key)
+
+    try:
+        await rate_limited(LINE, push)
+        logger.info("[PUSH] Pushed %d message(s) to user %s", len(messages), user_id)
+    except Exception as e:
+        logger.exception("[PUSH] Failed to push messages to user %s: %s", user_id, e)
+
+
+async def reply_text(reply_token: str, text: str, messaging_api) -> None:
+    """Reply to a webhook event with a short text message.
+
+    Errors are logged rather than raised, since the reply is sent after the
+    webhook has already been acknowledged. A failed reply is not retried:
+    replies cannot carry a retry key, so a retry could answer twice, and
+    the reply token expires soon after the event anyway.
+
+    Args:
+        reply_token: The reply token of the event being answered.
+        text: The text message content; must fit in one LINE message.
+        messaging_api: An instance of linebot.v3.messaging.AsyncMessagingApi.
+    """
+    try:
+        request = ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=text)])
+        await rate_limited(LINE, lambda: messaging_api.reply_message(request), retryable=lambda: False)
+        logger.debug("[REPLY] Reply sent to token=%s...", reply_token[:20])
+    except Exception as e:
+        logger.exception("[REPLY] Failed to send reply: %s", e)
@@ -1,24 +1,29 @@
 """FastAPI entry point with LINE Webhook endpoint."""
 
+import asyncio
 import logging
+import time
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import HTMLResponse
 from linebot.v3 import WebhookParser
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import MessageEvent, AudioMessageContent  # noqa: F401
-from linebot.v3.messaging import (
-    MessagingApi,
-    ApiClient,
-    Configuration,
-    ReplyMessageRequest,
-    TextMessage,
-)
 
+from app.clients import close_clients, get_clients, init_clients
 from app.config import get_settings
-from app.line_handler import handle_audio_message
+from app.idempotency import IdempotencyStore
+from app.job_queue import JobQueue, WorkerPool
+from app.line_handler import handle_audio_messages, job_priority
+from app.line_messenger import reply_text
 from app.log_store import InMemoryHandler, get_logs, clear_logs, log_buffer
 from app.log_page import LOG_HTML
+from app.pipeline import run_job
+from app.rate_limit import close_rate_limiters, init_rate_limiters, rate_limit_stats
+from app.result_cache import close_result_cache, get_result_cache, init_result_cache
+from app.summarizer import routing_stats
+from app.workspace import sweep_workspaces
 
 settings = get_settings()
 
@@ -35,13 +40,70 @@ logging.getLogger().addHandler(memory_handler)
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="LINE Voice Memo → Meeting Notes")
+AUDIO_EXTENSIONS = (".m4a", ".mp3", ".wav", ".ogg", ".flac", ".aac", ".mp4")
+
+# Replies still in flight; held so they are not garbage-collected mid-send
+# and can be awaited on shutdown.
+_reply_tasks: set[asyncio.Task] = set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_rate_limiters(settings)
+    init_clients(settings)
+    init_result_cache(settings)
+    job_queue = JobQueue(
+        settings.job_db_path,
+        max_pending=settings.job_max_pending,
+        max_attempts=settings.job_max_attempts,
+        node_id=settings.job_node_id or None,
+        lease_seconds=settings.job_lease_seconds,
+        batch_window_seconds=settings.batch_window_seconds,
+        batch_max_size=settings.batch_max_size,
+        retention_seconds=settings.job_retention_hours * 3600,
+    )
+    workers = WorkerPool(
+        job_queue,
+        run_job,
+        settings.job_workers,
+        poll_seconds=settings.job_poll_seconds,
+        heartbeat_seconds=settings.job_heartbeat_seconds,
+        retry_delay_seconds=settings.job_retry_delay_seconds,
+        fast_lane_workers=settings.job_fast_lane_workers,
+        fast_lane_max_seconds=settings.job_fast_lane_max_seconds,
+    )
+    sweep_workspaces(settings.workspace_dir, settings.workspace_max_age_hours * 3600)
+    idempotency = IdempotencyStore(settings.idempotency_db_path, settings.idempotency_ttl_hours * 3600)
+    app.state.idempotency = idempotency
+    workers.start()
+    app.state.job_queue = job_queue
+    try:
+        yield
+    finally:
+        await workers.stop()
+        if _reply_tasks:
+            await asyncio.gather(*_reply_tasks, return_exceptions=True)
+        job_queue.close()
+        idempotency.close()
+        close_result_cache()
+        await close_clients()
+        close_rate_limiters()
+
+
+app = FastAPI(title="LINE Voice Memo → Meeting Notes", lifespan=lifespan)
 
 parser = WebhookParser(settings.line_channel_secret)
 
-configuration = Configuration(access_token=settings.line_channel_access_token)
-api_client = ApiClient(configuration)
-messaging_api = MessagingApi(api_client)
+
+def send_reply(reply_token: str, text: str) -> None:
+    """Send a reply in the background so the webhook never waits on LINE."""
+    clients = get_clients()
+    if clients is None:
+        logger.warning("[REPLY] LINE client not initialised, dropping reply")
+        return
+    task = asyncio.create_task(reply_text(reply_token, text, clients.messaging_api))
+    _reply_tasks.add(task)
+    task.add_done_callback(_reply_tasks.discard)
 
 
 @app.get("/health")
@@ -49,19 +111,29 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/stats")
+async def stats():
+    job_queue = getattr(app.state, "job_queue", None)
+    idempotency = getattr(app.state, "idempotency", None)
+    result_cache = get_result_cache()
+    return {
+        "routing": routing_stats(),
+        "jobs": job_queue.counts() if job_queue is not None else {},
+        "result_cache": result_cache.stats() if result_cache is not None else {},
+        "webhook_dedup": idempotency.stats() if idempotency is not None else {},
+        "rate_limits": rate_limit_stats(),
+    }
+
+
 @app.post("/callback")
-async def callback(request: Request, background_tasks: BackgroundTasks):
+async def callback(request: Request):
+    started = time.perf_counter()
     signature = request.headers.get("X-Line-Signature", "")
     body = (await request.body()).decode("utf-8")
-
-    logger.info("[WEBHOOK] Received callback request")
-    logger.info("[WEBHOOK] Signature: %s", signature[:20] + "..." if signature else "(empty)")
-    logger.info("[WEBHOOK] Body length: %d chars", len(body))
-    logger.debug("[WEBHOOK] Body: %s", body[:500])
+    logger.debug("[WEBHOOK] Body (%d chars): %s", len(body), body[:500])
 
     try:
         events = parser.parse(body, signature)
-        logger.info("[WEBHOOK] Parsed %d event(s)", len(events))
     except InvalidSignatureError:
         logger.error("[WEBHOOK] Invalid signature!")
         raise HTTPException(status_code=400, detail="Invalid signature")
@@ -69,53 +141,55 @@ async def callback(request: Request, background_tasks: BackgroundTasks):
         logger.exception("[WEBHOOK] Failed to parse webhook body: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
+    duplicates = 0
+    audio_events: dict[str, list] = {}
     for i, event in enumerate(events):
-        event_type = getattr(event, "type", None)
-        logger.info("[WEBHOOK] Event[%d] type=%s, class=%s", i, event_type, type(event).__name__)
-
-        if event_type != "message":
-            logger.info("[WEBHOOK] Event[%d] skipped (not a message event)", i)
+        if getattr(event, "type", None) != "message":
+            logger.debug("[WEBHOOK] Event[%d] skipped (type=%s)", i, getattr(event, "type", None))
             continue
 
+        # Accept: audio messages OR file messages with audio extensions
         message_type = getattr(event.message, "type", None)
         file_name = getattr(event.message, "file_name", None)
-        logger.info("[WEBHOOK] Event[%d] message.type=%s, message.class=%s, file_name=%s",
-                    i, message_type, type(event.message).__name__, file_name)
-
-        # Accept: audio messages OR file messages with audio extensions
-        AUDIO_EXTENSIONS = (".m4a", ".mp3", ".wav", ".ogg", ".flac", ".aac", ".mp4")
         is_audio = message_type == "audio"
         is_audio_file = (
             message_type == "file"
             and file_name
             and file_name.lower().endswith(AUDIO_EXTENSIONS)
         )
-
         if not is_audio and not is_audio_file:
-            if message_type == "file" and file_name:
-                logger.info("[WEBHOOK] Event[%d] skipped (file '%s' is not an audio format)", i, file_name)
-            else:
-                logger.info("[WEBHOOK] Event[%d] skipped (message type is '%s', not audio)", i, message_type)
+            logger.debug("[WEBHOOK] Event[%d] skipped (message type=%s, file_name=%s)", i, message_type, file_name)
+            continue
+
+        # A redelivered webhook or a second event for the same message is
+        # acknowledged without queueing the recording again.
+        keys = [f"message:{event.message.id}"]
+        if getattr(event, "webhook_event_id", None):
+            keys.append(f"event:{event.webhook_event_id}")
+        if not request.app.state.idempotency.first_seen(*keys):
+            is_redelivery = getattr(getattr(event, "delivery_context", None), "is_redelivery", None)
+            logger.info("[WEBHOOK] Event[%d] skipped (duplicate of message_id=%s, redelivery=%s)",
+                        i, event.message.id, is_redelivery)
+            duplicates += 1
             continue
 
-        logger.info("[WEBHOOK] Event[%d] Audio detected! type=%s, file_name=%s, message_id=%s, user_id=%s",
-                    i, message_type, file_name, event.message.id, event.source.user_id)
+        audio_events.setdefault(event.source.user_id, []).append(event)
 
-        def reply_func(text: str, _event=event):
-            try:
-                logger.info("[REPLY] Sending reply to token=%s...", _event.reply_token[:20])
-                messaging_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=_event.reply_token,
-                        messages=[TextMessage(text=text)],
-                    )
-                )
-                logger.info("[REPLY] Reply sent successfully")
-            except Exception as e:
-                logger.exception("[REPLY] Failed to send reply: %s", e)
+    # Recordings a user sent in one payload become one job with one
+    # acknowledgement, which uses the first event's reply token.
+    queued = 0
+    for user_id, user_events in audio_events.items():
+        def reply_func(text: str, _event=user_events[0]):
+            send_reply(_event.reply_token, text)
 
-        handle_audio_message(event, reply_func, background_tasks)
+        queued += handle_audio_messages(
+            user_events, reply_func, request.app.state.job_queue, priority=job_priority(user_id, settings)
+        )
 
+    logger.info(
+        "[WEBHOOK] Handled %d event(s): %d queued, %d duplicate(s) in %.2f ms",
+        len(events), queued, duplicates, (time.perf_counter() - started) * 1000,
+    )
     return "OK"
 
 
@@ -1,111 +1,700 @@
 """Processing pipeline: download → validate → split → transcribe → Claude → send result."""
 
+import asyncio
+import functools
+import hashlib
 import logging
-import tempfile
-import os
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
 
-from linebot.v3.messaging import MessagingApi, MessagingApiBlob, ApiClient, Configuration
+from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, Configuration
 
+from app.clients import get_clients
 from app.config import get_settings
-from app.audio_processor import download_audio, validate_audio, split_audio_if_needed
-from app.transcriber import transcribe_audio
-from app.summarizer import generate_meeting_notes, generate_meeting_notes_from_chunks
-from app.line_messenger import send_text_to_user
+from app.job_queue import DOWNLOADING, FAILED, SENT, SUMMARIZING, TRANSCRIBING, Job
+from app.result_cache import get_result_cache
+from app.audio_processor import (
+    AudioChunk,
+    AudioValidationError,
+    iter_audio_chunks,
+    stream_audio_to_file,
+    transcode_for_upload,
+)
+from app.stages import Stage, run_stages
+from app.transcriber import transcribe_with_retry
+from app.vad import OffsetMap, trim_silence
+from app.summarizer import (
+    EMPTY_NOTES_MESSAGE,
+    PROMPT_VERSION,
+    ModelRoute,
+    estimate_tokens,
+    generate_meeting_notes_from_chunks,
+    generate_preview,
+    record_routing,
+    route_model,
+)
+from app.line_messenger import (
+    LINE_MAX_MESSAGES_PER_PUSH,
+    LINE_MESSAGE_MAX_LENGTH,
+    push_messages,
+    send_text_to_user,
+    split_text,
+)
+from app.workspace import JobWorkspace
 
 logger = logging.getLogger(__name__)
 
 
-def process_audio_pipeline(user_id: str, message_id: str) -> None:
+async def process_audio_pipeline(
+    user_id: str,
+    message_id: str,
+    priority: str = "normal",
+    on_state: Callable[[str], None] | None = None,
+    final_attempt: bool = True,
+) -> bool:
     """Full audio processing pipeline.
 
-    Downloads audio from LINE, validates it, optionally splits large files,
-    transcribes via Whisper, sends transcript to Claude for meeting notes
-    generation, and pushes the result back to the user via LINE.
+    Streams audio from LINE into a scratch file (validating its size while
+    downloading), optionally splits large files, transcribes via Whisper,
+    sends transcript to Claude for meeting notes generation, and pushes the
+    result back to the user via LINE. Splitting and transcription run as
+    overlapping stages connected by bounded queues.
+
+    Every network call is made with an async client, and ffmpeg and numpy
+    work runs on the audio executor, so a job waiting on an upstream holds
+    no thread and one process can keep many jobs in flight.
 
     Args:
         user_id: The LINE user ID to send results to.
         message_id: The LINE message ID of the audio to process.
+        priority: Job priority used to route the notes to a model tier.
+        on_state: Called with the job state as the pipeline moves from
+            downloading to transcribing to summarizing.
+        final_attempt: Whether the job will not be retried if this run
+            fails.
+
+    Each step checkpoints its output in a workspace keyed by message_id,
+    and a rerun of the same message skips whatever is already there. The
+    workspace is removed once the job is over.
+
+    Returns:
+        True if the meeting notes reached the user, False if the job failed
+        and the user was sent an error message instead.
+
+    Raises:
+        Exception: An unexpected error on a run that is not the final
+            attempt, while nothing has been pushed to the user yet. The
+            user is not told; the job is expected to be retried.
     """
+    return await _run_with_clients(user_id, [message_id], priority, on_state or _ignore_state, final_attempt)
+
+
+async def process_batch(
+    user_id: str,
+    message_ids: list[str],
+    priority: str = "normal",
+    on_state: Callable[..., None] | None = None,
+    final_attempt: bool = True,
+) -> bool:
+    """Pipeline for several recordings a user sent together.
+
+    The recordings are downloaded and transcribed concurrently. With
+    batch_summarize_together they are summarized as one meeting and the
+    user gets one set of notes. Otherwise each recording gets its own
+    notes as soon as it is done, and is reported finished through
+    on_state(state, message_id=...) so that a retry of the batch only
+    redoes the recordings that did not finish.
+
+    Returns:
+        True if every recording's notes reached the user.
+
+    Raises:
+        Exception: As process_audio_pipeline, for any recording.
+    """
+    on_state = on_state or _ignore_state
+    if get_settings().batch_summarize_together:
+        return await _run_with_clients(user_id, list(message_ids), priority, on_state, final_attempt)
+
+    async def run_one(message_id: str) -> bool:
+        sent = await process_audio_pipeline(
+            user_id,
+            message_id,
+            priority,
+            on_state=functools.partial(on_state, message_id=message_id),
+            final_attempt=final_attempt,
+        )
+        on_state(SENT if sent else FAILED, message_id=message_id)
+        return sent
+
+    results = await asyncio.gather(*(run_one(m) for m in message_ids), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return all(results)
+
+
+async def run_job(job: Job, on_state: Callable[..., None]) -> bool:
+    """Run the pipeline for a queued job; the job queue's worker handler."""
+    final_attempt = job.attempts >= get_settings().job_max_attempts
+    if len(job.message_ids) > 1:
+        return await process_batch(
+            job.user_id, list(job.message_ids), job.priority, on_state=on_state, final_attempt=final_attempt
+        )
+    return await process_audio_pipeline(
+        job.user_id,
+        job.message_id,
+        job.priority,
+        on_state=on_state,
+        final_attempt=final_attempt,
+    )
+
+
+async def _run_with_clients(user_id, message_ids, priority, on_state, final_attempt) -> bool:
     settings = get_settings()
 
-    configuration = Configuration(access_token=settings.line_channel_access_token)
-    api_client = ApiClient(configuration)
-    messaging_api = MessagingApi(api_client)
-    blob_api = MessagingApiBlob(api_client)
+    async with AsyncExitStack() as stack:
+        shared = get_clients()
+        if shared is not None:
+            messaging_api = shared.messaging_api
+        else:
+            configuration = Configuration(access_token=settings.line_channel_access_token)
+            api_client = await stack.enter_async_context(AsyncApiClient(configuration))
+            messaging_api = AsyncMessagingApi(api_client)
+        return await _run_pipeline(
+            user_id, message_ids, priority, settings, shared, messaging_api, on_state, final_attempt
+        )
+
+
+def _ignore_state(state: str, message_id: str | None = None) -> None:
+    pass
+
+
+async def _run_pipeline(
+    user_id: str, message_ids: list[str], priority: str, settings, shared, messaging_api, on_state, final_attempt
+) -> bool:
+    started_at = time.monotonic()
+    single = len(message_ids) == 1
+    message_id = ", ".join(message_ids)
+    preview = (
+        PreviewTask(user_id, messaging_api, settings, started_at) if settings.preview_enabled and single else None
+    )
+
+    async def first_notes_push() -> None:
+        # The full notes are on their way, so a late preview would be stale.
+        if preview is not None:
+            await preview.supersede()
+        logger.info("[PIPELINE] Step 5: First notes pushed after %.1fs", time.monotonic() - started_at)
+
+    sections = SectionPusher(user_id, messaging_api, on_first_push=first_notes_push)
+    workspaces = []
+    finished = False
 
     try:
         logger.info("[PIPELINE] ====== START message_id=%s user_id=%s ======", message_id, user_id)
+        workspaces = [JobWorkspace(settings.workspace_dir, m) for m in message_ids]
 
-        # Step 1: Download audio
-        logger.info("[PIPELINE] Step 1: Downloading audio...")
-        audio_data = download_audio(message_id, blob_api)
-        logger.info("[PIPELINE] Step 1: Downloaded %d bytes", len(audio_data))
-
-        # Step 2: Validate
-        logger.info("[PIPELINE] Step 2: Validating audio (max=%dMB)...", settings.max_audio_size_mb)
-        validate_audio(audio_data, settings.max_audio_size_mb)
-        logger.info("[PIPELINE] Step 2: Validation passed")
-
-        # Step 3: Save to temp file, split if needed
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            audio_path = os.path.join(tmp_dir, "audio.m4a")
-            with open(audio_path, "wb") as f:
-                f.write(audio_data)
-            logger.info("[PIPELINE] Step 3: Saved to temp file %s", audio_path)
-
-            logger.info("[PIPELINE] Step 3: Checking if audio needs splitting...")
-            chunk_paths = split_audio_if_needed(audio_path)
-            logger.info("[PIPELINE] Step 3: Got %d chunk(s)", len(chunk_paths))
-
-            # Step 4: Transcribe with Whisper
-            if len(chunk_paths) == 1:
-                logger.info("[PIPELINE] Step 4: Transcribing audio with Whisper...")
-                transcript = transcribe_audio(audio_path, settings.openai_api_key)
-                logger.info("[PIPELINE] Step 4: Transcription complete (%d chars)", len(transcript))
-
-                # Step 5: Generate meeting notes with Claude
-                logger.info("[PIPELINE] Step 5: Sending transcript to Claude API (model=%s)...", settings.claude_model)
-                result = generate_meeting_notes(
-                    transcript,
-                    settings.claude_model,
-                    settings.claude_max_tokens,
-                    settings.anthropic_api_key,
+        # Step 1-2: Stream audio into the workspaces, validating size on the fly
+        on_state(DOWNLOADING)
+        hashes = await asyncio.gather(*(_download_recording(w, settings, shared) for w in workspaces))
+
+        # A recording processed before (forwarded again, or re-uploaded as
+        # a file) is answered from the result cache: with its stored notes
+        # if they were written by the model this job routes to, otherwise
+        # by summarizing its stored transcript.
+        cache = get_result_cache()
+        recordings = [cache.get_transcripts(h) if cache and h else None for h in hashes]
+        if single and recordings[0] is not None:
+            route = _route(settings, sum(estimate_tokens(t) for t in recordings[0]), priority)
+            notes = cache.get_notes(hashes[0], route.model, PROMPT_VERSION)
+            if notes is not None:
+                logger.info(
+                    "[PIPELINE] Cache hit for message_id=%s (sha256=%s), sending stored notes",
+                    message_id, hashes[0][:12],
+                )
+                await send_text_to_user(user_id, notes, messaging_api)
+                finished = True
+                return True
+        for workspace, sha256, transcripts in zip(workspaces, hashes, recordings):
+            if transcripts is not None:
+                logger.info(
+                    "[PIPELINE] Step 3-4: Reusing cached transcript for message_id=%s (sha256=%s)",
+                    workspace.message_id, sha256[:12],
                 )
-            else:
-                logger.info("[PIPELINE] Step 4: Transcribing %d chunks with Whisper...", len(chunk_paths))
-                transcripts = []
-                for i, chunk_path in enumerate(chunk_paths):
-                    logger.info("[PIPELINE] Step 4: Transcribing chunk %d/%d...", i + 1, len(chunk_paths))
-                    t = transcribe_audio(chunk_path, settings.openai_api_key)
-                    transcripts.append(t)
-                logger.info("[PIPELINE] Step 4: All chunks transcribed")
-
-                # Step 5: Generate meeting notes with Claude
-                logger.info("[PIPELINE] Step 5: Sending %d transcripts to Claude API...", len(transcripts))
-                result = generate_meeting_notes_from_chunks(
-                    transcripts,
-                    settings.claude_model,
-                    settings.claude_max_tokens,
-                    settings.anthropic_api_key,
+
+        # Step 3-4: Split and transcribe as overlapping stages.
+        pending = [i for i, transcripts in enumerate(recordings) if transcripts is None]
+        if pending:
+            on_state(TRANSCRIBING)
+            results = await asyncio.gather(*(
+                _transcribe_recording(workspaces[i].audio_path, workspaces[i], settings, preview) for i in pending
+            ))
+            chunk_results = [c for chunks in results for c in chunks]
+            logger.info("[PIPELINE] Step 4: Transcribed %d chunk(s)", len(chunk_results))
+            if settings.vad_enabled:
+                logger.info(
+                    "[PIPELINE] Step 4: VAD saved %.1fs of audio for message_id=%s",
+                    sum(c.vad_saved_seconds for c in chunk_results), message_id,
                 )
+            for i, chunks in zip(pending, results):
+                recordings[i] = [c.transcript for c in chunks]
+        transcripts = recordings[0] if single else _label_recordings(recordings)
+        transcript_tokens = sum(estimate_tokens(t) for t in transcripts)
+        route = _route(settings, transcript_tokens, priority)
 
-            logger.info("[PIPELINE] Step 5: Claude returned %d chars", len(result))
-            logger.debug("[PIPELINE] Step 5: Result preview: %s", result[:200])
+        # Step 5: Generate meeting notes with Claude, packing the
+        # transcript into as few calls as the token budget allows. When
+        # streaming, each finished "## " section is pushed as soon as no
+        # other push is in flight, together with any that closed while
+        # one was. Window and merge notes are checkpointed in the
+        # workspace as they complete.
+        on_state(SUMMARIZING)
 
-        # Step 6: Send result to user
-        logger.info("[PIPELINE] Step 6: Sending result to user via LINE push...")
-        send_text_to_user(user_id, result, messaging_api)
-        logger.info("[PIPELINE] ====== DONE message_id=%s ======", message_id)
+        logger.info(
+            "[PIPELINE] Step 5: Sending %d transcript tokens to Claude API (tier=%s, model=%s, streaming=%s)...",
+            transcript_tokens, route.tier, route.model, settings.stream_notes_enabled,
+        )
+        notes_started_at = time.monotonic()
+        result = await generate_meeting_notes_from_chunks(
+            transcripts,
+            route.model,
+            route.max_tokens,
+            settings.anthropic_api_key,
+            max_concurrency=settings.summarize_max_concurrency,
+            merge_token_budget=settings.merge_token_budget,
+            transcript_token_budget=settings.transcript_token_budget,
+            on_section=sections if settings.stream_notes_enabled else None,
+            store=workspaces[0],
+        )
+        record_routing(route, priority, transcript_tokens, time.monotonic() - notes_started_at)
+        # Notes of a batch summarized together belong to no one recording.
+        if cache is not None and single and hashes[0] and result != EMPTY_NOTES_MESSAGE:
+            cache.put(hashes[0], transcripts, result, route.model, PROMPT_VERSION)
+        logger.info("[PIPELINE] Step 5: Claude returned %d chars", len(result))
+        logger.debug("[PIPELINE] Step 5: Result preview: %s", result[:200])
+        # Step 6: Send result to user (unless it was already streamed)
+        if preview is not None:
+            await preview.supersede()
+        await sections.flush()
+        if sections.received:
+            logger.info(
+                "[PIPELINE] Step 6: Result already pushed as %d section(s) in %d message(s)",
+                sections.received, sections.pushed,
+            )
+        else:
+            logger.info("[PIPELINE] Step 6: Sending result to user via LINE push...")
+            await send_text_to_user(user_id, result, messaging_api)
+        logger.info(
+            "[PIPELINE] ====== DONE message_id=%s in %.1fs (preview=%s) ======",
+            message_id, time.monotonic() - started_at,
+            f"{preview.elapsed:.1f}s" if preview and preview.elapsed is not None else "none",
+        )
+        finished = True
+        return True
 
-    except ValueError as e:
+    except AudioValidationError as e:
+        finished = True
         error_msg = f"音訊處理失敗：{e}"
         logger.warning("[PIPELINE] Validation error for message %s: %s", message_id, e)
-        send_text_to_user(user_id, error_msg, messaging_api)
+        await send_text_to_user(user_id, error_msg, messaging_api)
+        return False
 
     except Exception as e:
+        if not final_attempt and sections.rewind():
+            # Nothing has reached the user yet, so the job can be retried
+            # quietly; the next attempt resumes from the workspace and
+            # streams the notes again from the start.
+            logger.warning("[PIPELINE] Attempt failed for message %s, leaving it for a retry: %s", message_id, e)
+            raise
+
+        finished = True
         error_msg = "處理音訊時發生錯誤，請稍後再試。"
         logger.exception("[PIPELINE] Unexpected error for message %s: %s", message_id, e)
+        if sections.received:
+            # Part of the notes already streamed out; deliver what is
+            # buffered and say plainly that the notes stop short.
+            error_msg = "⚠️ 會議記錄產生到一半時發生錯誤，以上內容並不完整，請稍後再試。"
+            logger.warning(
+                "[PIPELINE] Notes for message %s interrupted after %d section(s)", message_id, sections.received
+            )
         try:
-            send_text_to_user(user_id, error_msg, messaging_api)
+            await sections.flush()
+            await send_text_to_user(user_id, error_msg, messaging_api)
         except Exception as send_err:
             logger.exception("[PIPELINE] Failed to send error message: %s", send_err)
+        return False
+
+    finally:
+        if preview is not None:
+            await preview.cancel()
+        sections.cancel()
+        # A job that will be retried or resumed keeps its checkpoints.
+        if finished:
+            for workspace in workspaces:
+                workspace.remove()
+
+
+async def _download_recording(workspace: JobWorkspace, settings, shared) -> str | None:
+    """Stream a recording into its workspace unless it is already there.
+
+    Returns:
+        The SHA-256 of the audio.
+    """
+    size = workspace.load_audio_size()
+    if size is not None:
+        logger.info(
+            "[PIPELINE] Step 1-2: Reusing downloaded audio for message_id=%s (%d bytes)", workspace.message_id, size
+        )
+        return workspace.load_audio_sha256()
+
+    logger.info(
+        "[PIPELINE] Step 1: Streaming audio to %s (max=%dMB)...", workspace.audio_path, settings.max_audio_size_mb
+    )
+    digest = hashlib.sha256()
+    size = await stream_audio_to_file(
+        workspace.message_id,
+        settings.line_channel_access_token,
+        workspace.audio_path,
+        settings.max_audio_size_mb,
+        http_client=shared.http if shared else None,
+        on_chunk=digest.update,
+    )
+    workspace.save_audio(size, digest.hexdigest())
+    logger.info("[PIPELINE] Step 2: Downloaded %d bytes for message_id=%s, validation passed", size, workspace.message_id)
+    return workspace.load_audio_sha256()
+
+
+def _label_recordings(recordings: list[list[str]]) -> list[str]:
+    """Chunk transcripts of several recordings, each headed with its number."""
+    transcripts = []
+    for number, chunks in enumerate(recordings, start=1):
+        if chunks:
+            transcripts.append(f"【第 {number} 段錄音】\n{chunks[0]}")
+            transcripts.extend(chunks[1:])
+    return transcripts
+
+
+async def _run_blocking(func, *args, **kwargs):
+    """Run blocking audio work on the shared audio executor (or the loop's default)."""
+    shared = get_clients()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        shared.audio_executor if shared else None, functools.partial(func, *args, **kwargs)
+    )
+
+
+def _route(settings, transcript_tokens: int, priority: str) -> ModelRoute:
+    """Choose the Claude model for a job, or the configured default if routing is off."""
+    if not settings.model_routing_enabled:
+        return ModelRoute("default", settings.claude_model, settings.claude_max_tokens)
+    return route_model(
+        transcript_tokens,
+        priority,
+        strong_model=settings.claude_model,
+        strong_max_tokens=settings.claude_max_tokens,
+        fast_model=settings.fast_model,
+        fast_max_tokens=settings.fast_max_tokens,
+        fast_route_max_tokens=settings.fast_route_max_tokens,
+    )
+
+
+@dataclass
+class ChunkResult:
+    """Per-chunk state carried through the pipeline stages.
+
+    start_seconds is where the chunk begins in the original recording;
+    offset_map translates positions in the uploaded audio to positions in
+    the original recording, across both the chunk's start time and any
+    silence removed by VAD.
+    """
+
+    source_path: str
+    index: int = 0
+    start_seconds: float = 0.0
+    offset_map: OffsetMap = field(default_factory=OffsetMap)
+    upload_path: str = ""
+    vad_saved_seconds: float = 0.0
+    transcript: str = ""
+
+
+async def _transcribe_chunk(chunk: ChunkResult, settings) -> ChunkResult:
+    """Trim, transcode and transcribe one chunk."""
+    upload_path = chunk.source_path
+    encoded_for_upload = False
+
+    if settings.vad_enabled:
+        # With upload transcoding on, the trimmed audio is written straight
+        # in the upload profile so it is only encoded once.
+        profile = {}
+        if settings.upload_transcode_enabled:
+            profile = dict(
+                codec=settings.upload_codec,
+                bitrate_kbps=settings.upload_bitrate_kbps,
+                sample_rate=settings.upload_sample_rate,
+            )
+        try:
+            trim = await _run_blocking(trim_silence, upload_path, settings.vad_min_silence_seconds, **profile)
+            encoded_for_upload = bool(profile) and trim.audio_path != upload_path
+            upload_path = trim.audio_path
+            chunk.vad_saved_seconds = trim.saved_seconds
+            chunk.offset_map = trim.offset_map.shifted(chunk.start_seconds)
+        except Exception as e:
+            logger.warning("[PIPELINE] VAD failed for %s, using untrimmed audio: %s", upload_path, e)
+
+    if settings.upload_transcode_enabled and not encoded_for_upload:
+        try:
+            upload_path = await _run_blocking(
+                transcode_for_upload,
+                upload_path,
+                codec=settings.upload_codec,
+                bitrate_kbps=settings.upload_bitrate_kbps,
+                sample_rate=settings.upload_sample_rate,
+            )
+        except Exception as e:
+            logger.warning("[PIPELINE] Transcode failed for %s, uploading original: %s", upload_path, e)
+
+    chunk.upload_path = upload_path
+    chunk.transcript = await transcribe_with_retry(
+        upload_path, settings.openai_api_key, max_retries=settings.transcribe_max_retries
+    )
+    return chunk
+
+
+async def _transcribe_recording(audio_path: str, workspace: JobWorkspace, settings, preview) -> list[ChunkResult]:
+    """Split the recording and transcribe its chunks as overlapping stages.
+
+    Each chunk is transcribed as soon as ffmpeg finishes writing it, and
+    chunks transcribed by an earlier attempt are not sent to Whisper again.
+    """
+    logger.info(
+        "[PIPELINE] Step 3-4: Streaming chunks through Whisper (concurrency=%d)...",
+        settings.transcribe_max_concurrency,
+    )
+
+    async def transcribe(chunk: ChunkResult) -> ChunkResult:
+        transcript = workspace.load_transcript(chunk.index, chunk.start_seconds)
+        if transcript is not None:
+            logger.info("[PIPELINE] Chunk %d already transcribed, skipping Whisper", chunk.index)
+            chunk.transcript = transcript
+        else:
+            chunk = await _transcribe_chunk(chunk, settings)
+            workspace.save_transcript(chunk.index, chunk.start_seconds, chunk.transcript)
+        if preview is not None and chunk.index == 0:
+            preview.set_first_transcript(chunk.transcript)
+        return chunk
+
+    def to_result(chunk: AudioChunk, index: int) -> ChunkResult:
+        # A single-chunk memo goes straight to the full notes; a preview
+        # would only race them.
+        if preview is not None and index == 1:
+            preview.set_multi_chunk()
+        return ChunkResult(
+            chunk.path,
+            index=index,
+            start_seconds=chunk.start_seconds,
+            offset_map=OffsetMap([(0.0, chunk.start_seconds, chunk.end_seconds - chunk.start_seconds)]),
+        )
+
+    async def chunk_source():
+        saved_chunks = workspace.load_chunks()
+        if saved_chunks is not None:
+            logger.info("[PIPELINE] Step 3: Reusing %d chunk(s) from the last attempt", len(saved_chunks))
+            for index, chunk in enumerate(saved_chunks):
+                yield to_result(chunk, index)
+            return
+
+        # The segmenter is a blocking generator around ffmpeg; each
+        # step of it runs on the audio executor.
+        chunks = iter(await _run_blocking(
+            iter_audio_chunks,
+            audio_path,
+            max_chunk_minutes=settings.chunk_max_minutes,
+            max_chunk_bytes=settings.chunk_max_mb * 1024 * 1024,
+            snap_tolerance_seconds=settings.chunk_snap_tolerance_seconds,
+            output_dir=workspace.path,
+        ))
+        produced = []
+        step = None
+        try:
+            while True:
+                # Shielded so that a cancellation leaves the step running
+                # rather than orphaning it on the executor thread.
+                step = asyncio.ensure_future(_run_blocking(next, chunks, None))
+                if (chunk := await asyncio.shield(step)) is None:
+                    break
+                yield to_result(chunk, len(produced))
+                produced.append(chunk)
+        finally:
+            # Closing a generator that another thread is still stepping
+            # raises "generator already executing", so let the step finish
+            # first.
+            if step is not None and not step.done():
+                await asyncio.wait({step})
+            if hasattr(chunks, "close"):
+                await _run_blocking(chunks.close)
+        workspace.save_chunks(produced)
+
+    return await run_stages(
+        chunk_source(),
+        [Stage("transcribe", transcribe, settings.transcribe_max_concurrency)],
+        queue_size=settings.stage_queue_size,
+    )
+
+
+class SectionPusher:
+    """Pushes streamed notes sections to the user as they close.
+
+    The first section goes out as soon as it arrives. Sections that close
+    while a push is in flight are coalesced into as few messages as fit
+    LINE_MESSAGE_MAX_LENGTH and go out together in the next push, up to
+    five messages per push, so a fast stream costs a handful of pushes
+    rather than one per section. on_first_push runs once, just before the
+    first push. flush() waits until every section has been pushed.
+
+    Calling the pusher adds a section, so it can be handed to the
+    summarizer as its section handler; rewind() lets a failed stream be
+    retried from scratch as long as nothing has been pushed yet.
+    """
+
+    def __init__(
+        self,
+        user_id: str,
+        messaging_api,
+        max_length: int = LINE_MESSAGE_MAX_LENGTH,
+        on_first_push: Callable[[], Awaitable[None]] | None = None,
+    ):
+        self.user_id = user_id
+        self.messaging_api = messaging_api
+        self.max_length = max_length
+        self.on_first_push = on_first_push
+        self.received = 0
+        self.pushed = 0
+        self._pending: list[str] = []
+        self._task: asyncio.Task | None = None
+
+    async def add(self, section: str) -> None:
+        self.received += 1
+        self._pending.append(section)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+            # Let the push start before the stream moves on.
+            await asyncio.sleep(0)
+
+    __call__ = add
+
+    async def flush(self) -> None:
+        if self._task is not None:
+            await self._task
+
+    def rewind(self) -> bool:
+        """Drop every section not yet pushed so the notes can start over.
+
+        Returns:
+            False, leaving everything as it is, if a push has already begun.
+        """
+        if self.pushed:
+            return False
+        self.cancel()
+        self._pending = []
+        self.received = 0
+        return True
+
+    def cancel(self) -> None:
+        """Stop pushing once the job is over without a flush."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _drain(self) -> None:
+        while self._pending:
+            messages = self._coalesce()
+            batch, rest = messages[:LINE_MAX_MESSAGES_PER_PUSH], messages[LINE_MAX_MESSAGES_PER_PUSH:]
+            self._pending[:0] = rest
+            if not self.pushed and self.on_first_push is not None:
+                await self.on_first_push()
+            logger.info(
+                "[PIPELINE] Pushing notes messages %d-%d (%d chars)",
+                self.pushed + 1, self.pushed + len(batch), sum(len(m) for m in batch),
+            )
+            self.pushed += len(batch)
+            await push_messages(self.user_id, batch, self.messaging_api)
+
+    def _coalesce(self) -> list[str]:
+        """Take every pending section, packed into messages of at most max_length."""
+        messages: list[str] = []
+        for section in self._pending:
+            for part in split_text(section, self.max_length):
+                if messages and len(messages[-1]) + 2 + len(part) <= self.max_length:
+                    messages[-1] = f"{messages[-1]}\n\n{part}"
+                else:
+                    messages.append(part)
+        self._pending = []
+        return messages
+
+
+class PreviewTask:
+    """Generates a TL;DR with the preview model and pushes it in the background.
+
+    The preview is only worth it for recordings split into several chunks,
+    so it starts once the first chunk is transcribed and a second chunk
+    exists. It is pushed at most once, and only if the full notes have not
+    started arriving yet; otherwise it would be stale on arrival.
+    """
+
+    def __init__(self, user_id: str, messaging_api, settings, started_at: float):
+        self.user_id = user_id
+        self.messaging_api = messaging_api
+        self.settings = settings
+        self.started_at = started_at
+        self.elapsed: float | None = None
+        self._lock = asyncio.Lock()
+        self._transcript: str | None = None
+        self._multi_chunk = False
+        self._superseded = False
+        self._task: asyncio.Task | None = None
+
+    def set_first_transcript(self, transcript: str) -> None:
+        self._transcript = transcript
+        self._maybe_start()
+
+    def set_multi_chunk(self) -> None:
+        self._multi_chunk = True
+        self._maybe_start()
+
+    def _maybe_start(self) -> None:
+        if self._task or self._superseded or self._transcript is None or not self._multi_chunk:
+            return
+        self._task = asyncio.create_task(self._run(self._transcript), name="preview")
+
+    async def supersede(self) -> None:
+        async with self._lock:
+            self._superseded = True
+
+    async def cancel(self) -> None:
+        """Stop a preview that is still being generated once the job is over."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self, transcript: str) -> None:
+        try:
+            gist = await generate_preview(
+                transcript,
+                self.settings.preview_model,
+                self.settings.preview_max_tokens,
+                self.settings.anthropic_api_key,
+            )
+        except Exception as e:
+            logger.warning("[PIPELINE] Preview generation failed: %s", e)
+            return
+
+        # Holding the lock while pushing makes supersede() wait, so the
+        # preview can never land after the first section of the full notes.
+        async with self._lock:
+            if self._superseded or not gist:
+                logger.info("[PIPELINE] Preview dropped; full notes already on their way")
+                return
+            await send_text_to_user(self.user_id, f"⚡ 重點預覽（完整會議記錄產生中）\n{gist}", self.messaging_api)
+            self.elapsed = time.monotonic() - self.started_at
+        logger.info("[PIPELINE] Preview pushed after %.1fs (model=%s)", self.elapsed, self.settings.preview_model)
@@ -0,0 +1,323 @@
+"""Shared client-side rate limiting for the OpenAI, Anthropic and LINE APIs."""
+
+import asyncio
+import email.utils
+import logging
+import random
+import re
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, TypeVar
+
+import aiohttp
+import anthropic
+import httpx
+import openai
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+OPENAI = "openai"
+ANTHROPIC = "anthropic"
+LINE = "line"
+
+# 408/409 and 5xx are what the SDKs' own retries covered before they were
+# turned off in favour of this layer; 429 and Anthropic's 529 are rate
+# limits proper.
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+_CONNECTION_ERRORS = (
+    openai.APIConnectionError,
+    anthropic.APIConnectionError,
+    httpx.TransportError,
+    aiohttp.ClientConnectionError,
+)
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class TokenBucket:
+    """Allowance that refills continuously up to one minute's quota.
+
+    Args:
+        per_minute: Units (requests or tokens) allowed per minute.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount is available; a request larger than the
+        bucket waits for a full bucket rather than forever."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def limit_to(self, remaining: float) -> None:
+        """Lower the allowance to what the upstream reports is left."""
+        self.level = min(self.level, remaining)
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RateLimiter:
+    """Request and token budgets for one upstream, shared by every job.
+
+    Calls wait their turn (first come, first served) until both buckets
+    have room, instead of being sent and rejected. The upstream's own view
+    is folded in as responses arrive: x-ratelimit-* and
+    anthropic-ratelimit-* headers lower the buckets to what is really
+    left, and a Retry-After or an exhausted quota pauses every caller
+    until the reset. A call that still fails with a rate limit, overload
+    or other transient error is retried after Retry-After, or else after
+    a jittered exponential backoff.
+
+    Args:
+        name: Upstream name, for logs and stats.
+        requests_per_minute: Request quota; 0 for no request bucket.
+        tokens_per_minute: Token quota; 0 for no token bucket.
+        max_retries: Retries of a call after its first attempt.
+        base_delay_seconds: Backoff before the first retry.
+        max_delay_seconds: Upper bound on any one backoff or pause.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_retries: int = 4,
+        base_delay_seconds: float = 1.0,
+        max_delay_seconds: float = 60.0,
+    ):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_retries = max_retries
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._stats = {"calls": 0, "throttled": 0, "throttled_seconds": 0.0, "retries": 0}
+
+    async def call(
+        self,
+        func: Callable[[], Awaitable[T]],
+        tokens: int = 0,
+        retryable: Callable[[], bool] | None = None,
+    ) -> T:
+        """Await func() once the budget allows, retrying transient failures.
+
+        Args:
+            func: Makes the upstream call; invoked afresh for each attempt.
+            tokens: Estimated tokens the call consumes.
+            retryable: Checked before a retry; return False once the call
+                has had effects that must not be repeated.
+        """
+        self._stats["calls"] += 1
+        attempt = 0
+        while True:
+            await self.acquire(tokens)
+            try:
+                return await func()
+            except Exception as e:
+                status, headers = _error_details(e)
+                transient = status in RETRY_STATUSES or isinstance(e, _CONNECTION_ERRORS)
+                if not transient or attempt == self.max_retries or (retryable and not retryable()):
+                    raise
+                retry_after = parse_retry_after(headers)
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                delay = min(delay, self.max_delay_seconds)
+                if status in (429, 529):
+                    # Everyone else is over the limit too; hold them back.
+                    self.pause(delay)
+                self._stats["retries"] += 1
+                logger.warning(
+                    "[RATELIMIT] %s call failed (status=%s, attempt %d/%d), retrying in %.1fs: %s",
+                    self.name, status, attempt + 1, self.max_retries + 1, delay, e,
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """Wait until a request, and tokens, may be sent, then spend them."""
+        started = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                if wait <= 0:
+                    wait = max(
+                        self.requests.wait_time(1, now) if self.requests else 0.0,
+                        self.tokens.wait_time(tokens, now) if self.tokens and tokens else 0.0,
+                    )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests:
+                self.requests.take(1, now)
+            if self.tokens and tokens:
+                self.tokens.take(tokens, now)
+        waited = time.monotonic() - started
+        if waited >= 0.01:
+            self._stats["throttled"] += 1
+            self._stats["throttled_seconds"] += waited
+            logger.debug("[RATELIMIT] %s call waited %.2fs for its budget", self.name, waited)
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff for the given retry, with jitter so that
+        callers that failed together do not retry together."""
+        delay = min(self.max_delay_seconds, self.base_delay_seconds * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every caller back for seconds."""
+        seconds = min(seconds, self.max_delay_seconds)
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def observe(self, headers) -> None:
+        """Fold the upstream's rate-limit headers into the local budget."""
+        headers = _lower_keys(headers)
+        retry_after = parse_retry_after(headers)
+        if retry_after is not None:
+            self.pause(retry_after)
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            remaining = _header_float(
+                headers, f"x-ratelimit-remaining-{kind}", f"anthropic-ratelimit-{kind}-remaining"
+            )
+            if remaining is None:
+                continue
+            if bucket is not None:
+                bucket.limit_to(remaining)
+            if remaining < 1:
+                reset = _parse_reset(
+                    headers.get(f"x-ratelimit-reset-{kind}") or headers.get(f"anthropic-ratelimit-{kind}-reset")
+                )
+                if reset is not None:
+                    logger.info("[RATELIMIT] %s %s quota exhausted, pausing %.1fs", self.name, kind, reset)
+                    self.pause(reset)
+
+    def stats(self) -> dict:
+        return {**self._stats, "throttled_seconds": round(self._stats["throttled_seconds"], 1)}
+
+
+def parse_retry_after(headers) -> float | None:
+    """Seconds to wait from retry-after-ms or Retry-After (seconds or HTTP date)."""
+    headers = _lower_keys(headers)
+    retry_after_ms = _header_float(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_reset(value: str | None) -> float | None:
+    """Seconds until a quota resets, from "1m30s"-style or RFC 3339 values."""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if parts and "".join(n + unit for n, unit in parts) == value:
+        return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+    try:
+        return max(0.0, datetime.fromisoformat(value).timestamp() - time.time())
+    except ValueError:
+        return None
+
+
+def _header_float(headers: dict, *names: str) -> float | None:
+    for name in names:
+        try:
+            return float(headers[name])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def _lower_keys(headers) -> dict:
+    if not headers:
+        return {}
+    return {str(k).lower(): v for k, v in headers.items()}
+
+
+def _error_details(error: Exception) -> tuple[int | None, dict]:
+    """HTTP status and headers of an SDK error, whichever SDK raised it."""
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    return (status if isinstance(status, int) else None), _lower_keys(headers)
+
+
+_limiters: dict[str, RateLimiter] = {}
+
+
+def init_rate_limiters(settings) -> dict[str, RateLimiter]:
+    """Create one limiter per upstream; called once at application startup."""
+    if _limiters or not settings.rate_limit_enabled:
+        return _limiters
+    common = dict(
+        max_retries=settings.rate_limit_max_retries,
+        max_delay_seconds=settings.rate_limit_max_delay_seconds,
+    )
+    _limiters[OPENAI] = RateLimiter(OPENAI, settings.openai_rpm, **common)
+    _limiters[ANTHROPIC] = RateLimiter(ANTHROPIC, settings.anthropic_rpm, settings.anthropic_tpm, **common)
+    _limiters[LINE] = RateLimiter(LINE, settings.line_rpm, **common)
+    logger.info(
+        "[RATELIMIT] Limits ready: openai=%d rpm, anthropic=%d rpm/%d tpm, line=%d rpm",
+        settings.openai_rpm, settings.anthropic_rpm, settings.anthropic_tpm, settings.line_rpm,
+    )
+    return _limiters
+
+
+def get_rate_limiter(upstream: str) -> RateLimiter | None:
+    """Return the limiter for upstream, or None if rate limiting is off."""
+    return _limiters.get(upstream)
+
+
+def close_rate_limiters() -> None:
+    _limiters.clear()
+
+
+def rate_limit_stats() -> dict[str, dict]:
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
+
+
+async def rate_limited(
+    upstream: str,
+    func: Callable[[], Awaitable[T]],
+    tokens: int = 0,
+    retryable: Callable[[], bool] | None = None,
+) -> T:
+    """Run func through upstream's limiter, or directly if there is none."""
+    limiter = get_rate_limiter(upstream)
+    if limiter is None:
+        return await func()
+    return await limiter.call(func, tokens=tokens, retryable=retryable)
+
+
+def response_hook(upstream: str) -> Callable[[httpx.Response], Awaitable[None]]:
+    """httpx response hook feeding every response's headers to upstream's limiter."""
+
+    async def observe(response: httpx.Response) -> None:
+        limiter = get_rate_limiter(upstream)
+        if limiter is not None:
+            limiter.observe(response.headers)
+
+    return observe
@@ -0,0 +1,163 @@
+"""Disk-backed cache of transcripts and notes, keyed by the audio's content."""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    audio_sha256 TEXT PRIMARY KEY,
+    transcripts TEXT NOT NULL,
+    notes TEXT,
+    model TEXT,
+    prompt_version TEXT,
+    size INTEGER NOT NULL,
+    last_used_at REAL NOT NULL
+)
+"""
+
+
+class ResultCache:
+    """Transcripts and final notes of recordings that were already processed.
+
+    Entries are keyed by the SHA-256 of the audio bytes, so the same
+    recording forwarded again or re-uploaded as a file is recognised
+    whatever its message ID. The transcript is reusable on its own; the
+    notes are only returned for the model and prompt version that wrote
+    them. Once the stored text passes max_bytes the least recently used
+    entries are evicted.
+
+    Lookups are counted: a notes hit skips the whole pipeline, a
+    transcript hit skips Whisper only, and a miss runs everything.
+
+    Args:
+        db_path: SQLite file to store results in (":memory:" for tests).
+        max_bytes: Upper bound on the UTF-8 size of stored text.
+    """
+
+    def __init__(self, db_path: str, max_bytes: int):
+        if db_path != ":memory:" and os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._counts = {"hits": 0, "transcript_hits": 0, "misses": 0}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def get_transcripts(self, audio_sha256: str) -> list[str] | None:
+        """Chunk transcripts of a recording seen before, or None (a miss)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT transcripts FROM results WHERE audio_sha256 = ?", (audio_sha256,)
+            ).fetchone()
+            if row is None:
+                self._counts["misses"] += 1
+                return None
+            self._counts["transcript_hits"] += 1
+            self._touch(audio_sha256)
+        return json.loads(row[0])
+
+    def get_notes(self, audio_sha256: str, model: str, prompt_version: str) -> str | None:
+        """Notes written by model with prompt_version, if stored.
+
+        Only called after get_transcripts found the recording, whose
+        lookup it turns from a transcript hit into a notes hit if the notes
+        are there.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT notes FROM results WHERE audio_sha256 = ? AND model = ? AND prompt_version = ?",
+                (audio_sha256, model, prompt_version),
+            ).fetchone()
+            notes = row[0] if row else None
+            if notes:
+                self._counts["transcript_hits"] -= 1
+                self._counts["hits"] += 1
+        return notes
+
+    def put(self, audio_sha256: str, transcripts: list[str], notes: str, model: str, prompt_version: str) -> None:
+        """Store a recording's results, evicting old entries to stay under max_bytes."""
+        encoded = json.dumps(transcripts, ensure_ascii=False)
+        size = len(encoded.encode("utf-8")) + len(notes.encode("utf-8"))
+        if size > self.max_bytes:
+            logger.info("[CACHE] Not caching %s: %d bytes exceeds the cache size", audio_sha256[:12], size)
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results "
+                "(audio_sha256, transcripts, notes, model, prompt_version, size, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (audio_sha256, encoded, notes, model, prompt_version, size, time.time()),
+            )
+            evicted = self._evict()
+            self._conn.commit()
+        if evicted:
+            logger.info("[CACHE] Evicted %d least recently used result(s)", evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, stored = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+            counts = dict(self._counts)
+        lookups = sum(counts.values())
+        return {
+            **counts,
+            "hit_rate": round(counts["hits"] / lookups, 3) if lookups else 0.0,
+            "entries": entries,
+            "bytes": stored,
+        }
+
+    def _touch(self, audio_sha256: str) -> None:
+        self._conn.execute(
+            "UPDATE results SET last_used_at = ? WHERE audio_sha256 = ?", (time.time(), audio_sha256)
+        )
+        self._conn.commit()
+
+    def _evict(self) -> int:
+        (total,) = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        evicted = 0
+        for audio_sha256, size in self._conn.execute(
+            "SELECT audio_sha256, size FROM results ORDER BY last_used_at"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM results WHERE audio_sha256 = ?", (audio_sha256,))
+            total -= size
+            evicted += 1
+        return evicted
+
+
+_cache: ResultCache | None = None
+
+
+def init_result_cache(settings) -> ResultCache | None:
+    """Open the shared result cache; called once at application startup."""
+    global _cache
+    if _cache is None and settings.result_cache_enabled:
+        _cache = ResultCache(settings.result_cache_path, settings.result_cache_max_mb * 1024 * 1024)
+        logger.info("[CACHE] Result cache ready at %s", settings.result_cache_path)
+    return _cache
+
+
+def get_result_cache() -> ResultCache | None:
+    """Return the shared result cache, or None if it is off or not opened."""
+    return _cache
+
+
+def close_result_cache() -> None:
+    global _cache
+    if _cache is None:
+        return
+    cache, _cache = _cache, None
+    cache.close()
@@ -0,0 +1,107 @@
+"""Streaming processing stages connected by bounded queues."""
+
+import asyncio
+import logging
+from typing import Any, AsyncIterable, Awaitable, Callable, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage(NamedTuple):
+    """One step of a streaming pipeline.
+
+    func is awaited once per item with the output of the previous stage;
+    up to workers calls run concurrently.
+    """
+
+    name: str
+    func: Callable[[Any], Awaitable[Any]]
+    workers: int = 1
+
+
+async def run_stages(source: AsyncIterable, stages: list[Stage], queue_size: int = 2) -> list:
+    """Push every item of source through stages, overlapping their work.
+
+    The source is consumed by the calling task. Each stage runs as its own
+    worker tasks and hands results to the next stage through a queue of at
+    most queue_size items, so a fast producer waits instead of buffering
+    the whole input. An item moves on as soon as its stage finishes it,
+    regardless of the order in which items complete.
+
+    If the source or any stage raises, the remaining work is skipped and
+    the first exception is re-raised once all workers have stopped. If the
+    calling task is cancelled, the workers are cancelled with it.
+
+    Args:
+        source: Items to process, in order.
+        stages: Stages to run, in order.
+        queue_size: Capacity of each queue between stages.
+
+    Returns:
+        The output of the last stage for each source item, in source order.
+    """
+    queues = [asyncio.Queue(maxsize=max(1, queue_size)) for _ in stages]
+    results: dict[int, Any] = {}
+    errors: list[BaseException] = []
+
+    async def worker(stage_index: int, stage: Stage, remaining: list[int]) -> None:
+        inbox = queues[stage_index]
+        outbox = queues[stage_index + 1] if stage_index + 1 < len(stages) else None
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                # Let sibling workers see the marker too; the last one to
+                # stop forwards it downstream.
+                await inbox.put(_DONE)
+                remaining[0] -= 1
+                if remaining[0] == 0 and outbox is not None:
+                    await outbox.put(_DONE)
+                return
+
+            index, value = item
+            if errors:
+                continue
+            try:
+                output = await stage.func(value)
+            except Exception as e:
+                logger.exception("[STAGES] Stage '%s' failed on item %d: %s", stage.name, index, e)
+                errors.append(e)
+                continue
+
+            if outbox is None:
+                results[index] = output
+            else:
+                await outbox.put((index, output))
+
+    tasks = []
+    for stage_index, stage in enumerate(stages):
+        remaining = [max(1, stage.workers)]
+        for n in range(remaining[0]):
+            tasks.append(asyncio.create_task(
+                worker(stage_index, stage, remaining), name=f"stage-{stage.name}-{n}"
+            ))
+
+    count = 0
+    try:
+        async for value in source:
+            if errors:
+                break
+            await queues[0].put((count, value))
+            count += 1
+    except Exception as e:
+        logger.exception("[STAGES] Source failed after %d item(s): %s", count, e)
+        errors.append(e)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    await queues[0].put(_DONE)
+    await asyncio.gather(*tasks)
+
+    if errors:
+        raise errors[0]
+    return [results[i] for i in range(count)]
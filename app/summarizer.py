@@ -1,90 +1,600 @@
 import anthropic
+import asyncio
+import hashlib
+import json
 import logging
+import math
+import re
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Iterable, NamedTuple, Protocol
+
+from app.clients import get_clients
+from app.rate_limit import ANTHROPIC, rate_limited
 
 logger = logging.getLogger(__name__)
 
+# Input budget for a single merge call. Groups of notes are merged level by
+# level until one document remains, so any number of chunks fits.
+DEFAULT_MERGE_TOKEN_BUDGET = 12000
+DEFAULT_MAX_CONCURRENCY = 4
+# Transcript tokens sent to Claude in one call. Audio chunking is decoupled
+# from this: transcripts are joined and re-packed into as few windows of
+# this size as possible.
+DEFAULT_TRANSCRIPT_TOKEN_BUDGET = 100000
 
-def generate_meeting_notes(
-    transcript: str, model: str, max_tokens: int, api_key: str
-) -> str:
-    client = anthropic.Anthropic(api_key=api_key)
-
-    prompt = (
-        "以下是一段語音轉錄的文字內容，請根據這段內容生成結構化的會議記錄。請包含以下內容：\n\n"
-        "## 會議摘要\n"
-        "簡短概述會議主題和目的。\n\n"
-        "## 重點討論事項\n"
-        "列出主要討論的議題和內容。\n\n"
-        "## 決議事項\n"
-        "列出會議中做出的決定。\n\n"
-        "## 待辦事項\n"
-        "列出需要後續跟進的事項。\n\n"
-        "請使用繁體中文撰寫，並保持條理清晰。"
-        "如果內容不像會議，請根據內容做適當的筆記摘要。\n\n"
-        "---\n\n"
-        f"{transcript}"
+# Fixed instructions live in the system prompt and the user turn carries only
+# the transcript. They are not marked for prompt caching: each prompt is far
+# below the 1024-token minimum cacheable prefix, so every call would miss.
+MEETING_NOTES_SYSTEM_PROMPT = (
+    "使用者會提供一段語音轉錄的文字內容，請根據這段內容生成結構化的會議記錄。請包含以下內容：\n\n"
+    "## 會議摘要\n"
+    "簡短概述會議主題和目的。\n\n"
+    "## 重點討論事項\n"
+    "列出主要討論的議題和內容。\n\n"
+    "## 決議事項\n"
+    "列出會議中做出的決定。\n\n"
+    "## 待辦事項\n"
+    "列出需要後續跟進的事項。\n\n"
+    "請使用繁體中文撰寫，並保持條理清晰。"
+    "如果內容不像會議，請根據內容做適當的筆記摘要。"
+)
+
+MERGE_NOTES_SYSTEM_PROMPT = (
+    "使用者會提供同一場會議的多段會議記錄（以 --- 分隔），"
+    "請將它們合併成一份完整、不重複的會議記錄，"
+    "保持相同的格式結構。"
+)
+
+PREVIEW_SYSTEM_PROMPT = (
+    "使用者會提供一段會議或語音備忘錄的逐字稿開頭。"
+    "請用繁體中文寫出最多三行的重點預覽，每行一句，"
+    "讓讀者在完整會議記錄產生前先掌握大意。不要加標題或其他說明。"
+)
+
+# Returned in place of notes when Claude answers with no text.
+EMPTY_NOTES_MESSAGE = "無法生成會議記錄。"
+
+# Fingerprint of the prompts that write the final notes. Stored notes are
+# only reused while it matches, so editing a prompt invalidates them.
+PROMPT_VERSION = hashlib.sha256(
+    (MEETING_NOTES_SYSTEM_PROMPT + MERGE_NOTES_SYSTEM_PROMPT).encode("utf-8")
+).hexdigest()[:12]
+
+# Job priorities understood by route_model. Low-priority jobs tolerate the
+# fast tier for longer transcripts; high-priority jobs always get the strong
+# model.
+PRIORITIES = ("low", "normal", "high")
+LOW_PRIORITY_FAST_ROUTE_FACTOR = 4
+ROUTING_LOG_SIZE = 1000
+
+_SENTENCE_END_PATTERN = re.compile(r"(?<=[\n。！？!?])|(?<=[.] )")
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+SECTION_HEADING = "## "
+
+SectionHandler = Callable[[str], Awaitable[None]]
+
+
+class NotesStore(Protocol):
+    """Somewhere to keep generated notes so a retried job need not pay for them again."""
+
+    def load_notes(self, key: str) -> str | None: ...
+
+    def save_notes(self, key: str, notes: str) -> None: ...
+
+
+class ModelRoute(NamedTuple):
+    """Model and output budget chosen for one job."""
+
+    tier: str
+    model: str
+    max_tokens: int
+
+
+@dataclass
+class RoutingDecision:
+    """One routed job, kept so tiers can be compared on latency and size."""
+
+    tier: str
+    model: str
+    priority: str
+    transcript_tokens: int
+    latency_seconds: float
+    recorded_at: float = field(default_factory=time.time)
+
+
+_routing_log: deque[RoutingDecision] = deque(maxlen=ROUTING_LOG_SIZE)
+_routing_lock = threading.Lock()
+
+
+def route_model(
+    transcript_tokens: int,
+    priority: str,
+    strong_model: str,
+    strong_max_tokens: int,
+    fast_model: str,
+    fast_max_tokens: int,
+    fast_route_max_tokens: int,
+) -> ModelRoute:
+    """Pick the model tier for a job from its transcript size and priority.
+
+    Transcripts up to fast_route_max_tokens (or LOW_PRIORITY_FAST_ROUTE_FACTOR
+    times that for low-priority jobs) go to the low-latency fast model with a
+    smaller output budget; everything else, and every high-priority job,
+    goes to the strong model.
+
+    Args:
+        transcript_tokens: Estimated token count of the whole transcript.
+        priority: One of PRIORITIES; unknown values are treated as "normal".
+        strong_model: Model for long or high-priority jobs.
+        strong_max_tokens: Output budget for the strong model.
+        fast_model: Model for short jobs.
+        fast_max_tokens: Output budget for the fast model.
+        fast_route_max_tokens: Largest transcript sent to the fast model.
+
+    Returns:
+        The chosen ModelRoute.
+    """
+    if priority not in PRIORITIES:
+        priority = "normal"
+    limit = fast_route_max_tokens
+    if priority == "low":
+        limit *= LOW_PRIORITY_FAST_ROUTE_FACTOR
+
+    if priority != "high" and transcript_tokens <= limit:
+        return ModelRoute("fast", fast_model, fast_max_tokens)
+    return ModelRoute("strong", strong_model, strong_max_tokens)
+
+
+def record_routing(route: ModelRoute, priority: str, transcript_tokens: int, latency_seconds: float) -> None:
+    """Remember a routing decision and how long the job's notes took."""
+    decision = RoutingDecision(route.tier, route.model, priority, transcript_tokens, latency_seconds)
+    with _routing_lock:
+        _routing_log.append(decision)
+    logger.info(
+        "[ROUTE] tier=%s model=%s priority=%s transcript_tokens=%d latency=%.1fs",
+        route.tier, route.model, priority, transcript_tokens, latency_seconds,
     )
 
+
+def routing_stats() -> dict[str, dict]:
+    """Summarize recent routing decisions per tier.
+
+    Returns:
+        For each tier: job count, models used, median and mean latency in
+        seconds, and mean and total transcript tokens.
+    """
+    with _routing_lock:
+        decisions = list(_routing_log)
+
+    stats = {}
+    for tier in sorted({d.tier for d in decisions}):
+        rows = [d for d in decisions if d.tier == tier]
+        latencies = [d.latency_seconds for d in rows]
+        tokens = [d.transcript_tokens for d in rows]
+        stats[tier] = {
+            "jobs": len(rows),
+            "models": sorted({d.model for d in rows}),
+            "latency_p50_seconds": round(statistics.median(latencies), 3),
+            "latency_mean_seconds": round(statistics.fmean(latencies), 3),
+            "transcript_tokens_mean": round(statistics.fmean(tokens)),
+            "transcript_tokens_total": sum(tokens),
+        }
+    return stats
+
+
+async def generate_meeting_notes(
+    transcript: str,
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    on_section: SectionHandler | None = None,
+    store: NotesStore | None = None,
+) -> str:
     logger.info(
-        "[CLAUDE] Sending transcript (%d chars) to model=%s, max_tokens=%d",
-        len(transcript), model, max_tokens,
+        "[CLAUDE] Sending transcript (%d chars) to model=%s, max_tokens=%d, streaming=%s",
+        len(transcript), model, max_tokens, on_section is not None,
     )
 
-    response = client.messages.create(
+    request = dict(
         model=model,
         max_tokens=max_tokens,
-        messages=[{"role": "user", "content": prompt}],
+        system=MEETING_NOTES_SYSTEM_PROMPT,
+        messages=[{"role": "user", "content": transcript}],
     )
 
-    result = "".join(
-        block.text for block in response.content if block.type == "text"
-    )
+    async def produce() -> str:
+        async with _anthropic_client(api_key) as client:
+            return await _request_text(client, "notes", on_section, **request)
+
+    result = await _with_store(store, request, produce)
 
     if not result:
-        logger.warning("[CLAUDE] Empty response from Claude API, content blocks: %s", response.content)
-        return "無法生成會議記錄。"
+        logger.warning("[CLAUDE] Empty response from Claude API for model=%s", model)
+        return EMPTY_NOTES_MESSAGE
 
     logger.info("[CLAUDE] Meeting notes generated: %d chars", len(result))
     return result
 
 
-def generate_meeting_notes_from_chunks(
-    transcripts: list[str], model: str, max_tokens: int, api_key: str
+async def generate_preview(transcript: str, model: str, max_tokens: int, api_key: str) -> str:
+    """Write a three-line TL;DR of transcript with a fast, lightweight model."""
+    logger.info("[CLAUDE] Generating preview from %d chars with model=%s", len(transcript), model)
+    async with _anthropic_client(api_key) as client:
+        result = await _request_text(
+            client,
+            "preview",
+            None,
+            model=model,
+            max_tokens=max_tokens,
+            system=PREVIEW_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": transcript}],
+        )
+    return result.strip()
+
+
+@asynccontextmanager
+async def _anthropic_client(api_key: str) -> AsyncIterator[anthropic.AsyncAnthropic]:
+    """Yield the shared pooled client, or a one-off client outside the app."""
+    shared = get_clients()
+    if shared is not None:
+        yield shared.anthropic
+        return
+    async with anthropic.AsyncAnthropic(api_key=api_key) as client:
+        yield client
+
+
+def notes_key(request: dict) -> str:
+    """Identify a Claude request by everything that shapes its output."""
+    encoded = json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+async def _with_store(store: NotesStore | None, request: dict, produce: Callable[[], Awaitable[str]]) -> str:
+    """Return the saved text for request, or produce it and save it."""
+    if store is None:
+        return await produce()
+    key = notes_key(request)
+    saved = store.load_notes(key)
+    if saved is not None:
+        logger.info("[CLAUDE] Reusing saved notes %s (%d chars)", key[:12], len(saved))
+        return saved
+    text = await produce()
+    if text:
+        store.save_notes(key, text)
+    return text
+
+
+async def _request_text(client, label: str, on_section: SectionHandler | None, **request) -> str:
+    """Call the Messages API and return the concatenated text blocks.
+
+    With on_section, the response is consumed through the streaming API and
+    each "## " section is awaited on on_section as soon as the next heading
+    (or the end of the response) closes it.
+
+    The call goes through the Anthropic rate limiter, budgeted at the
+    prompt's estimated input tokens. A streamed call is only retried
+    until its first section has been handed on, unless on_section has a
+    rewind() that takes the sections back (see SectionPusher).
+    """
+    tokens = estimate_tokens(request.get("system", "")) + sum(
+        estimate_tokens(m["content"]) for m in request["messages"]
+    )
+
+    if on_section is None:
+        response = await rate_limited(ANTHROPIC, lambda: client.messages.create(**request), tokens=tokens)
+        _log_usage(label, response)
+        return "".join(
+            block.text for block in response.content if block.type == "text"
+        )
+
+    emitted = False
+
+    async def stream_sections() -> str:
+        nonlocal emitted
+        splitter = SectionSplitter()
+        async with client.messages.stream(**request) as stream:
+            async for text in stream.text_stream:
+                for section in splitter.feed(text):
+                    emitted = True
+                    await on_section(section)
+            final_message = await stream.get_final_message()
+        for section in splitter.close():
+            emitted = True
+            await on_section(section)
+        _log_usage(label, final_message)
+        return splitter.text
+
+    rewind = getattr(on_section, "rewind", None)
+
+    def retryable() -> bool:
+        nonlocal emitted
+        if emitted and (rewind is None or not rewind()):
+            return False
+        emitted = False
+        return True
+
+    return await rate_limited(ANTHROPIC, stream_sections, tokens=tokens, retryable=retryable)
+
+
+class SectionSplitter:
+    """Cuts streamed Markdown text into sections at "## " headings.
+
+    feed() and close() return the sections they completed. Text before the
+    first heading is returned as its own section. Empty sections are
+    skipped.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._section_start = 0
+        self._scan_from = 0
+
+    def feed(self, text: str) -> list[str]:
+        self.text += text
+        marker = "\n" + SECTION_HEADING
+        sections = []
+        while True:
+            pos = self.text.find(marker, max(self._scan_from, self._section_start))
+            if pos == -1:
+                # A marker may straddle the next delta; rescan its tail.
+                self._scan_from = max(self._section_start, len(self.text) - len(marker) + 1)
+                return sections
+            sections.extend(self._take(self.text[self._section_start:pos]))
+            self._section_start = pos + 1
+            self._scan_from = self._section_start
+
+    def close(self) -> list[str]:
+        sections = self._take(self.text[self._section_start:])
+        self._section_start = len(self.text)
+        return sections
+
+    @staticmethod
+    def _take(section: str) -> list[str]:
+        section = section.strip()
+        return [section] if section else []
+
+
+def _log_usage(label: str, response) -> None:
+    """Log input and output token counts from response.usage."""
+    usage = getattr(response, "usage", None)
+
+    def count(name: str) -> int:
+        value = getattr(usage, name, None)
+        return value if isinstance(value, int) else 0
+
+    logger.info(
+        "[CLAUDE] %s usage: input=%d, output=%d",
+        label, count("input_tokens"), count("output_tokens"),
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the Claude token count of text without an API call.
+
+    CJK characters count as about one token each; other text as about one
+    token per four characters.
+    """
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def pack_transcripts(transcripts: list[str], token_budget: int) -> list[str]:
+    """Re-pack transcripts into the fewest windows that fit token_budget.
+
+    Transcripts are joined in order and windows are filled greedily, which
+    for contiguous windows gives the minimum count. A transcript that is too
+    large on its own is broken at sentence boundaries, or hard-cut if a
+    single sentence exceeds the budget.
+
+    Args:
+        transcripts: Transcript texts in playback order.
+        token_budget: Maximum estimated tokens per window.
+
+    Returns:
+        The packed windows, in order.
+    """
+    pieces = []
+    for transcript in transcripts:
+        if estimate_tokens(transcript) <= token_budget:
+            pieces.append(transcript)
+        else:
+            pieces.extend(_split_by_tokens(transcript, token_budget))
+
+    windows: list[str] = []
+    current: list[str] = []
+    current_tokens = 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if current and current_tokens + tokens > token_budget:
+            windows.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        windows.append("\n".join(current))
+    return windows
+
+
+def _split_by_tokens(text: str, token_budget: int) -> list[str]:
+    """Split one oversized text into pieces within token_budget."""
+    pieces: list[str] = []
+    current = ""
+    for sentence in _SENTENCE_END_PATTERN.split(text):
+        if not sentence:
+            continue
+        if estimate_tokens(current + sentence) <= token_budget:
+            current += sentence
+            continue
+        if current:
+            pieces.append(current)
+        # No character is more than one token, so a cut every token_budget
+        # characters always fits.
+        while estimate_tokens(sentence) > token_budget:
+            pieces.append(sentence[:token_budget])
+            sentence = sentence[token_budget:]
+        current = sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+async def generate_meeting_notes_from_chunks(
+    transcripts: list[str],
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    merge_token_budget: int = DEFAULT_MERGE_TOKEN_BUDGET,
+    transcript_token_budget: int = DEFAULT_TRANSCRIPT_TOKEN_BUDGET,
+    on_section: SectionHandler | None = None,
+    store: NotesStore | None = None,
 ) -> str:
-    results = []
-    for i, transcript in enumerate(transcripts):
-        logger.info("Processing transcript chunk %d/%d", i + 1, len(transcripts))
-        notes = generate_meeting_notes(transcript, model, max_tokens, api_key)
-        results.append(notes)
+    """Generate meeting notes for a transcript that arrived in audio chunks.
 
-    if len(results) == 1:
-        return results[0]
+    The chunk transcripts are re-packed by token count: when the whole
+    transcript fits transcript_token_budget a single Claude call is made,
+    otherwise each window is summarized concurrently and the notes are
+    merged with merge_chunk_notes. on_section, if given, receives the
+    sections of the final document as they are streamed. With a store,
+    every window and merge result is saved as it completes, and a retry
+    only calls Claude for the ones that are missing; text loaded from the
+    store is returned without going through on_section.
+    """
+    windows = pack_transcripts(transcripts, transcript_token_budget)
+    logger.info(
+        "Packed %d transcript chunk(s) into %d window(s) (budget=%d tokens)",
+        len(transcripts), len(windows), transcript_token_budget,
+    )
+    if len(windows) == 1:
+        return await generate_meeting_notes(
+            windows[0], model, max_tokens, api_key, on_section=on_section, store=store
+        )
 
-    return _merge_meeting_notes(results, model, max_tokens, api_key)
+    results = await _gather_bounded(
+        lambda window: generate_meeting_notes(window, model, max_tokens, api_key, store=store),
+        windows,
+        max_concurrency,
+    )
 
+    return await merge_chunk_notes(
+        results, model, max_tokens, api_key,
+        max_concurrency=max_concurrency, token_budget=merge_token_budget,
+        on_section=on_section, store=store,
+    )
 
-def _merge_meeting_notes(
-    notes_list: list[str], model: str, max_tokens: int, api_key: str
+
+async def merge_chunk_notes(
+    notes_list: list[str],
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    token_budget: int = DEFAULT_MERGE_TOKEN_BUDGET,
+    on_section: SectionHandler | None = None,
+    store: NotesStore | None = None,
 ) -> str:
-    client = anthropic.Anthropic(api_key=api_key)
+    """Combine per-chunk notes into one document with a hierarchical reduction.
+
+    Consecutive notes are grouped so each merge call stays within
+    token_budget, the groups of one level are merged concurrently, and the
+    merged notes form the next level. A single note is returned without
+    calling Claude. Latency grows with log(chunks) rather than linearly.
+    The last merge call is streamed to on_section, if given.
+    """
+    level = list(notes_list)
+    depth = 0
+    while len(level) > 1:
+        groups = _group_by_token_budget(level, token_budget)
+        depth += 1
+        logger.info(
+            "Merge level %d: %d note(s) -> %d group(s) (budget=%d tokens)",
+            depth, len(level), len(groups), token_budget,
+        )
+
+        final_section_handler = on_section if len(groups) == 1 else None
+
+        async def merge_group(group: list[str]) -> str:
+            if len(group) == 1:
+                return group[0]
+            return await _merge_meeting_notes(
+                group, model, max_tokens, api_key, on_section=final_section_handler, store=store
+            )
+
+        level = await _gather_bounded(merge_group, groups, max_concurrency)
+
+    return level[0]
 
+
+async def _gather_bounded(func: Callable[[object], Awaitable], items: Iterable, max_concurrency: int) -> list:
+    """Await func over items with at most max_concurrency calls in flight.
+
+    Results keep the order of items. If one call fails, the others are
+    cancelled and the error is re-raised.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    tasks = [asyncio.ensure_future(run(item)) for item in items]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+def _group_by_token_budget(notes_list: list[str], token_budget: int) -> list[list[str]]:
+    """Split notes into consecutive groups that fit token_budget.
+
+    Every group that can take a second note gets one even when that exceeds
+    the budget, so each reduction level shrinks the list.
+    """
+    groups: list[list[str]] = []
+    current: list[str] = []
+    current_tokens = 0
+    for notes in notes_list:
+        tokens = estimate_tokens(notes)
+        if current and current_tokens + tokens > token_budget and len(current) > 1:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(notes)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+async def _merge_meeting_notes(
+    notes_list: list[str],
+    model: str,
+    max_tokens: int,
+    api_key: str,
+    on_section: SectionHandler | None = None,
+    store: NotesStore | None = None,
+) -> str:
     combined_notes = "---\n".join(notes_list)
-    prompt = (
-        "以下是同一場會議的多段會議記錄，"
-        "請將它們合併成一份完整、不重複的會議記錄，"
-        "保持相同的格式結構：\n\n" + combined_notes
-    )
 
     logger.info("Merging %d meeting note chunks", len(notes_list))
 
-    response = client.messages.create(
+    request = dict(
         model=model,
         max_tokens=max_tokens,
-        messages=[{"role": "user", "content": prompt}],
+        system=MERGE_NOTES_SYSTEM_PROMPT,
+        messages=[{"role": "user", "content": combined_notes}],
     )
 
-    result = "".join(
-        block.text for block in response.content if block.type == "text"
-    )
+    async def produce() -> str:
+        async with _anthropic_client(api_key) as client:
+            return await _request_text(client, "merge", on_section, **request)
 
-    return result
+    return await _with_store(store, request, produce)
@@ -1,25 +1,80 @@
+import asyncio
 import logging
 from pathlib import Path
 
 import openai
 
+from app.clients import get_clients
+from app.rate_limit import OPENAI, get_rate_limiter, rate_limited
+
 logger = logging.getLogger(__name__)
 
+RETRY_BASE_DELAY_SECONDS = 1.0
+
+
+async def transcribe_audio(audio_path: str, api_key: str) -> str:
+    shared = get_clients()
+    if shared is not None:
+        return await _transcribe(shared.openai, audio_path)
+    async with openai.AsyncOpenAI(api_key=api_key) as client:
+        return await _transcribe(client, audio_path)
 
-def transcribe_audio(audio_path: str, api_key: str) -> str:
-    client = openai.OpenAI(api_key=api_key)
 
+async def _transcribe(client: openai.AsyncOpenAI, audio_path: str) -> str:
     file_name = Path(audio_path).name
     file_size = Path(audio_path).stat().st_size
     logger.info("[WHISPER] Transcribing %s (%d bytes)...", file_name, file_size)
 
-    with open(audio_path, "rb") as audio_file:
-        response = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-        )
+    # A Path is read by the client without blocking the event loop.
+    response = await rate_limited(
+        OPENAI, lambda: client.audio.transcriptions.create(model="whisper-1", file=Path(audio_path))
+    )
 
     transcript = response.text
     logger.info("[WHISPER] Transcription complete: %d chars", len(transcript))
     logger.debug("[WHISPER] Preview: %s", transcript[:200])
     return transcript
+
+
+def _is_transient(error: Exception) -> bool:
+    """Whether a Whisper error is worth retrying: network trouble, 429 or 5xx."""
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+async def transcribe_with_retry(audio_path: str, api_key: str, max_retries: int = 2) -> str:
+    """Transcribe one chunk, retrying transient failures with exponential backoff.
+
+    Only connection errors, timeouts, rate limits and 5xx responses are
+    retried; anything else (e.g. a 400 for an unsupported file) would fail
+    the same way again and is raised immediately. When the OpenAI rate
+    limiter is on it already retries those errors, so the upload is not
+    retried again here.
+
+    Args:
+        audio_path: Path to the audio chunk.
+        api_key: The OpenAI API key.
+        max_retries: Retries after the first attempt, without a rate limiter.
+
+    Returns:
+        The transcript text.
+
+    Raises:
+        Exception: The first non-transient error, or the last error once
+            retries are exhausted.
+    """
+    if get_rate_limiter(OPENAI) is not None:
+        max_retries = 0
+    for attempt in range(max_retries + 1):
+        try:
+            return await transcribe_audio(audio_path, api_key)
+        except Exception as e:
+            if attempt == max_retries or not _is_transient(e):
+                raise
+            delay = RETRY_BASE_DELAY_SECONDS * 2 ** attempt
+            logger.warning(
+                "[WHISPER] %s failed (attempt %d/%d), retrying in %.1fs: %s",
+                Path(audio_path).name, attempt + 1, max_retries + 1, delay, e,
+            )
+            await asyncio.sleep(delay)
@@ -0,0 +1,205 @@
+"""Energy-based voice-activity trimming of long silences before transcription."""
+
+import bisect
+import logging
+import os
+import subprocess
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from app.audio_processor import (
+    ENERGY_WINDOW_SECONDS,
+    FFMPEG_BINARY,
+    UPLOAD_CODEC_EXTENSIONS,
+    compute_energy_envelope,
+)
+
+logger = logging.getLogger(__name__)
+
+# A frame counts as speech when its RMS is ~10 dB above the recording's
+# noise floor and above an absolute floor of roughly -50 dBFS. The noise
+# estimate is capped at 20 dB below the loud parts, so recordings with
+# almost no silence in them are not misread as all noise.
+VAD_NOISE_FACTOR = 3.0
+VAD_MIN_RMS = 100.0
+VAD_NOISE_PERCENTILE = 10
+VAD_LOUD_PERCENTILE = 90
+VAD_LOUD_RATIO = 0.1
+# Silence kept on each side of a removed span, so word onsets and tails
+# are not clipped.
+VAD_PADDING_SECONDS = 0.3
+
+
+@dataclass
+class OffsetMap:
+    """Maps positions in trimmed audio back to positions in the original.
+
+    Each segment is (trimmed_start, original_start, length) in seconds,
+    ordered by trimmed_start.
+    """
+
+    segments: list[tuple[float, float, float]] = field(default_factory=list)
+
+    def to_original(self, trimmed_seconds: float) -> float:
+        """Translate a timestamp in the trimmed audio to the original audio."""
+        if not self.segments:
+            return trimmed_seconds
+        starts = [segment[0] for segment in self.segments]
+        index = max(0, bisect.bisect_right(starts, trimmed_seconds) - 1)
+        trimmed_start, original_start, length = self.segments[index]
+        return original_start + min(trimmed_seconds - trimmed_start, length)
+
+    def shifted(self, offset_seconds: float) -> "OffsetMap":
+        """Return a map whose original positions are moved by offset_seconds.
+
+        Used to turn a chunk-relative map into one relative to the whole
+        recording, given the chunk's start time.
+        """
+        return OffsetMap([
+            (trimmed_start, round(original_start + offset_seconds, 3), length)
+            for trimmed_start, original_start, length in self.segments
+        ])
+
+
+@dataclass
+class TrimResult:
+    """Outcome of trimming one audio file."""
+
+    audio_path: str
+    offset_map: OffsetMap
+    original_seconds: float
+    trimmed_seconds: float
+
+    @property
+    def saved_seconds(self) -> float:
+        return self.original_seconds - self.trimmed_seconds
+
+
+def detect_speech_spans(
+    energy: np.ndarray,
+    min_silence_seconds: float,
+    frame_seconds: float = ENERGY_WINDOW_SECONDS,
+    padding_seconds: float = VAD_PADDING_SECONDS,
+) -> list[tuple[float, float]]:
+    """Return the spans of audio to keep after dropping long silences.
+
+    Silent runs shorter than min_silence_seconds are kept as natural pauses;
+    longer runs are removed except for padding_seconds on each side.
+
+    Args:
+        energy: RMS envelope with one value per frame.
+        min_silence_seconds: Shortest silence that gets removed.
+        frame_seconds: Duration covered by each envelope value.
+        padding_seconds: Silence kept next to speech on each side.
+
+    Returns:
+        (start, end) spans in seconds, ascending and non-overlapping. An
+        empty list means no speech was detected.
+    """
+    if len(energy) == 0:
+        return []
+
+    noise_floor = np.percentile(energy, VAD_NOISE_PERCENTILE)
+    loud_level = np.percentile(energy, VAD_LOUD_PERCENTILE)
+    threshold = max(min(noise_floor * VAD_NOISE_FACTOR, loud_level * VAD_LOUD_RATIO), VAD_MIN_RMS)
+    speech = energy > threshold
+    if not speech.any():
+        return []
+
+    # Run boundaries of silence: +1 where silence starts, -1 where it ends.
+    silent = np.concatenate(([0], (~speech).astype(np.int8), [0]))
+    edges = np.diff(silent)
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+
+    min_frames = int(round(min_silence_seconds / frame_seconds))
+    pad = int(round(padding_seconds / frame_seconds))
+    keep = np.ones(len(energy), dtype=bool)
+    for start, end in zip(run_starts, run_ends):
+        if end - start < min_frames:
+            continue
+        cut_start = start if start == 0 else start + pad
+        cut_end = end if end == len(energy) else end - pad
+        keep[cut_start:cut_end] = False
+
+    kept = np.concatenate(([0], keep.astype(np.int8), [0]))
+    kept_edges = np.diff(kept)
+    span_starts = np.flatnonzero(kept_edges == 1)
+    span_ends = np.flatnonzero(kept_edges == -1)
+    return [
+        (round(start * frame_seconds, 3), round(end * frame_seconds, 3))
+        for start, end in zip(span_starts, span_ends)
+    ]
+
+
+def trim_silence(
+    audio_path: str,
+    min_silence_seconds: float,
+    codec: str = "aac",
+    bitrate_kbps: int = 64,
+    sample_rate: int | None = None,
+) -> TrimResult:
+    """Remove silent stretches longer than min_silence_seconds from audio_path.
+
+    The trimmed audio is written next to the input with the given encoder,
+    so callers that upload it can ask for their upload profile directly
+    instead of encoding the audio a second time. When nothing would be
+    removed, or no speech is found at all, the input is returned untouched
+    with an identity offset map.
+
+    Args:
+        audio_path: Path to the audio file.
+        min_silence_seconds: Shortest silence that gets removed.
+        codec: ffmpeg encoder name, one of UPLOAD_CODEC_EXTENSIONS.
+        bitrate_kbps: Target bitrate in kbit/s.
+        sample_rate: Target sample rate in Hz, downmixed to mono; None keeps
+            the source layout.
+
+    Returns:
+        A TrimResult with the path to transcribe and its offset map.
+
+    Raises:
+        ValueError: If codec is not supported.
+    """
+    if codec not in UPLOAD_CODEC_EXTENSIONS:
+        raise ValueError(f"Unsupported codec: {codec}")
+
+    energy = compute_energy_envelope(audio_path)
+    original_seconds = round(len(energy) * ENERGY_WINDOW_SECONDS, 3)
+    spans = detect_speech_spans(energy, min_silence_seconds)
+    kept_seconds = round(sum(end - start for start, end in spans), 3)
+
+    if not spans or kept_seconds >= original_seconds:
+        if not spans:
+            logger.info("[VAD] No speech detected in %s, leaving it untouched", audio_path)
+        identity = OffsetMap([(0.0, 0.0, original_seconds)])
+        return TrimResult(audio_path, identity, original_seconds, original_seconds)
+
+    root, _ = os.path.splitext(audio_path)
+    trimmed_path = f"{root}_vad{UPLOAD_CODEC_EXTENSIONS[codec]}"
+    selection = "+".join(f"between(t,{start:.3f},{end:.3f})" for start, end in spans)
+    layout_args = ["-ac", "1", "-ar", str(sample_rate)] if sample_rate else []
+    cmd = [
+        FFMPEG_BINARY, "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        "-i", audio_path,
+        "-map", "0:a:0", "-vn",
+        "-af", f"aselect='{selection}',asetpts=N/SR/TB",
+        *layout_args,
+        "-c:a", codec, "-b:a", f"{bitrate_kbps}k",
+        trimmed_path,
+    ]
+    subprocess.run(cmd, check=True, capture_output=True)
+
+    segments = []
+    trimmed_cursor = 0.0
+    for start, end in spans:
+        segments.append((round(trimmed_cursor, 3), start, round(end - start, 3)))
+        trimmed_cursor += end - start
+
+    result = TrimResult(trimmed_path, OffsetMap(segments), original_seconds, kept_seconds)
+    logger.info(
+        "[VAD] Trimmed %s: %.1fs -> %.1fs (saved %.1fs, %d span(s))",
+        audio_path, original_seconds, kept_seconds, result.saved_seconds, len(spans),
+    )
+    return result
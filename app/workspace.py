@@ -0,0 +1,148 @@
+"""Per-job working directory that checkpoints what the pipeline has produced."""
+
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+from app.audio_processor import AudioChunk
+
+logger = logging.getLogger(__name__)
+
+_UNSAFE_NAME_PATTERN = re.compile(r"[^\w.-]")
+
+
+class JobWorkspace:
+    """Files a job has produced so far, kept until the job is over.
+
+    Each stage records its output here as soon as it is complete, so a job
+    that is retried or resumed on another worker picks up where the last
+    attempt stopped instead of downloading and transcribing again:
+
+        audio.m4a, audio.json     the downloaded recording, its size and
+                                  SHA-256
+        chunk_*, chunks.json      chunk files and the list of chunks, written
+                                  once splitting has finished
+        transcripts/<n>.json      the transcript of chunk n
+        notes/<key>.md            Claude output, keyed by summarizer.notes_key
+
+    Records are written to a temporary file and renamed into place, so a
+    crash never leaves a half-written checkpoint behind. Replicas on
+    different hosts only share checkpoints if root is on shared storage.
+
+    Args:
+        root: Directory holding every job's workspace.
+        message_id: LINE message ID of the job's recording.
+    """
+
+    def __init__(self, root: str, message_id: str):
+        self.message_id = message_id
+        self.path = os.path.abspath(os.path.join(root, _UNSAFE_NAME_PATTERN.sub("_", message_id)))
+        os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def audio_path(self) -> str:
+        return os.path.join(self.path, "audio.m4a")
+
+    def load_audio_size(self) -> int | None:
+        """Size of the downloaded recording, or None if it was not fully downloaded."""
+        record = self._read_json("audio.json")
+        if record is None or not os.path.exists(self.audio_path):
+            return None
+        return record["size"]
+
+    def load_audio_sha256(self) -> str | None:
+        record = self._read_json("audio.json")
+        return record.get("sha256") if record else None
+
+    def save_audio(self, size: int, sha256: str) -> None:
+        self._write_json("audio.json", {"size": size, "sha256": sha256})
+
+    def load_chunks(self) -> list[AudioChunk] | None:
+        """Chunks of the recording, or None if splitting did not finish."""
+        record = self._read_json("chunks.json")
+        if record is None:
+            return None
+        chunks = [AudioChunk(c["path"], c["start_seconds"], c["end_seconds"]) for c in record]
+        if not all(os.path.exists(c.path) for c in chunks):
+            return None
+        return chunks
+
+    def save_chunks(self, chunks: list[AudioChunk]) -> None:
+        self._write_json(
+            "chunks.json",
+            [{"path": c.path, "start_seconds": c.start_seconds, "end_seconds": c.end_seconds} for c in chunks],
+        )
+
+    def load_transcript(self, index: int, start_seconds: float) -> str | None:
+        """Transcript of chunk index, if it was transcribed from the same cut."""
+        record = self._read_json(os.path.join("transcripts", f"{index}.json"))
+        if record is None or record["start_seconds"] != start_seconds:
+            return None
+        return record["transcript"]
+
+    def save_transcript(self, index: int, start_seconds: float, transcript: str) -> None:
+        self._write_json(
+            os.path.join("transcripts", f"{index}.json"),
+            {"start_seconds": start_seconds, "transcript": transcript},
+        )
+
+    def load_notes(self, key: str) -> str | None:
+        try:
+            with open(os.path.join(self.path, "notes", f"{key}.md"), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def save_notes(self, key: str, notes: str) -> None:
+        self._write(os.path.join("notes", f"{key}.md"), notes)
+
+    def remove(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+        logger.info("[WORKSPACE] Removed workspace for message_id=%s", self.message_id)
+
+    def _read_json(self, name: str):
+        try:
+            with open(os.path.join(self.path, name), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning("[WORKSPACE] Ignoring unreadable checkpoint %s: %s", name, e)
+            return None
+
+    def _write_json(self, name: str, value) -> None:
+        self._write(name, json.dumps(value, ensure_ascii=False))
+
+    def _write(self, name: str, text: str) -> None:
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+def sweep_workspaces(root: str, max_age_seconds: float) -> int:
+    """Delete workspaces untouched for max_age_seconds.
+
+    Workspaces are normally removed when their job ends; this catches the
+    ones left behind by jobs that were abandoned, e.g. after their lease
+    expired too many times.
+
+    Returns:
+        The number of workspaces deleted.
+    """
+    if not os.path.isdir(root):
+        return 0
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for entry in os.scandir(root):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    if removed:
+        logger.info("[WORKSPACE] Swept %d stale workspace(s) from %s", removed, root)
+    return removed
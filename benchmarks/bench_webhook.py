@@ -0,0 +1,109 @@
+"""Measure /callback latency under concurrent signed webhook deliveries.
+
+Runs the FastAPI app in-process over ASGI with the real parser, job queue
+and idempotency store on temporary SQLite files. Workers are not started
+and LINE replies are replaced by a no-op, so the numbers cover only the
+webhook's own path: signature check, event filtering and enqueueing.
+
+    python -m benchmarks.bench_webhook --requests 2000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+
+def _body(n: int) -> str:
+    return json.dumps({
+        "destination": "Ubench",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": f"U{n % 20:032d}"},
+            "webhookEventId": f"EVT{n:020d}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"token{n}",
+            "message": {"id": f"{n:018d}", "type": "audio", "duration": 60000,
+                        "contentProvider": {"type": "line"}},
+        }],
+    })
+
+
+def _sign(secret: str, body: str) -> str:
+    digest = hmac.new(secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+async def run(requests: int, concurrency: int) -> dict:
+    import httpx
+
+    from app import main
+    from app.idempotency import IdempotencyStore
+    from app.job_queue import JobQueue
+
+    secret = main.settings.line_channel_secret
+    tmp = tempfile.mkdtemp(prefix="bench_webhook_")
+    main.app.state.job_queue = JobQueue(os.path.join(tmp, "jobs.db"), max_pending=requests + 1)
+    main.app.state.idempotency = IdempotencyStore(os.path.join(tmp, "idempotency.db"), 3600)
+    main.send_reply = lambda reply_token, text: None
+
+    bodies = [_body(n) for n in range(requests)]
+    latencies: list[float] = []
+    pending = iter(range(requests))
+
+    async def client_loop(client):
+        for n in pending:
+            body = bodies[n]
+            headers = {"X-Line-Signature": _sign(secret, body), "Content-Type": "application/json"}
+            started = time.perf_counter()
+            response = await client.post("/callback", content=body, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    main.app.state.job_queue.close()
+    main.app.state.idempotency.close()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+    latencies.sort()
+    ms = [s * 1000 for s in latencies]
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "p50_ms": round(ms[len(ms) // 2], 3),
+        "p99_ms": round(ms[min(len(ms) - 1, int(len(ms) * 0.99))], 3),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "throughput_rps": round(requests / elapsed, 1),
+    }
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--requests", type=int, default=1000)
+    arg_parser.add_argument("--concurrency", type=int, default=20)
+    args = arg_parser.parse_args()
+
+    # Nothing is sent upstream; placeholders let Settings load without a .env.
+    for name in ("LINE_CHANNEL_SECRET", "LINE_CHANNEL_ACCESS_TOKEN", "OPENAI_API_KEY", "ANTHROPIC_API_KEY"):
+        os.environ.setdefault(name, "bench")
+    logging.disable(logging.INFO)
+    print(json.dumps(asyncio.run(run(args.requests, args.concurrency)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,106 +1,329 @@
 """Tests for audio_processor module."""
 
+import hashlib
+import json
+import os
+import subprocess
+
+import httpx
+import numpy as np
 import pytest
 from unittest.mock import MagicMock, patch, Mock
 
-from app.audio_processor import download_audio, validate_audio, split_audio_if_needed
+from app.audio_processor import (
+    AudioChunk,
+    AudioInfo,
+    find_quiet_frame,
+    frame_rms,
+    iter_audio_chunks,
+    snap_boundaries_to_silence,
+    transcode_for_upload,
+    plan_chunk_boundaries,
+    probe_audio,
+    stream_audio_to_file,
+)
+
+
+class TestStreamAudioToFile:
+    def _client(self, body: bytes, headers=None, status_code=200):
+        def handler(request):
+            assert request.headers["Authorization"] == "Bearer token"
+            return httpx.Response(status_code, content=body, headers=headers or {})
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    @pytest.mark.asyncio
+    async def test_stream_writes_file(self, tmp_path):
+        """Streamed body is written to dest_path and its size returned."""
+        body = b"\x00\xff" * 4096
+        dest = tmp_path / "audio.m4a"
+
+        size = await stream_audio_to_file(
+            "msg_123", "token", str(dest), max_size_mb=1,
+            http_client=self._client(body), chunk_size=1024,
+        )
+
+        assert size == len(body)
+        assert dest.read_bytes() == body
 
+    @pytest.mark.asyncio
+    async def test_stream_fingerprints_while_writing(self, tmp_path):
+        """on_chunk sees every byte, so the file can be hashed without rereading it."""
+        body = bytes(range(256)) * 40
+        digest = hashlib.sha256()
 
-class TestDownloadAudio:
-    def test_download_audio_success(self):
-        """Successful download returns the audio bytes from the response."""
-        expected_bytes = b"\x00\xff" * 512
-        mock_response = MagicMock()
-        mock_response.content = expected_bytes
+        await stream_audio_to_file(
+            "msg_123", "token", str(tmp_path / "audio.m4a"), max_size_mb=1,
+            http_client=self._client(body), chunk_size=1000, on_chunk=digest.update,
+        )
 
-        mock_blob_api = MagicMock()
-        mock_blob_api.get_message_content.return_value = mock_response
+        assert digest.hexdigest() == hashlib.sha256(body).hexdigest()
 
-        result = download_audio("msg_123", mock_blob_api)
+    @pytest.mark.asyncio
+    async def test_stream_aborts_when_too_large(self, tmp_path):
+        """Exceeding the limit mid-stream raises and removes the partial file."""
+        body = b"\x00" * (1024 * 1024 + 1)
+        dest = tmp_path / "audio.m4a"
 
-        assert result == expected_bytes
-        mock_blob_api.get_message_content.assert_called_once_with("msg_123")
+        with pytest.raises(ValueError, match="(?i)large"):
+            await stream_audio_to_file(
+                "msg_123", "token", str(dest), max_size_mb=1,
+                http_client=self._client(body), chunk_size=4096,
+            )
 
-    def test_download_audio_failure(self):
-        """Exception from blob API propagates to the caller."""
-        mock_blob_api = MagicMock()
-        mock_blob_api.get_message_content.side_effect = Exception("API error")
+        assert not dest.exists()
 
-        with pytest.raises(Exception, match="API error"):
-            download_audio("msg_456", mock_blob_api)
+    @pytest.mark.asyncio
+    async def test_stream_rejects_large_content_length(self, tmp_path):
+        """An oversized Content-Length is rejected before the body is read."""
+        dest = tmp_path / "audio.m4a"
+        client = self._client(b"\x00", headers={"Content-Length": str(5 * 1024 * 1024)})
 
+        with pytest.raises(ValueError, match="(?i)large"):
+            await stream_audio_to_file("msg_123", "token", str(dest), max_size_mb=1, http_client=client)
 
-class TestValidateAudio:
-    def test_validate_audio_success(self):
-        """Valid audio data within size limit passes without error."""
-        audio_data = b"\x00" * 1024
-        validate_audio(audio_data, max_size_mb=1)
+        assert not dest.exists()
+
+    @pytest.mark.asyncio
+    async def test_stream_empty(self, tmp_path):
+        """Empty body raises ValueError with 'empty' in message."""
+        dest = tmp_path / "audio.m4a"
 
-    def test_validate_audio_empty(self):
-        """Empty bytes raises ValueError with 'empty' in message."""
         with pytest.raises(ValueError, match="(?i)empty"):
-            validate_audio(b"", max_size_mb=10)
+            await stream_audio_to_file("msg_123", "token", str(dest), max_size_mb=1, http_client=self._client(b""))
 
-    def test_validate_audio_too_large(self):
-        """Data exceeding max_size_mb raises ValueError about size."""
-        # 2 MB of data with a 1 MB limit
-        audio_data = b"\x00" * (2 * 1024 * 1024)
-        with pytest.raises(ValueError, match="(?i)(size|large)"):
-            validate_audio(audio_data, max_size_mb=1)
+        assert not dest.exists()
 
+    @pytest.mark.asyncio
+    async def test_stream_http_error(self, tmp_path):
+        """Non-2xx responses raise httpx.HTTPStatusError."""
+        dest = tmp_path / "audio.m4a"
 
-class TestSplitAudio:
-    @patch("app.audio_processor.AudioSegment")
-    def test_split_audio_no_split_needed(self, mock_audio_segment_cls):
-        """Audio shorter than max returns the original path."""
-        mock_audio = MagicMock()
-        mock_audio.__len__ = Mock(return_value=5 * 60 * 1000)  # 5 minutes
-        mock_audio_segment_cls.from_file.return_value = mock_audio
+        with pytest.raises(httpx.HTTPStatusError):
+            await stream_audio_to_file(
+                "msg_123", "token", str(dest), max_size_mb=1,
+                http_client=self._client(b"not found", status_code=404),
+            )
+
+
+class TestProbeAudio:
+    def test_probe_audio_reads_metadata(self, tmp_audio_file):
+        """Duration, codec and bitrate are parsed from ffprobe's JSON output."""
+        output = json.dumps({
+            "streams": [{"codec_name": "aac", "bit_rate": "64000"}],
+            "format": {"duration": "123.45", "bit_rate": "65000"},
+        }).encode()
+
+        with patch("app.audio_processor.subprocess.run") as mock_run:
+            mock_run.return_value = subprocess.CompletedProcess([], 0, stdout=output)
+            info = probe_audio(tmp_audio_file)
+
+        assert info == AudioInfo(duration_seconds=123.45, size_bytes=1024, codec="aac", bit_rate=64000)
+        assert mock_run.call_args[0][0][0] == "ffprobe"
+
+    def test_probe_audio_unreadable(self, tmp_audio_file):
+        """ffprobe failure is reported as a ValueError."""
+        with patch("app.audio_processor.subprocess.run") as mock_run:
+            mock_run.side_effect = subprocess.CalledProcessError(1, [], stderr=b"Invalid data")
+            with pytest.raises(ValueError, match="Invalid data"):
+                probe_audio(tmp_audio_file)
+
+
+class TestPlanChunkBoundaries:
+    def test_short_file_not_split(self):
+        """A 5-minute voice memo needs no cut points."""
+        info = AudioInfo(duration_seconds=300, size_bytes=2 * 1024 * 1024)
+        assert plan_chunk_boundaries(info, max_chunk_seconds=900) == []
+
+    def test_long_file_split_by_duration(self):
+        """35 minutes at a low bitrate is cut into 3 even chunks."""
+        info = AudioInfo(duration_seconds=2100, size_bytes=16 * 1024 * 1024)
+        assert plan_chunk_boundaries(info, max_chunk_seconds=900) == [700.0, 1400.0]
+
+    def test_high_bitrate_split_by_bytes(self):
+        """A 10-minute WAV over the byte budget is split even though it is short."""
+        info = AudioInfo(duration_seconds=600, size_bytes=100 * 1024 * 1024)
+        boundaries = plan_chunk_boundaries(info, max_chunk_seconds=900, max_chunk_bytes=25 * 1024 * 1024)
+
+        edges = [0.0, *boundaries, 600.0]
+        bytes_per_second = info.size_bytes / info.duration_seconds
+        assert len(boundaries) >= 4
+        assert all((b - a) * bytes_per_second <= 25 * 1024 * 1024 for a, b in zip(edges, edges[1:]))
+
+
+class TestSilenceSnapping:
+    def test_frame_rms(self):
+        """RMS is computed per frame and trailing partial frames are dropped."""
+        samples = np.array([3, -3, 3, -3, 0, 0, 0, 0, 7], dtype=np.int16)
+        np.testing.assert_allclose(frame_rms(samples, 4), [3.0, 0.0])
+
+    def test_find_quiet_frame_prefers_nearest_pause(self):
+        """Of two pauses, the one closest to the target frame is chosen."""
+        energy = np.full(200, 1000.0, dtype=np.float32)
+        energy[20:30] = 1.0
+        energy[120:130] = 1.0
+
+        assert 120 <= find_quiet_frame(energy, target=100, pause_frames=6) < 130
+        assert 20 <= find_quiet_frame(energy, target=40, pause_frames=6) < 30
+
+    def test_find_quiet_frame_ignores_single_dip(self):
+        """A one-frame dip inside speech is not mistaken for a pause."""
+        energy = np.full(200, 1000.0, dtype=np.float32)
+        energy[101] = 0.0
+        energy[150:160] = 1.0
+
+        assert 150 <= find_quiet_frame(energy, target=100, pause_frames=6) < 160
 
-        result = split_audio_if_needed("/tmp/test.m4a", max_chunk_minutes=15)
+    def test_snap_boundaries_to_silence(self):
+        """Cut points move into the pause found in their analysis window."""
+        energy = np.full(1200, 1000.0, dtype=np.float32)  # 60s window at 50ms frames
+        energy[800:820] = 1.0  # pause 10s after the planned cut
 
-        assert result == ["/tmp/test.m4a"]
-        mock_audio_segment_cls.from_file.assert_called_once_with("/tmp/test.m4a")
+        with patch("app.audio_processor.compute_energy_envelope", return_value=energy) as mock_window:
+            result = snap_boundaries_to_silence("/tmp/a.m4a", [700.0], tolerance_seconds=30)
 
-    @patch("app.audio_processor.tempfile")
-    @patch("app.audio_processor.AudioSegment")
-    def test_split_audio_splits_large_file(
-        self, mock_audio_segment_cls, mock_tempfile
-    ):
-        """35-minute audio is split into 3 chunks (15 + 15 + 5)."""
-        total_duration_ms = 35 * 60 * 1000
-        chunk_duration_ms = 15 * 60 * 1000
+        mock_window.assert_called_once_with("/tmp/a.m4a", 670.0, 60.0)
+        assert 710.0 <= result[0] <= 711.0
 
-        mock_audio = MagicMock()
-        mock_audio.__len__ = Mock(return_value=total_duration_ms)
+    def test_snap_keeps_boundary_when_analysis_fails(self):
+        """An ffmpeg failure leaves the planned cut point unchanged."""
+        with patch(
+            "app.audio_processor.compute_energy_envelope",
+            side_effect=subprocess.CalledProcessError(1, ["ffmpeg"]),
+        ):
+            assert snap_boundaries_to_silence("/tmp/a.m4a", [700.0, 1400.0], 30) == [700.0, 1400.0]
 
-        # Each slice returns a mock chunk that supports export
-        mock_chunk = MagicMock()
-        mock_audio.__getitem__ = Mock(return_value=mock_chunk)
+    def test_snap_disabled(self):
+        """A zero tolerance returns the planned cut points without decoding."""
+        with patch("app.audio_processor.compute_energy_envelope") as mock_window:
+            assert snap_boundaries_to_silence("/tmp/a.m4a", [700.0], 0) == [700.0]
+        mock_window.assert_not_called()
 
-        mock_audio_segment_cls.from_file.return_value = mock_audio
 
-        mock_tempfile.mkdtemp.return_value = "/tmp/fake_chunks"
+class TestSplitAudio:
+    def _fake_ffmpeg(self, num_chunks, fail_copy=False):
+        """Build a subprocess.Popen stand-in that lists num_chunks segments on stdout."""
+        calls = []
+
+        def popen(cmd, **kwargs):
+            calls.append(cmd)
+            proc = MagicMock()
+            proc.__enter__.return_value = proc
+            if fail_copy and "copy" in cmd:
+                proc.stdout = iter([])
+                proc.stderr.read.return_value = b"codec not supported"
+                proc.returncode = 1
+            else:
+                pattern = os.path.basename(cmd[-1])
+                proc.stdout = iter(f"{pattern.replace('%d', str(i))}\n".encode() for i in range(num_chunks))
+                proc.stderr.read.return_value = b""
+                proc.returncode = 0
+            return proc
+
+        return popen, calls
+
+    def test_iter_audio_chunks_no_split_needed(self, tmp_audio_file):
+        """Audio shorter than max returns the original path without running ffmpeg."""
+        info = AudioInfo(duration_seconds=5 * 60, size_bytes=1024)
+
+        with patch("app.audio_processor.probe_audio", return_value=info), \
+                patch("app.audio_processor.subprocess.Popen") as mock_popen:
+            result = list(iter_audio_chunks(tmp_audio_file, max_chunk_minutes=15))
+
+        assert result == [AudioChunk(tmp_audio_file, 0.0, 300.0)]
+        mock_popen.assert_not_called()
+
+    def test_iter_audio_chunks_splits_large_file(self, tmp_audio_file):
+        """35-minute audio is segmented into 3 chunks without re-encoding."""
+        popen, calls = self._fake_ffmpeg(num_chunks=3)
+        info = AudioInfo(duration_seconds=35 * 60, size_bytes=16 * 1024 * 1024)
 
-        result = split_audio_if_needed("/tmp/long_audio.m4a", max_chunk_minutes=15)
+        with patch("app.audio_processor.probe_audio", return_value=info), \
+                patch("app.audio_processor.subprocess.Popen", side_effect=popen):
+            result = list(iter_audio_chunks(tmp_audio_file, max_chunk_minutes=15))
 
-        # 35 min / 15 min = 2 full chunks + 1 remainder = 3 chunks
         assert len(result) == 3
-        assert all(path.startswith("/tmp/fake_chunks/chunk_") for path in result)
-        assert all(path.endswith(".m4a") for path in result)
-
-        # Verify export was called for each chunk with format="ipod"
-        assert mock_chunk.export.call_count == 3
-        for call in mock_chunk.export.call_args_list:
-            assert call[1]["format"] == "ipod" or call[0][1] == "ipod"
-
-        # Verify slicing boundaries
-        slice_calls = mock_audio.__getitem__.call_args_list
-        assert len(slice_calls) == 3
-
-        # First chunk: 0 to 15 min
-        assert slice_calls[0][0][0] == slice(0, chunk_duration_ms)
-        # Second chunk: 15 min to 30 min
-        assert slice_calls[1][0][0] == slice(chunk_duration_ms, 2 * chunk_duration_ms)
-        # Third chunk: 30 min to 35 min
-        assert slice_calls[2][0][0] == slice(2 * chunk_duration_ms, total_duration_ms)
+        assert [os.path.basename(c.path) for c in result] == ["chunk_0.m4a", "chunk_1.m4a", "chunk_2.m4a"]
+        assert [(c.start_seconds, c.end_seconds) for c in result] == [
+            (0.0, 700.0), (700.0, 1400.0), (1400.0, 2100.0)
+        ]
+
+        cmd = calls[0]
+        assert cmd[cmd.index("-c:a") + 1] == "copy"
+        assert cmd[cmd.index("-f") + 1] == "segment"
+        assert cmd[cmd.index("-segment_times") + 1] == "700.000,1400.000"
+        assert cmd[cmd.index("-segment_list") + 1] == "pipe:1"
+
+    def test_iter_audio_chunks_falls_back_to_reencode(self, tmp_audio_file):
+        """If stream copy fails, segmenting is retried with an AAC encode."""
+        popen, calls = self._fake_ffmpeg(num_chunks=2, fail_copy=True)
+        info = AudioInfo(duration_seconds=20 * 60, size_bytes=1024)
+
+        with patch("app.audio_processor.probe_audio", return_value=info), \
+                patch("app.audio_processor.subprocess.Popen", side_effect=popen):
+            result = list(iter_audio_chunks(tmp_audio_file, max_chunk_minutes=15))
+
+        assert len(result) == 2
+        assert len(calls) == 2
+        assert calls[1][calls[1].index("-c:a") + 1] == "aac"
+
+    def test_iter_audio_chunks_writes_to_output_dir(self, tmp_audio_file, tmp_path):
+        """Chunks land in the caller's directory so its cleanup removes them."""
+        popen, calls = self._fake_ffmpeg(num_chunks=2)
+        info = AudioInfo(duration_seconds=20 * 60, size_bytes=1024)
+        output_dir = str(tmp_path / "job")
+
+        with patch("app.audio_processor.probe_audio", return_value=info), \
+                patch("app.audio_processor.subprocess.Popen", side_effect=popen):
+            result = list(iter_audio_chunks(tmp_audio_file, max_chunk_minutes=15, output_dir=output_dir))
+
+        assert [os.path.dirname(c.path) for c in result] == [output_dir, output_dir]
+        assert os.path.dirname(calls[0][-1]) == output_dir
+
+    def test_iter_audio_chunks_yields_as_written(self, tmp_audio_file):
+        """Chunks are yielded one at a time while ffmpeg is still running."""
+        popen, calls = self._fake_ffmpeg(num_chunks=3)
+        info = AudioInfo(duration_seconds=35 * 60, size_bytes=16 * 1024 * 1024)
+
+        with patch("app.audio_processor.probe_audio", return_value=info), \
+                patch("app.audio_processor.subprocess.Popen", side_effect=popen):
+            chunks = iter_audio_chunks(tmp_audio_file, max_chunk_minutes=15)
+            first = next(chunks)
+
+            assert os.path.basename(first.path) == "chunk_0.m4a"
+            assert len(calls) == 1
+            assert [os.path.basename(c.path) for c in chunks] == ["chunk_1.m4a", "chunk_2.m4a"]
+
+
+class TestTranscodeForUpload:
+    def _fake_ffmpeg(self, output_size):
+        def run(cmd, **kwargs):
+            with open(cmd[-1], "wb") as f:
+                f.write(b"\x00" * output_size)
+            return subprocess.CompletedProcess(cmd, 0)
+
+        return run
+
+    def test_transcode_shrinks_payload(self, tmp_audio_file):
+        """A smaller re-encode replaces the original for upload."""
+        with patch("app.audio_processor.subprocess.run", side_effect=self._fake_ffmpeg(256)) as mock_run:
+            result = transcode_for_upload(tmp_audio_file, codec="libopus", bitrate_kbps=24)
+
+        assert result.endswith("_upload.ogg")
+        assert os.path.getsize(result) == 256
+        cmd = mock_run.call_args[0][0]
+        assert cmd[cmd.index("-c:a") + 1] == "libopus"
+        assert cmd[cmd.index("-ac") + 1] == "1"
+        assert cmd[cmd.index("-ar") + 1] == "16000"
+
+    def test_transcode_keeps_smaller_original(self, tmp_audio_file):
+        """If the re-encode is not smaller, the original is kept and the output removed."""
+        with patch("app.audio_processor.subprocess.run", side_effect=self._fake_ffmpeg(4096)):
+            result = transcode_for_upload(tmp_audio_file)
+
+        assert result == tmp_audio_file
+        assert not os.path.exists(tmp_audio_file.replace(".m4a", "_upload.ogg"))
+
+    def test_transcode_unsupported_codec(self, tmp_audio_file):
+        with pytest.raises(ValueError, match="Unsupported"):
+            transcode_for_upload(tmp_audio_file, codec="pcm_s16le")
@@ -0,0 +1,77 @@
+"""Tests for clients module."""
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+import pytest
+import pytest_asyncio
+
+from app import clients
+from app.config import Settings
+
+
+@pytest.fixture
+def settings():
+    return Settings(
+        _env_file=None,
+        line_channel_secret="secret",
+        line_channel_access_token="token",
+        anthropic_api_key="key",
+        openai_api_key="openai-key",
+        client_pool_size=7,
+        audio_max_workers=3,
+    )
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def reset_clients():
+    yield
+    await clients.close_clients()
+
+
+@pytest.mark.asyncio
+async def test_init_builds_once_and_close_clears(settings):
+    """The registry is built once at startup and released at shutdown."""
+    first = clients.init_clients(settings)
+
+    assert clients.init_clients(settings) is first
+    assert clients.get_clients() is first
+    assert isinstance(first.http, httpx.AsyncClient)
+    assert first.line_api_client.configuration.connection_pool_maxsize == 7
+    assert first.audio_executor._max_workers == 3
+
+    await clients.close_clients()
+
+    assert clients.get_clients() is None
+    assert first.http.is_closed
+
+
+@pytest.mark.asyncio
+async def test_close_survives_failing_client(settings):
+    """One client failing to close does not stop the others from closing."""
+    shared = clients.init_clients(settings)
+    shared.openai = MagicMock()
+    shared.openai.close = AsyncMock(side_effect=RuntimeError("boom"))
+
+    await clients.close_clients()
+
+    assert shared.http.is_closed
+
+
+@pytest.mark.asyncio
+@patch("app.transcriber.openai.AsyncOpenAI")
+async def test_transcriber_reuses_shared_client(mock_openai_cls, settings, tmp_audio_file):
+    """With the registry up, Whisper calls go through the pooled client."""
+    from app.transcriber import transcribe_audio
+
+    shared = clients.init_clients(settings)
+    shared.openai = MagicMock()
+    shared.openai.close = AsyncMock()
+    shared.openai.audio.transcriptions.create = AsyncMock(return_value=MagicMock(text="轉錄結果"))
+    mock_openai_cls.reset_mock()
+
+    assert await transcribe_audio(tmp_audio_file, "openai-key") == "轉錄結果"
+    assert await transcribe_audio(tmp_audio_file, "openai-key") == "轉錄結果"
+
+    mock_openai_cls.assert_not_called()
+    assert shared.openai.audio.transcriptions.create.call_count == 2
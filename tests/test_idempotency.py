@@ -0,0 +1,32 @@
+"""Tests for idempotency module."""
+
+import time
+
+from app.idempotency import IdempotencyStore
+
+
+def test_duplicate_keys_detected_and_counted():
+    store = IdempotencyStore(":memory:", ttl_seconds=3600)
+
+    assert store.first_seen("event:e1", "message:m1")
+    assert not store.first_seen("event:e1", "message:m1")
+    assert not store.first_seen("event:e2", "message:m1")
+    assert store.first_seen("event:e3", "message:m2")
+
+    assert store.stats() == {"duplicates": 2, "entries": 5}
+
+
+def test_keys_expire_after_ttl():
+    store = IdempotencyStore(":memory:", ttl_seconds=0.05)
+    store.first_seen("message:m1")
+
+    time.sleep(0.1)
+
+    assert store.first_seen("message:m1")
+
+
+def test_survives_restart(tmp_path):
+    db_path = str(tmp_path / "idempotency.db")
+    IdempotencyStore(db_path, ttl_seconds=3600).first_seen("event:e1")
+
+    assert not IdempotencyStore(db_path, ttl_seconds=3600).first_seen("event:e1")
@@ -1,15 +1,22 @@
 """Integration tests for the FastAPI application."""
 
+import asyncio
+
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 from fastapi.testclient import TestClient
 
-from app.main import app
+from app.idempotency import IdempotencyStore
+from app.main import app, send_reply
 
 
 @pytest.fixture
 def client():
-    return TestClient(app)
+    app.state.job_queue = MagicMock()
+    app.state.idempotency = IdempotencyStore(":memory:", ttl_seconds=3600)
+    yield TestClient(app)
+    del app.state.job_queue
+    del app.state.idempotency
 
 
 class TestHealthEndpoint:
@@ -19,6 +26,17 @@ class TestHealthEndpoint:
         assert response.json() == {"status": "ok"}
 
 
+class TestStatsEndpoint:
+    def test_stats_reports_routing(self, client):
+        response = client.get("/stats")
+        assert response.status_code == 200
+        assert "routing" in response.json()
+        assert "jobs" in response.json()
+        assert "result_cache" in response.json()
+        assert "webhook_dedup" in response.json()
+        assert "rate_limits" in response.json()
+
+
 class TestWebhookCallback:
     def test_invalid_signature(self, client):
         """Request with invalid signature returns 400."""
@@ -32,10 +50,10 @@ class TestWebhookCallback:
         )
         assert response.status_code == 400
 
-    @patch("app.main.handle_audio_message")
+    @patch("app.main.handle_audio_messages")
     @patch("app.main.parser")
-    @patch("app.main.messaging_api")
-    def test_valid_audio_event(self, mock_messaging_api, mock_parser, mock_handler, client):
+    @patch("app.main.send_reply")
+    def test_valid_audio_event(self, mock_send_reply, mock_parser, mock_handler, client):
         """Valid audio event triggers handler."""
         mock_event = MagicMock()
         mock_event.type = "message"
@@ -59,7 +77,61 @@ class TestWebhookCallback:
         assert response.status_code == 200
         mock_handler.assert_called_once()
 
-    @patch("app.main.handle_audio_message")
+    @patch("app.main.handle_audio_messages")
+    @patch("app.main.parser")
+    @patch("app.main.send_reply")
+    def test_redelivered_event_not_queued_twice(self, mock_send_reply, mock_parser, mock_handler, client):
+        """A redelivery, or another event for the same message, is acked without new work."""
+        def audio_event(event_id, redelivery):
+            event = MagicMock()
+            event.type = "message"
+            event.message.type = "audio"
+            event.message.id = "msg_test"
+            event.webhook_event_id = event_id
+            event.delivery_context.is_redelivery = redelivery
+            return event
+
+        headers = {"X-Line-Signature": "valid", "Content-Type": "application/json"}
+        for events in (
+            [audio_event("evt_1", False)],
+            [audio_event("evt_1", True)],
+            [audio_event("evt_2", False)],
+        ):
+            mock_parser.parse.return_value = events
+            response = client.post("/callback", content='{"events": []}', headers=headers)
+            assert response.status_code == 200
+
+        mock_handler.assert_called_once()
+        assert client.get("/stats").json()["webhook_dedup"]["duplicates"] == 2
+
+    @patch("app.main.handle_audio_messages")
+    @patch("app.main.parser")
+    @patch("app.main.send_reply")
+    def test_payload_grouped_by_user(self, mock_send_reply, mock_parser, mock_handler, client):
+        """Audio events in one payload are handed over once per user, in order."""
+        def audio_event(user_id, message_id):
+            event = MagicMock()
+            event.type = "message"
+            event.source.user_id = user_id
+            event.message.type = "audio"
+            event.message.id = message_id
+            event.webhook_event_id = f"evt_{message_id}"
+            return event
+
+        events = [audio_event("U_a", "m1"), audio_event("U_b", "m2"), audio_event("U_a", "m3")]
+        mock_parser.parse.return_value = events
+        mock_handler.return_value = 1
+
+        response = client.post(
+            "/callback",
+            content='{"events": []}',
+            headers={"X-Line-Signature": "valid", "Content-Type": "application/json"},
+        )
+
+        assert response.status_code == 200
+        assert [c[0][0] for c in mock_handler.call_args_list] == [[events[0], events[2]], [events[1]]]
+
+    @patch("app.main.handle_audio_messages")
     @patch("app.main.parser")
     def test_non_audio_event_ignored(self, mock_parser, mock_handler, client):
         """Non-audio message events are ignored."""
@@ -82,10 +154,10 @@ class TestWebhookCallback:
         assert response.status_code == 200
         mock_handler.assert_not_called()
 
-    @patch("app.main.handle_audio_message")
+    @patch("app.main.handle_audio_messages")
     @patch("app.main.parser")
-    @patch("app.main.messaging_api")
-    def test_file_m4a_treated_as_audio(self, mock_messaging_api, mock_parser, mock_handler, client):
+    @patch("app.main.send_reply")
+    def test_file_m4a_treated_as_audio(self, mock_send_reply, mock_parser, mock_handler, client):
         """M4A file shared via LINE file message triggers audio handler."""
         mock_event = MagicMock()
         mock_event.type = "message"
@@ -109,7 +181,7 @@ class TestWebhookCallback:
         assert response.status_code == 200
         mock_handler.assert_called_once()
 
-    @patch("app.main.handle_audio_message")
+    @patch("app.main.handle_audio_messages")
     @patch("app.main.parser")
     def test_file_non_audio_ignored(self, mock_parser, mock_handler, client):
         """Non-audio file (e.g. PDF) is ignored."""
@@ -131,3 +203,23 @@ class TestWebhookCallback:
 
         assert response.status_code == 200
         mock_handler.assert_not_called()
+
+
+class TestSendReply:
+    @pytest.mark.asyncio
+    async def test_reply_sent_in_background(self):
+        """send_reply returns at once and the reply goes out on the async client."""
+        clients = MagicMock()
+        clients.messaging_api = AsyncMock()
+
+        with patch("app.main.get_clients", return_value=clients):
+            send_reply("reply_token", "已收到")
+            clients.messaging_api.reply_message.assert_not_called()
+            await asyncio.sleep(0)
+
+        request = clients.messaging_api.reply_message.call_args[0][0]
+        assert request.reply_token == "reply_token"
+
+    def test_reply_dropped_without_clients(self):
+        with patch("app.main.get_clients", return_value=None):
+            send_reply("reply_token", "已收到")
@@ -0,0 +1,413 @@
+"""Tests for job_queue module."""
+
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+from app.job_queue import JobQueue, QueueFullError, WorkerPool
+
+
+def test_enqueue_and_claim_in_order():
+    """Jobs are claimed oldest first and marked as downloading."""
+    queue = JobQueue(":memory:")
+    queue.enqueue("U1", "m1")
+    queue.enqueue("U2", "m2", priority="high")
+
+    first = queue.claim()
+    second = queue.claim()
+
+    assert (first.message_id, first.state, first.attempts) == ("m1", "downloading", 1)
+    assert (second.message_id, second.priority) == ("m2", "high")
+    assert queue.claim() is None
+
+
+def test_duplicate_message_not_queued_twice():
+    """A redelivered message returns the existing job."""
+    queue = JobQueue(":memory:")
+    job = queue.enqueue("U1", "m1")
+
+    assert queue.enqueue("U1", "m1").id == job.id
+    assert queue.counts()["queued"] == 1
+
+
+def test_admission_control():
+    """Queued and in-flight jobs count against max_pending; finished ones do not."""
+    queue = JobQueue(":memory:", max_pending=2)
+    queue.enqueue("U1", "m1")
+    queue.enqueue("U1", "m2")
+    running = queue.claim()
+
+    with pytest.raises(QueueFullError):
+        queue.enqueue("U1", "m3")
+
+    queue.set_state(running.id, "sent")
+    queue.enqueue("U1", "m3")
+
+
+def test_unknown_state_rejected():
+    queue = JobQueue(":memory:")
+    job = queue.enqueue("U1", "m1")
+
+    with pytest.raises(ValueError):
+        queue.set_state(job.id, "lost")
+
+
+def test_batch_claimed_as_one_job():
+    """Recordings queued into a batch are leased together."""
+    queue = JobQueue(":memory:")
+    first = queue.enqueue("U1", "m1")
+    queue.enqueue("U1", "m2", batch_id=first.id)
+    queue.enqueue("U2", "m3")
+
+    job = queue.claim()
+
+    assert (job.id, job.message_ids, job.attempts) == (first.id, ("m1", "m2"), 1)
+    assert queue.claim().message_ids == ("m3",)
+    assert queue.counts()["downloading"] == 3
+
+
+def test_batch_window_groups_same_user_only():
+    """Within the window a user's recordings join one job; other users get their own."""
+    queue = JobQueue(":memory:", batch_window_seconds=0.05)
+    first = queue.enqueue("U1", "m1")
+    assert queue.enqueue("U1", "m2").id == first.id
+    assert queue.enqueue("U2", "m3").id != first.id
+
+    assert queue.claim() is None
+    time.sleep(0.06)
+    assert queue.claim().message_ids == ("m1", "m2")
+    assert queue.enqueue("U1", "m4").id != first.id
+
+
+def test_batch_does_not_grow_past_max_size():
+    queue = JobQueue(":memory:", batch_max_size=2)
+    first = queue.enqueue("U1", "m1")
+    queue.enqueue("U1", "m2", batch_id=first.id)
+
+    assert queue.enqueue("U1", "m3", batch_id=first.id).id != first.id
+
+
+def test_retry_only_redoes_unfinished_recordings():
+    """A recording finished before its batch failed is not run again."""
+    queue = JobQueue(":memory:")
+    first = queue.enqueue("U1", "m1")
+    queue.enqueue("U1", "m2", batch_id=first.id)
+    job = queue.claim()
+
+    assert queue.set_state(job.id, "sent", message_id="m1")
+    queue.retry(job.id, "overloaded", delay_seconds=0)
+    retried = queue.claim()
+
+    assert (retried.message_ids, retried.attempts) == (("m2",), 2)
+    queue.set_state(retried.id, "failed")
+    assert queue.counts()["sent"] == 1
+    assert queue.counts()["failed"] == 1
+
+
+def test_claims_are_fair_between_users():
+    """A user with a backlog does not hold up another user's recording."""
+    queue = JobQueue(":memory:")
+    for n in range(3):
+        queue.enqueue("U1", f"long{n}")
+    queue.enqueue("U2", "memo")
+
+    claimed = [queue.claim() for _ in range(2)]
+
+    assert [job.message_id for job in claimed] == ["long0", "memo"]
+
+
+def test_least_recently_served_user_goes_first():
+    """A user who has not been served yet overtakes an older job of one who has."""
+    queue = JobQueue(":memory:")
+    queue.enqueue("U1", "a1")
+    queue.enqueue("U1", "a2")
+    queue.enqueue("U2", "b1")
+
+    job = queue.claim()
+    assert job.message_id == "a1"
+    queue.set_state(job.id, "sent")
+
+    assert [queue.claim().message_id for _ in range(2)] == ["b1", "a2"]
+
+
+def test_claim_purges_finished_jobs_past_retention():
+    queue = JobQueue(":memory:", retention_seconds=0)
+    done = queue.enqueue("U1", "done")
+    queue.set_state(queue.claim().id, "sent")
+    batch = queue.enqueue("U1", "batch_done")
+    queue.enqueue("U1", "batch_pending", batch_id=batch.id)
+    queue.set_state(queue.claim().id, "sent", message_id="batch_done")
+    queue.enqueue("U2", "waiting")
+    queue._purged_at = 0.0
+    time.sleep(0.01)
+
+    queue.claim()
+
+    assert queue.get(done.id) is None
+    assert queue.get(batch.id).message_ids == ("batch_done", "batch_pending")
+    assert queue.counts()["sent"] == 1
+
+
+def test_fast_lane_claim_skips_long_and_unknown_jobs():
+    queue = JobQueue(":memory:")
+    queue.enqueue("U1", "long", duration_seconds=3600)
+    queue.enqueue("U1", "unknown")
+    first = queue.enqueue("U2", "short", duration_seconds=60)
+    queue.enqueue("U2", "short_too", batch_id=first.id, duration_seconds=120)
+
+    assert queue.claim(max_duration_seconds=300).message_ids == ("short", "short_too")
+    assert queue.claim(max_duration_seconds=300) is None
+    assert queue.claim().message_id == "long"
+
+
+def test_expired_lease_reclaimed_by_another_node(tmp_path):
+    """A job held by a node that stopped heartbeating is taken over by another."""
+    db_path = str(tmp_path / "jobs.db")
+    crashed = JobQueue(db_path, node_id="a", lease_seconds=0.05)
+    survivor = JobQueue(db_path, node_id="b")
+    job = crashed.enqueue("U1", "m1")
+    crashed.claim()
+
+    assert survivor.claim() is None
+    time.sleep(0.1)
+    reclaimed = survivor.claim()
+
+    assert (reclaimed.id, reclaimed.attempts) == (job.id, 2)
+    assert not crashed.heartbeat(job.id)
+    assert not crashed.set_state(job.id, "sent")
+    assert survivor.set_state(job.id, "sent")
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    owner = JobQueue(db_path, node_id="a", lease_seconds=0.1)
+    other = JobQueue(db_path, node_id="b")
+    owner.enqueue("U1", "m1")
+    job = owner.claim()
+
+    for _ in range(3):
+        time.sleep(0.05)
+        assert owner.heartbeat(job.id)
+        assert other.claim() is None
+
+
+def test_gives_up_after_max_attempts(tmp_path):
+    """A job whose lease expired max_attempts times is failed instead of retried forever."""
+    queue = JobQueue(str(tmp_path / "jobs.db"), max_attempts=1, lease_seconds=0)
+    job = queue.enqueue("U1", "m1")
+    queue.claim()
+
+    assert queue.claim() is None
+    assert queue.get(job.id).state == "failed"
+
+
+def test_release_requeues_without_counting_attempt():
+    queue = JobQueue(":memory:")
+    job = queue.enqueue("U1", "m1")
+    queue.claim()
+
+    queue.release(job.id)
+
+    assert queue.get(job.id).state == "queued"
+    assert queue.claim().attempts == 1
+
+
+def test_opens_database_without_lease_columns(tmp_path):
+    """A job database from before leases existed is migrated on open."""
+    db_path = str(tmp_path / "jobs.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, "
+        "message_id TEXT NOT NULL UNIQUE, priority TEXT NOT NULL DEFAULT 'normal', state TEXT NOT NULL, "
+        "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+    )
+    conn.execute(
+        "INSERT INTO jobs (user_id, message_id, state, created_at, updated_at) VALUES ('U1', 'm1', 'queued', 0, 0)"
+    )
+    conn.commit()
+    conn.close()
+
+    job = JobQueue(db_path).claim()
+    assert (job.message_id, job.message_ids) == ("m1", ("m1",))
+
+
+_REPLICA_SCRIPT = """
+import asyncio, sys
+from app.job_queue import JobQueue, WorkerPool
+
+async def handler(job, on_state):
+    on_state("transcribing")
+    await asyncio.sleep(0.02)
+    return True
+
+async def main():
+    queue = JobQueue(sys.argv[1], node_id=sys.argv[2], lease_seconds=5)
+    pool = WorkerPool(queue, handler, workers=2, poll_seconds=0.01, heartbeat_seconds=1)
+    pool.start()
+    while True:
+        counts = queue.counts()
+        if counts["sent"] == int(sys.argv[3]):
+            break
+        await asyncio.sleep(0.02)
+    await pool.stop()
+
+asyncio.run(main())
+"""
+
+
+def test_replicas_share_one_store(tmp_path):
+    """Several processes drain one queue, and each job runs exactly once."""
+    db_path = str(tmp_path / "jobs.db")
+    queue = JobQueue(db_path, max_pending=100)
+    jobs = [queue.enqueue("U1", f"m{n}") for n in range(30)]
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    replicas = [
+        subprocess.Popen(
+            [sys.executable, "-c", _REPLICA_SCRIPT, db_path, f"node-{n}", str(len(jobs))], cwd=root
+        )
+        for n in range(3)
+    ]
+    for replica in replicas:
+        assert replica.wait(timeout=60) == 0
+
+    rows = sqlite3.connect(db_path).execute("SELECT state, attempts, lease_owner FROM jobs").fetchall()
+    assert all(state == "sent" and attempts == 1 for state, attempts, _ in rows)
+    assert len({owner for _, _, owner in rows}) > 1
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_runs_jobs_and_records_states():
+    """Workers report pipeline progress and mark jobs sent or failed."""
+    queue = JobQueue(":memory:", max_attempts=1)
+    seen = []
+
+    async def handler(job, on_state):
+        on_state("transcribing")
+        seen.append(queue.get(job.id).state)
+        if job.message_id == "boom":
+            raise RuntimeError("crash")
+        return job.message_id == "ok"
+
+    ok = queue.enqueue("U1", "ok")
+    failed = queue.enqueue("U1", "bad")
+    crashed = queue.enqueue("U1", "boom")
+
+    pool = WorkerPool(queue, handler, workers=2, poll_seconds=0.01)
+    pool.start()
+    for _ in range(100):
+        if queue.counts()["sent"] + queue.counts()["failed"] == 3:
+            break
+        await asyncio.sleep(0.01)
+    await pool.stop()
+
+    assert seen == ["transcribing"] * 3
+    assert queue.get(ok.id).state == "sent"
+    assert queue.get(failed.id).state == "failed"
+    assert queue.get(crashed.id).state == "failed"
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_retries_failed_job_after_delay():
+    """A handler that raises gets its job run again, after a backoff."""
+    queue = JobQueue(":memory:", max_attempts=2)
+    attempts = []
+
+    async def handler(job, on_state):
+        attempts.append((job.attempts, time.monotonic()))
+        if job.attempts == 1:
+            raise RuntimeError("anthropic overloaded")
+        return True
+
+    job = queue.enqueue("U1", "m1")
+    pool = WorkerPool(queue, handler, workers=1, poll_seconds=0.01, retry_delay_seconds=0.1)
+    pool.start()
+    for _ in range(100):
+        if queue.get(job.id).state == "sent":
+            break
+        await asyncio.sleep(0.01)
+    await pool.stop()
+
+    assert queue.get(job.id).state == "sent"
+    assert [n for n, _ in attempts] == [1, 2]
+    assert attempts[1][1] - attempts[0][1] >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_bounds_concurrency_and_releases_on_stop():
+    """No more than `workers` jobs run at once, and stopping hands them back."""
+    queue = JobQueue(":memory:")
+    started = []
+
+    async def handler(job, on_state):
+        started.append(job.id)
+        await asyncio.sleep(60)
+        return True
+
+    for n in range(3):
+        queue.enqueue("U1", f"m{n}")
+
+    pool = WorkerPool(queue, handler, workers=2, poll_seconds=0.01)
+    pool.start()
+    await asyncio.sleep(0.05)
+    await pool.stop()
+
+    assert len(started) == 2
+    assert queue.counts()["queued"] == 3
+    assert queue.claim().attempts == 1
+
+
+@pytest.mark.asyncio
+async def test_fast_lane_worker_runs_short_job_while_others_are_busy():
+    """A short memo starts at once even though long recordings fill the general workers."""
+    queue = JobQueue(":memory:")
+    started = []
+
+    async def handler(job, on_state):
+        started.append(job.message_id)
+        await asyncio.sleep(60)
+        return True
+
+    queue.enqueue("U1", "long1", duration_seconds=3600)
+    queue.enqueue("U1", "long2", duration_seconds=3600)
+    queue.enqueue("U2", "short", duration_seconds=30)
+
+    pool = WorkerPool(queue, handler, workers=2, poll_seconds=0.01, fast_lane_workers=1, fast_lane_max_seconds=300)
+    pool.start()
+    await asyncio.sleep(0.05)
+    await pool.stop()
+
+    assert sorted(started) == ["long1", "short"]
+
+
+@pytest.mark.asyncio
+async def test_worker_abandons_job_when_lease_lost(tmp_path):
+    """A worker whose lease was taken over stops its run instead of finishing twice."""
+    db_path = str(tmp_path / "jobs.db")
+    queue = JobQueue(db_path, node_id="a", lease_seconds=0.05)
+    other = JobQueue(db_path, node_id="b", lease_seconds=60)
+    cancelled = asyncio.Event()
+
+    async def handler(job, on_state):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return True
+
+    job = queue.enqueue("U1", "m1")
+    pool = WorkerPool(queue, handler, workers=1, poll_seconds=0.01, heartbeat_seconds=0.2)
+    pool.start()
+    await asyncio.sleep(0.1)
+    assert other.claim().id == job.id
+    await asyncio.wait_for(cancelled.wait(), timeout=2)
+    await pool.stop()
+
+    assert other.get(job.id).state == "downloading"
+    assert other.set_state(job.id, "sent")
@@ -1,13 +1,19 @@
 """Tests for line_handler module."""
 
 import pytest
-from unittest.mock import MagicMock, patch, Mock, AsyncMock
+from types import SimpleNamespace
+from unittest.mock import MagicMock
 
-from app.line_handler import handle_audio_message
-from app import pipeline
+from app.job_queue import JobQueue
+from app.line_handler import (
+    QUEUE_BUSY_MESSAGE,
+    estimate_duration_seconds,
+    handle_audio_messages,
+    job_priority,
+)
 
 
-class TestHandleAudioMessage:
+class TestHandleAudioMessages:
     def _make_event(self, user_id="U123", message_id="msg456"):
         """Create a mock MessageEvent with the given user_id and message_id."""
         event = MagicMock()
@@ -15,27 +21,85 @@ class TestHandleAudioMessage:
         event.message.id = message_id
         return event
 
-    def test_handle_audio_message_replies_immediately(self):
+    def test_handle_audio_messages_replies_immediately(self):
         """Verify reply_func is called with the acknowledgement message."""
         event = self._make_event()
         reply_func = MagicMock()
-        background_tasks = MagicMock()
 
-        handle_audio_message(event, reply_func, background_tasks)
+        handle_audio_messages([event], reply_func, JobQueue(":memory:"))
 
         reply_func.assert_called_once()
         call_text = reply_func.call_args[0][0]
         assert "已收到語音訊息" in call_text
         assert "處理中" in call_text
 
-    def test_handle_audio_message_adds_background_task(self):
-        """Verify background_tasks.add_task is called with the pipeline function."""
+    def test_handle_audio_messages_queues_job(self):
+        """Verify the recording is queued for the worker pool."""
         event = self._make_event()
+        job_queue = JobQueue(":memory:")
+
+        assert handle_audio_messages([event], MagicMock(), job_queue) == 1
+
+        job = job_queue.claim()
+        assert (job.user_id, job.message_id) == ("U123", "msg456")
+
+    def test_handle_audio_messages_replies_busy_when_full(self):
+        """A full queue turns the recording away with a busy reply."""
+        job_queue = JobQueue(":memory:", max_pending=1)
+        handle_audio_messages([self._make_event(message_id="first")], MagicMock(), job_queue)
+        reply_func = MagicMock()
+
+        assert handle_audio_messages([self._make_event(message_id="second")], reply_func, job_queue) == 0
+
+        reply_func.assert_called_once_with(QUEUE_BUSY_MESSAGE)
+        assert job_queue.counts()["queued"] == 1
+
+    def test_handle_audio_messages_queues_one_job_with_one_reply(self):
+        """Recordings sent together become one job and one acknowledgement."""
+        events = [self._make_event(message_id=f"msg{n}") for n in range(3)]
+        job_queue = JobQueue(":memory:")
+        reply_func = MagicMock()
+
+        assert handle_audio_messages(events, reply_func, job_queue) == 3
+
+        reply_func.assert_called_once()
+        assert "3 則語音訊息" in reply_func.call_args[0][0]
+        assert job_queue.claim().message_ids == ("msg0", "msg1", "msg2")
+
+    def test_handle_audio_messages_counts_turned_away(self):
+        """When the queue fills mid-batch the reply says how many were not taken."""
+        events = [self._make_event(message_id=f"msg{n}") for n in range(3)]
         reply_func = MagicMock()
-        background_tasks = MagicMock()
 
-        handle_audio_message(event, reply_func, background_tasks)
+        assert handle_audio_messages(events, reply_func, JobQueue(":memory:", max_pending=2)) == 2
+
+        text = reply_func.call_args[0][0]
+        assert "2 則語音訊息" in text
+        assert "另有 1 則" in text
+
+    def test_handle_audio_messages_queues_with_priority(self):
+        job_queue = JobQueue(":memory:")
+
+        handle_audio_messages([self._make_event()], MagicMock(), job_queue, priority="high")
+
+        assert job_queue.claim().priority == "high"
+
+
+def test_job_priority_from_user_lists():
+    settings = SimpleNamespace(high_priority_users="Uboss, Uceo", low_priority_users="Ubot")
+
+    assert job_priority("Uceo", settings) == "high"
+    assert job_priority("Ubot", settings) == "low"
+    assert job_priority("U123", settings) == "normal"
+    assert job_priority("", SimpleNamespace(high_priority_users="", low_priority_users="")) == "normal"
+
+
+class TestEstimateDuration:
+    def test_audio_message_duration(self):
+        assert estimate_duration_seconds(SimpleNamespace(duration=90_000)) == 90.0
+
+    def test_file_estimated_from_size(self):
+        assert estimate_duration_seconds(SimpleNamespace(file_size=1_600_000)) == 100.0
 
-        background_tasks.add_task.assert_called_once_with(
-            pipeline.process_audio_pipeline, "U123", "msg456"
-        )
+    def test_unknown(self):
+        assert estimate_duration_seconds(SimpleNamespace()) is None
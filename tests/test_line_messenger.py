@@ -1,9 +1,19 @@
 """Tests for line_messenger module."""
 
 import pytest
-from unittest.mock import MagicMock, call
+from unittest.mock import AsyncMock, call
 
-from app.line_messenger import split_text, send_text_to_user
+from linebot.v3.messaging import ApiException
+
+from app.line_messenger import push_messages, reply_text, split_text, send_text_to_user
+from app.rate_limit import RateLimiter, _limiters
+
+
+@pytest.fixture
+def line_limiter(monkeypatch):
+    limiter = RateLimiter("line", base_delay_seconds=0.001)
+    monkeypatch.setitem(_limiters, "line", limiter)
+    return limiter
 
 
 class TestSplitText:
@@ -53,10 +63,11 @@ class TestSplitText:
 
 
 class TestSendTextToUser:
-    def test_send_text_short_message(self):
+    @pytest.mark.asyncio
+    async def test_send_text_short_message(self):
         """Short text sends a single push with one TextMessage."""
-        mock_api = MagicMock()
-        send_text_to_user("U_user1", "Hello!", mock_api)
+        mock_api = AsyncMock()
+        await send_text_to_user("U_user1", "Hello!", mock_api)
 
         mock_api.push_message.assert_called_once()
         push_call = mock_api.push_message.call_args
@@ -65,13 +76,14 @@ class TestSendTextToUser:
         assert len(request.messages) == 1
         assert request.messages[0].text == "Hello!"
 
-    def test_send_text_long_message_with_pages(self):
+    @pytest.mark.asyncio
+    async def test_send_text_long_message_with_pages(self):
         """Long text that splits into 3 parts has page numbers appended."""
-        mock_api = MagicMock()
+        mock_api = AsyncMock()
 
         # Create text that will split into 3 parts via paragraph breaks
         text = "A" * 4000 + "\n\n" + "B" * 4000 + "\n\n" + "C" * 4000
-        send_text_to_user("U_user2", text, mock_api)
+        await send_text_to_user("U_user2", text, mock_api)
 
         # All 3 messages fit in one push (< 5 limit)
         mock_api.push_message.assert_called_once()
@@ -81,9 +93,10 @@ class TestSendTextToUser:
         assert request.messages[1].text.endswith("(2/3)")
         assert request.messages[2].text.endswith("(3/3)")
 
-    def test_send_text_batching(self):
+    @pytest.mark.asyncio
+    async def test_send_text_batching(self):
         """7 segments are sent in 2 batches: 5 + 2."""
-        mock_api = MagicMock()
+        mock_api = AsyncMock()
 
         # Use split_text with a small max_length to generate 7 segments
         # Build text: 7 segments of 90 chars separated by "\n\n"
@@ -100,7 +113,7 @@ class TestSendTextToUser:
         # Now test the actual send function by mocking split_text
         from unittest.mock import patch
         with patch("app.line_messenger.split_text", return_value=segments):
-            send_text_to_user("U_user3", text, mock_api)
+            await send_text_to_user("U_user3", text, mock_api)
 
         assert mock_api.push_message.call_count == 2
         # First batch: 5 messages
@@ -109,3 +122,57 @@ class TestSendTextToUser:
         # Second batch: 2 messages
         second_request = mock_api.push_message.call_args_list[1][0][0]
         assert len(second_request.messages) == 2
+
+
+class TestPushMessages:
+    @pytest.mark.asyncio
+    async def test_retry_reuses_retry_key(self, line_limiter):
+        """A push retried after a 5xx carries the same retry key, and LINE's 409 for it counts as delivered."""
+        messaging_api = AsyncMock()
+        messaging_api.push_message.side_effect = [ApiException(status=500), ApiException(status=409)]
+
+        await push_messages("U_user", ["第一則", "第二則"], messaging_api)
+
+        keys = [c.kwargs["x_line_retry_key"] for c in messaging_api.push_message.call_args_list]
+        assert len(keys) == 2 and keys[0] == keys[1]
+        assert len(messaging_api.push_message.call_args[0][0].messages) == 2
+        assert line_limiter.stats()["retries"] == 1
+
+    @pytest.mark.asyncio
+    async def test_each_push_gets_its_own_retry_key(self):
+        messaging_api = AsyncMock()
+
+        await push_messages("U_user", ["一"], messaging_api)
+        await push_messages("U_user", ["一"], messaging_api)
+
+        keys = {c.kwargs["x_line_retry_key"] for c in messaging_api.push_message.call_args_list}
+        assert len(keys) == 2
+
+
+class TestReplyText:
+    @pytest.mark.asyncio
+    async def test_reply_text(self):
+        messaging_api = AsyncMock()
+
+        await reply_text("token", "已收到", messaging_api)
+
+        request = messaging_api.reply_message.call_args[0][0]
+        assert request.reply_token == "token"
+        assert request.messages[0].text == "已收到"
+
+    @pytest.mark.asyncio
+    async def test_reply_text_swallows_errors(self):
+        messaging_api = AsyncMock()
+        messaging_api.reply_message.side_effect = RuntimeError("expired token")
+
+        await reply_text("token", "已收到", messaging_api)
+
+    @pytest.mark.asyncio
+    async def test_reply_text_not_retried(self, line_limiter):
+        """A reply cannot carry a retry key, so a failed one is not sent again."""
+        messaging_api = AsyncMock()
+        messaging_api.reply_message.side_effect = ApiException(status=500)
+
+        await reply_text("token", "已收到", messaging_api)
+
+        assert messaging_api.reply_message.call_count == 1
@@ -1,108 +1,130 @@
 """Tests for pipeline module."""
 
-from unittest.mock import MagicMock, patch, Mock
+import asyncio
+import hashlib
+import os
+import threading
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch, Mock
 
-from app.pipeline import process_audio_pipeline
+from app.audio_processor import AudioChunk, AudioValidationError
+from app.config import Settings
+from app.pipeline import PreviewTask, SectionPusher, process_audio_pipeline, process_batch
+from app.result_cache import ResultCache
+from app.summarizer import PROMPT_VERSION
+from app.stages import run_stages
+
+
+def _make_settings(**overrides) -> Settings:
+    values = dict(
+        line_channel_secret="secret",
+        line_channel_access_token="token",
+        anthropic_api_key="key",
+        openai_api_key="openai-key",
+        claude_model="claude-sonnet-4-5-20250929",
+        claude_max_tokens=4096,
+        max_audio_size_mb=100,
+        upload_transcode_enabled=False,
+    )
+    values.update(overrides)
+    return Settings(_env_file=None, **values)
+
+
+@pytest.fixture(autouse=True)
+def workspace_root(tmp_path, monkeypatch):
+    root = tmp_path / "workspaces"
+    monkeypatch.setenv("WORKSPACE_DIR", str(root))
+    return root
+
+
+def _chunks(*paths: str, seconds: float = 600.0) -> list[AudioChunk]:
+    return [AudioChunk(path, i * seconds, (i + 1) * seconds) for i, path in enumerate(paths)]
 
 
 @patch("app.pipeline.send_text_to_user")
-@patch("app.pipeline.generate_meeting_notes")
-@patch("app.pipeline.transcribe_audio")
-@patch("app.pipeline.split_audio_if_needed")
-@patch("app.pipeline.validate_audio")
-@patch("app.pipeline.download_audio")
-@patch("app.pipeline.MessagingApiBlob")
-@patch("app.pipeline.MessagingApi")
-@patch("app.pipeline.ApiClient")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
 @patch("app.pipeline.Configuration")
 @patch("app.pipeline.get_settings")
-def test_pipeline_full_success(
+@pytest.mark.asyncio
+async def test_pipeline_full_success(
     mock_settings, mock_config, mock_api_client, mock_messaging_api,
-    mock_blob_api, mock_download, mock_validate, mock_split,
+    mock_stream, mock_split,
     mock_transcribe, mock_generate, mock_send
 ):
-    """Full pipeline succeeds: download → validate → transcribe → generate → send."""
-    settings = MagicMock()
-    settings.line_channel_access_token = "token"
-    settings.max_audio_size_mb = 100
-    settings.claude_model = "claude-sonnet-4-5-20250929"
-    settings.claude_max_tokens = 4096
-    settings.anthropic_api_key = "key"
-    settings.openai_api_key = "openai-key"
-    mock_settings.return_value = settings
-
-    mock_download.return_value = b"audio_data"
-    mock_split.return_value = ["/tmp/audio.m4a"]
+    """Full pipeline succeeds: stream download → transcribe → generate → send."""
+    mock_settings.return_value = _make_settings()
+
+    mock_stream.return_value = 1024
+    mock_split.return_value = _chunks("/tmp/audio.m4a")
     mock_transcribe.return_value = "這是轉錄的文字"
     mock_generate.return_value = "## 會議摘要\n測試結果"
 
-    process_audio_pipeline("U_user", "msg_123")
+    states = []
+    assert await process_audio_pipeline("U_user", "msg_123", on_state=states.append) is True
 
-    mock_download.assert_called_once()
-    mock_validate.assert_called_once_with(b"audio_data", 100)
+    assert states == ["downloading", "transcribing", "summarizing"]
+    mock_stream.assert_called_once()
+    args = mock_stream.call_args[0]
+    assert args[0] == "msg_123"
+    assert args[1] == "token"
+    assert args[2].endswith("audio.m4a")
+    assert args[3] == 100
+    assert mock_split.call_args.kwargs["output_dir"] == os.path.dirname(args[2])
     mock_transcribe.assert_called_once()
     mock_generate.assert_called_once()
     mock_send.assert_called_once_with("U_user", "## 會議摘要\n測試結果", mock_messaging_api.return_value)
 
 
 @patch("app.pipeline.send_text_to_user")
-@patch("app.pipeline.generate_meeting_notes")
-@patch("app.pipeline.transcribe_audio")
-@patch("app.pipeline.split_audio_if_needed")
-@patch("app.pipeline.validate_audio")
-@patch("app.pipeline.download_audio")
-@patch("app.pipeline.MessagingApiBlob")
-@patch("app.pipeline.MessagingApi")
-@patch("app.pipeline.ApiClient")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
 @patch("app.pipeline.Configuration")
 @patch("app.pipeline.get_settings")
-def test_pipeline_empty_result(
+@pytest.mark.asyncio
+async def test_pipeline_empty_result(
     mock_settings, mock_config, mock_api_client, mock_messaging_api,
-    mock_blob_api, mock_download, mock_validate, mock_split,
+    mock_stream, mock_split,
     mock_transcribe, mock_generate, mock_send
 ):
     """Pipeline handles empty result from Claude."""
-    settings = MagicMock()
-    settings.line_channel_access_token = "token"
-    settings.max_audio_size_mb = 100
-    settings.claude_model = "claude-sonnet-4-5-20250929"
-    settings.claude_max_tokens = 4096
-    settings.anthropic_api_key = "key"
-    settings.openai_api_key = "openai-key"
-    mock_settings.return_value = settings
-
-    mock_download.return_value = b"audio_data"
-    mock_split.return_value = ["/tmp/audio.m4a"]
+    mock_settings.return_value = _make_settings()
+
+    mock_stream.return_value = 1024
+    mock_split.return_value = _chunks("/tmp/audio.m4a")
     mock_transcribe.return_value = "這是轉錄的文字"
     mock_generate.return_value = "無法生成會議記錄。"
 
-    process_audio_pipeline("U_user", "msg_123")
+    await process_audio_pipeline("U_user", "msg_123")
 
     mock_send.assert_called_once_with("U_user", "無法生成會議記錄。", mock_messaging_api.return_value)
 
 
 @patch("app.pipeline.send_text_to_user")
-@patch("app.pipeline.validate_audio")
-@patch("app.pipeline.download_audio")
-@patch("app.pipeline.MessagingApiBlob")
-@patch("app.pipeline.MessagingApi")
-@patch("app.pipeline.ApiClient")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
 @patch("app.pipeline.Configuration")
 @patch("app.pipeline.get_settings")
-def test_pipeline_validation_error(
+@pytest.mark.asyncio
+async def test_pipeline_validation_error(
     mock_settings, mock_config, mock_api_client, mock_messaging_api,
-    mock_blob_api, mock_download, mock_validate, mock_send
+    mock_stream, mock_send
 ):
     """Pipeline sends error message on validation failure."""
-    settings = MagicMock()
-    settings.line_channel_access_token = "token"
-    settings.max_audio_size_mb = 100
-    mock_settings.return_value = settings
+    mock_settings.return_value = _make_settings()
 
-    mock_download.return_value = b"audio_data"
-    mock_validate.side_effect = ValueError("Audio data is empty")
+    mock_stream.side_effect = AudioValidationError("Audio data is empty")
 
-    process_audio_pipeline("U_user", "msg_123")
+    assert await process_audio_pipeline("U_user", "msg_123") is False
 
     mock_send.assert_called_once()
     sent_text = mock_send.call_args[0][1]
@@ -110,26 +132,716 @@ def test_pipeline_validation_error(
 
 
 @patch("app.pipeline.send_text_to_user")
-@patch("app.pipeline.download_audio")
-@patch("app.pipeline.MessagingApiBlob")
-@patch("app.pipeline.MessagingApi")
-@patch("app.pipeline.ApiClient")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
 @patch("app.pipeline.Configuration")
 @patch("app.pipeline.get_settings")
-def test_pipeline_unexpected_error(
+@pytest.mark.asyncio
+async def test_pipeline_unexpected_error(
     mock_settings, mock_config, mock_api_client, mock_messaging_api,
-    mock_blob_api, mock_download, mock_send
+    mock_stream, mock_send
 ):
     """Pipeline sends generic error message on unexpected exception."""
-    settings = MagicMock()
-    settings.line_channel_access_token = "token"
-    settings.max_audio_size_mb = 100
-    mock_settings.return_value = settings
+    mock_settings.return_value = _make_settings()
 
-    mock_download.side_effect = RuntimeError("Network error")
+    mock_stream.side_effect = RuntimeError("Network error")
 
-    process_audio_pipeline("U_user", "msg_123")
+    assert await process_audio_pipeline("U_user", "msg_123") is False
 
     mock_send.assert_called_once()
     sent_text = mock_send.call_args[0][1]
     assert "發生錯誤" in sent_text
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.trim_silence")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_transcribes_vad_trimmed_audio(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_split, mock_trim, mock_transcribe, mock_generate, mock_send
+):
+    """With VAD enabled, the trimmed file is what gets transcribed."""
+    from app.vad import OffsetMap, TrimResult
+
+    mock_settings.return_value = _make_settings(vad_enabled=True, vad_min_silence_seconds=3.0)
+    mock_stream.return_value = 1024
+    mock_split.return_value = _chunks("/tmp/audio.m4a")
+    mock_trim.return_value = TrimResult("/tmp/audio_vad.m4a", OffsetMap(), 60.0, 45.0)
+    mock_transcribe.return_value = "這是轉錄的文字"
+    mock_generate.return_value = "## 會議摘要\n測試結果"
+
+    await process_audio_pipeline("U_user", "msg_123")
+
+    mock_trim.assert_called_once_with("/tmp/audio.m4a", 3.0)
+    assert mock_transcribe.call_args[0][0] == "/tmp/audio_vad.m4a"
+    mock_send.assert_called_once()
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.transcode_for_upload")
+@patch("app.pipeline.trim_silence")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_vad_writes_upload_profile_once(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_trim, mock_transcode, mock_transcribe, mock_generate, mock_send
+):
+    """With VAD and upload transcoding on, the trimmed file is encoded once, in the upload profile."""
+    from app.vad import OffsetMap, TrimResult
+
+    mock_settings.return_value = _make_settings(vad_enabled=True, upload_transcode_enabled=True)
+    mock_stream.return_value = 1024
+    mock_chunks.return_value = _chunks("/tmp/chunk_0.m4a", "/tmp/chunk_1.m4a")
+    mock_trim.side_effect = lambda path, *args, **kwargs: TrimResult(
+        path.replace(".m4a", "_vad.ogg"), OffsetMap([(0.0, 0.0, 5.0), (5.0, 20.0, 5.0)]), 600.0, 10.0
+    )
+    mock_transcribe.return_value = "這是轉錄的文字"
+    mock_generate.return_value = "## 會議摘要\n測試結果"
+
+    chunk_results = []
+
+    async def capture_stages(*args, **kwargs):
+        chunk_results.extend(await run_stages(*args, **kwargs))
+        return chunk_results
+
+    with patch("app.pipeline.run_stages", side_effect=capture_stages):
+        await process_audio_pipeline("U_user", "msg_123")
+
+    assert mock_trim.call_args.kwargs == {"codec": "libopus", "bitrate_kbps": 24, "sample_rate": 16000}
+    mock_transcode.assert_not_called()
+    assert sorted(c[0][0] for c in mock_transcribe.call_args_list) == [
+        "/tmp/chunk_0_vad.ogg", "/tmp/chunk_1_vad.ogg"
+    ]
+    assert chunk_results[1].offset_map.to_original(6.0) == 621.0
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.transcode_for_upload")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_uploads_transcoded_audio(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_split, mock_transcode, mock_transcribe, mock_generate, mock_send
+):
+    """With upload transcoding enabled, the compact file is sent to Whisper."""
+    mock_settings.return_value = _make_settings(upload_transcode_enabled=True)
+    mock_stream.return_value = 1024
+    mock_split.return_value = _chunks("/tmp/audio.m4a")
+    mock_transcode.return_value = "/tmp/audio_upload.ogg"
+    mock_transcribe.return_value = "這是轉錄的文字"
+    mock_generate.return_value = "## 會議摘要\n測試結果"
+
+    await process_audio_pipeline("U_user", "msg_123")
+
+    mock_transcode.assert_called_once_with(
+        "/tmp/audio.m4a", codec="libopus", bitrate_kbps=24, sample_rate=16000
+    )
+    assert mock_transcribe.call_args[0][0] == "/tmp/audio_upload.ogg"
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_routes_by_length_and_priority(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_send
+):
+    """A short memo goes to the fast model unless the job is high priority."""
+    mock_settings.return_value = _make_settings(fast_model="fast-model", fast_max_tokens=1024)
+    mock_stream.return_value = 1024
+    mock_chunks.side_effect = lambda *args, **kwargs: iter(_chunks("/tmp/audio.m4a"))
+    mock_transcribe.return_value = "短短的語音備忘錄"
+    mock_generate.return_value = "## 會議摘要\n測試結果"
+
+    await process_audio_pipeline("U_user", "msg_1")
+    await process_audio_pipeline("U_user", "msg_2", priority="high")
+
+    first, second = mock_generate.call_args_list
+    assert first[0][1:3] == ("fast-model", 1024)
+    assert second[0][1:3] == ("claude-sonnet-4-5-20250929", 4096)
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_multiple_chunks_streamed(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_send
+):
+    """Every chunk is transcribed and the transcripts reach Claude in chunk order."""
+    mock_settings.return_value = _make_settings(transcribe_max_concurrency=3)
+    mock_stream.return_value = 1024
+    mock_chunks.return_value = iter(_chunks("/tmp/chunk_0.m4a", "/tmp/chunk_1.m4a", "/tmp/chunk_2.m4a"))
+    mock_transcribe.side_effect = lambda path, *args, **kwargs: f"transcript of {path}"
+    mock_generate.return_value = "## 會議摘要\n合併結果"
+
+    await process_audio_pipeline("U_user", "msg_123")
+
+    assert mock_transcribe.call_count == 3
+    mock_generate.assert_called_once()
+    assert mock_generate.call_args[0][0] == [
+        "transcript of /tmp/chunk_0.m4a",
+        "transcript of /tmp/chunk_1.m4a",
+        "transcript of /tmp/chunk_2.m4a",
+    ]
+    assert mock_generate.call_args.kwargs["transcript_token_budget"] == 100000
+    mock_send.assert_called_once_with("U_user", "## 會議摘要\n合併結果", mock_messaging_api.return_value)
+
+
+@patch("app.pipeline.push_messages")
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_pushes_streamed_sections(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_send, mock_push
+):
+    """The first section is pushed at once, the ones that close during that push go out together, and the full result is not re-sent."""
+    mock_settings.return_value = _make_settings()
+    mock_stream.return_value = 1024
+    mock_chunks.return_value = iter(_chunks("/tmp/audio.m4a"))
+    mock_transcribe.return_value = "這是轉錄的文字"
+    first_push_done = asyncio.Event()
+
+    async def push(user_id, texts, api):
+        if mock_push.call_count == 1:
+            await first_push_done.wait()
+
+    mock_push.side_effect = push
+
+    async def generate(transcripts, *args, on_section=None, **kwargs):
+        await on_section("# 會議記錄")
+        assert mock_push.call_count == 1
+        await on_section("## 會議摘要\n摘要")
+        await on_section("## 待辦事項\n- 寄信")
+        first_push_done.set()
+        return "# 會議記錄\n## 會議摘要\n摘要\n## 待辦事項\n- 寄信"
+
+    mock_generate.side_effect = generate
+
+    await process_audio_pipeline("U_user", "msg_123")
+
+    api = mock_messaging_api.return_value
+    assert mock_push.call_args_list == [
+        (("U_user", ["# 會議記錄"], api),),
+        (("U_user", ["## 會議摘要\n摘要\n\n## 待辦事項\n- 寄信"], api),),
+    ]
+    mock_send.assert_not_called()
+
+
+@patch("app.pipeline.push_messages")
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.parametrize("final_attempt", [True, False])
+@pytest.mark.asyncio
+async def test_pipeline_flags_interrupted_notes(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_send, mock_push, final_attempt
+):
+    """Once a section has been pushed, a failed stream ends with an incomplete-notes warning instead of a retry."""
+    mock_settings.return_value = _make_settings()
+    mock_stream.return_value = 1024
+    mock_chunks.return_value = iter(_chunks("/tmp/audio.m4a"))
+    mock_transcribe.return_value = "這是轉錄的文字"
+
+    async def generate(transcripts, *args, on_section=None, **kwargs):
+        await on_section("## 會議摘要\n摘要")
+        raise RuntimeError("stream dropped")
+
+    mock_generate.side_effect = generate
+
+    assert await process_audio_pipeline("U_user", "msg_123", final_attempt=final_attempt) is False
+
+    assert mock_push.call_args[0][1] == ["## 會議摘要\n摘要"]
+    mock_send.assert_called_once()
+    assert "並不完整" in mock_send.call_args[0][1]
+
+
+def _blocked_pusher(max_length: int):
+    """A SectionPusher whose first push waits until the returned event is set."""
+    release = asyncio.Event()
+    pushes = []
+
+    async def push(user_id, texts, api):
+        pushes.append(texts)
+        if len(pushes) == 1:
+            await release.wait()
+
+    first_push = AsyncMock()
+    pusher = SectionPusher("U_user", MagicMock(), max_length=max_length, on_first_push=first_push)
+    return pusher, push, pushes, release, first_push
+
+
+@pytest.mark.asyncio
+async def test_section_pusher_coalesces_sections_closed_during_a_push():
+    """Sections closed during a push share the next one, split only where a message would overflow."""
+    pusher, push, pushes, release, first_push = _blocked_pusher(max_length=20)
+    with patch("app.pipeline.push_messages", side_effect=push):
+        await pusher.add("A" * 10)
+        first_push.assert_awaited_once()
+        await pusher.add("B" * 5)
+        await pusher.add("C" * 10)
+        await pusher.add("D" * 10)
+        release.set()
+        await pusher.flush()
+
+    assert pushes == [["A" * 10], ["B" * 5 + "\n\n" + "C" * 10, "D" * 10]]
+    first_push.assert_awaited_once()
+    assert (pusher.received, pusher.pushed) == (4, 3)
+
+
+@pytest.mark.asyncio
+async def test_section_pusher_rewinds_only_before_first_push():
+    """Sections can be taken back while the first push has not begun, but not after."""
+    started = asyncio.Event()
+
+    async def first_push():
+        started.set()
+        await asyncio.Event().wait()
+
+    with patch("app.pipeline.push_messages") as mock_push:
+        pusher = SectionPusher("U_user", MagicMock(), on_first_push=first_push)
+        await pusher.add("## 會議摘要")
+        await started.wait()
+        assert pusher.rewind() is True
+        assert (pusher.received, pusher.pushed) == (0, 0)
+
+        pusher.on_first_push = None
+        await pusher.add("## 會議摘要")
+        await pusher.flush()
+        assert pusher.rewind() is False
+
+    assert mock_push.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_section_pusher_sends_at_most_five_messages_per_push():
+    pusher, push, pushes, release, first_push = _blocked_pusher(max_length=10)
+    with patch("app.pipeline.push_messages", side_effect=push):
+        for section in "ABCDEFGH":
+            await pusher.add(section * 9)
+        release.set()
+        await pusher.flush()
+
+    assert [len(texts) for texts in pushes] == [1, 5, 2]
+    assert pusher.pushed == 8
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_preview")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_pushes_preview_before_notes(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_preview, mock_send
+):
+    """The first chunk's transcript yields a preview from the preview model before the full notes."""
+    preview_pushed = asyncio.Event()
+    mock_settings.return_value = _make_settings(preview_enabled=True, preview_model="fast-model")
+    mock_stream.return_value = 1024
+    mock_chunks.return_value = iter(_chunks("/tmp/chunk_0.m4a", "/tmp/chunk_1.m4a"))
+    mock_transcribe.side_effect = lambda path, *args, **kwargs: f"transcript of {path}"
+    mock_preview.return_value = "重點一\n重點二\n重點三"
+    mock_send.side_effect = lambda user_id, text, api: preview_pushed.set()
+
+    async def generate(*args, **kwargs):
+        await asyncio.wait_for(preview_pushed.wait(), timeout=5)
+        return "## 會議摘要\n完整內容"
+
+    mock_generate.side_effect = generate
+
+    await process_audio_pipeline("U_user", "msg_123")
+
+    mock_preview.assert_called_once_with("transcript of /tmp/chunk_0.m4a", "fast-model", 300, "key")
+    sent = [c[0][1] for c in mock_send.call_args_list]
+    assert len(sent) == 2
+    assert "重點一\n重點二\n重點三" in sent[0]
+    assert sent[1] == "## 會議摘要\n完整內容"
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_preview")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_skips_preview_for_single_chunk(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_preview, mock_send
+):
+    """A recording that fits one chunk gets only the full notes."""
+    mock_settings.return_value = _make_settings(preview_enabled=True)
+    mock_stream.return_value = 1024
+    mock_chunks.return_value = iter(_chunks("/tmp/audio.m4a"))
+    mock_transcribe.return_value = "這是轉錄的文字"
+    mock_generate.return_value = "## 會議摘要\n完整內容"
+
+    await process_audio_pipeline("U_user", "msg_123")
+
+    mock_preview.assert_not_called()
+    mock_send.assert_called_once()
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_preview")
+@pytest.mark.asyncio
+async def test_preview_dropped_once_superseded(mock_preview, mock_send):
+    """A preview requested after the full notes started is never generated or pushed."""
+    task = PreviewTask("U_user", MagicMock(), _make_settings(), started_at=0.0)
+
+    await task.supersede()
+    task.set_multi_chunk()
+    task.set_first_transcript("逐字稿")
+
+    mock_preview.assert_not_called()
+    mock_send.assert_not_called()
+    assert task.elapsed is None
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_retry_resumes_from_checkpoints(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_send,
+    workspace_root,
+):
+    """A retry after a Claude failure reuses the audio, chunks and transcripts."""
+    mock_settings.return_value = _make_settings()
+
+    def download(message_id, token, dest_path, *args, **kwargs):
+        with open(dest_path, "wb") as f:
+            f.write(b"audio")
+        return 5
+
+    def split(audio_path, output_dir, **kwargs):
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(output_dir, f"chunk_{i}.m4a"))
+            with open(paths[-1], "wb") as f:
+                f.write(b"chunk")
+        return iter(_chunks(*paths))
+
+    mock_stream.side_effect = download
+    mock_chunks.side_effect = split
+    mock_transcribe.side_effect = lambda path, *args, **kwargs: f"transcript of {os.path.basename(path)}"
+    mock_generate.side_effect = [RuntimeError("overloaded"), "## 會議摘要\n結果"]
+
+    with pytest.raises(RuntimeError):
+        await process_audio_pipeline("U_user", "msg_123", final_attempt=False)
+    mock_send.assert_not_called()
+
+    assert await process_audio_pipeline("U_user", "msg_123") is True
+
+    assert mock_stream.call_count == 1
+    assert mock_chunks.call_count == 1
+    assert mock_transcribe.call_count == 3
+    assert mock_generate.call_args[0][0] == [f"transcript of chunk_{i}.m4a" for i in range(3)]
+    assert mock_generate.call_args.kwargs["store"].message_id == "msg_123"
+    mock_send.assert_called_once_with("U_user", "## 會議摘要\n結果", mock_messaging_api.return_value)
+    assert list(workspace_root.iterdir()) == []
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_final_failure_discards_workspace(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_send, workspace_root,
+):
+    """The last attempt tells the user and cleans up; an earlier one keeps the checkpoints."""
+    mock_settings.return_value = _make_settings()
+    mock_stream.side_effect = RuntimeError("Network error")
+
+    with pytest.raises(RuntimeError):
+        await process_audio_pipeline("U_user", "msg_123", final_attempt=False)
+    assert [p.name for p in workspace_root.iterdir()] == ["msg_123"]
+
+    assert await process_audio_pipeline("U_user", "msg_123", final_attempt=True) is False
+    mock_send.assert_called_once()
+    assert list(workspace_root.iterdir()) == []
+
+
+def _write_download(body: bytes):
+    def download(message_id, token, dest_path, *args, on_chunk=None, **kwargs):
+        with open(dest_path, "wb") as f:
+            f.write(body)
+        on_chunk(body)
+        return len(body)
+    return download
+
+
+@patch("app.pipeline.get_result_cache")
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_repeated_recording_served_from_cache(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_send, mock_cache,
+):
+    """The same audio under a new message ID goes straight to send_text_to_user."""
+    mock_settings.return_value = _make_settings()
+    mock_cache.return_value = cache = ResultCache(":memory:", max_bytes=10_000)
+    mock_stream.side_effect = _write_download(b"same recording")
+    mock_chunks.side_effect = lambda path, **kwargs: iter([AudioChunk(path, 0.0, 60.0)])
+    mock_transcribe.return_value = "逐字稿"
+    mock_generate.return_value = "## 會議摘要\n結果"
+
+    assert await process_audio_pipeline("U_user", "msg_1") is True
+    assert await process_audio_pipeline("U_user", "msg_2") is True
+
+    assert mock_transcribe.call_count == 1
+    assert mock_generate.call_count == 1
+    assert mock_send.call_args_list[1][0][:2] == ("U_user", "## 會議摘要\n結果")
+    assert cache.stats()["hits"] == 1
+
+
+@patch("app.pipeline.get_result_cache")
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_cached_transcript_resummarized_for_other_model(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_send, mock_cache,
+):
+    """Notes from another model are not reused, but the transcript still skips Whisper."""
+    body = b"same recording"
+    mock_settings.return_value = _make_settings(model_routing_enabled=False)
+    mock_cache.return_value = cache = ResultCache(":memory:", max_bytes=10_000)
+    cache.put(hashlib.sha256(body).hexdigest(), ["逐字稿"], "## 舊的", "other-model", PROMPT_VERSION)
+    mock_stream.side_effect = _write_download(body)
+    mock_generate.return_value = "## 會議摘要\n結果"
+
+    assert await process_audio_pipeline("U_user", "msg_1") is True
+
+    mock_chunks.assert_not_called()
+    mock_transcribe.assert_not_called()
+    assert mock_generate.call_args[0][0] == ["逐字稿"]
+    mock_send.assert_called_once_with("U_user", "## 會議摘要\n結果", mock_messaging_api.return_value)
+    assert cache.get_notes(hashlib.sha256(body).hexdigest(), "claude-sonnet-4-5-20250929", PROMPT_VERSION)
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_batch_downloads_concurrently_and_reports_each_recording(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_send,
+):
+    """Each recording of a batch gets its own notes, and its own finished state."""
+    mock_settings.return_value = _make_settings()
+    in_flight = []
+    overlapped = asyncio.Event()
+
+    async def download(message_id, token, dest_path, *args, on_chunk=None, **kwargs):
+        in_flight.append(message_id)
+        if len(in_flight) == 2:
+            overlapped.set()
+        await asyncio.wait_for(overlapped.wait(), timeout=1)
+        with open(dest_path, "wb") as f:
+            f.write(message_id.encode())
+        on_chunk(message_id.encode())
+        return len(message_id)
+
+    mock_stream.side_effect = download
+    mock_chunks.side_effect = lambda path, **kwargs: iter([AudioChunk(path, 0.0, 60.0)])
+    mock_transcribe.side_effect = lambda path, *args, **kwargs: f"transcript of {path}"
+
+    def generate(transcripts, *args, **kwargs):
+        if "msg_2" in transcripts[0]:
+            raise RuntimeError("overloaded")
+        return "## 會議摘要\n一"
+
+    mock_generate.side_effect = generate
+    states = []
+
+    with pytest.raises(RuntimeError):
+        await process_batch(
+            "U_user", ["msg_1", "msg_2"], on_state=lambda state, message_id=None: states.append((state, message_id)),
+            final_attempt=False,
+        )
+
+    assert ("sent", "msg_1") in states
+    assert ("sent", "msg_2") not in states
+    mock_send.assert_called_once_with("U_user", "## 會議摘要\n一", mock_messaging_api.return_value)
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.generate_meeting_notes_from_chunks")
+@patch("app.pipeline.transcribe_with_retry")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_batch_summarized_together(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_transcribe, mock_generate, mock_send, workspace_root,
+):
+    """With batch_summarize_together the recordings become one set of notes."""
+    mock_settings.return_value = _make_settings(batch_summarize_together=True)
+    mock_stream.side_effect = lambda message_id, *args, **kwargs: _write_download(message_id.encode())(
+        message_id, *args, **kwargs
+    )
+    mock_chunks.side_effect = lambda path, **kwargs: iter([AudioChunk(path, 0.0, 60.0)])
+    mock_transcribe.side_effect = lambda path, *args, **kwargs: "第一段" if "msg_1" in path else "第二段"
+    mock_generate.return_value = "## 會議摘要\n合併"
+
+    assert await process_batch("U_user", ["msg_1", "msg_2"]) is True
+
+    assert mock_stream.call_count == 2
+    assert mock_generate.call_args[0][0] == ["【第 1 段錄音】\n第一段", "【第 2 段錄音】\n第二段"]
+    mock_send.assert_called_once_with("U_user", "## 會議摘要\n合併", mock_messaging_api.return_value)
+    assert list(workspace_root.iterdir()) == []
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.iter_audio_chunks")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_cancelled_mid_split_stays_cancelled(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api,
+    mock_stream, mock_chunks, mock_send, workspace_root,
+):
+    """Cancelling while ffmpeg is cutting a chunk neither messages the user nor drops the workspace."""
+    mock_settings.return_value = _make_settings()
+    mock_stream.side_effect = _write_download(b"audio")
+    splitting = threading.Event()
+    release = threading.Event()
+
+    def split(audio_path, **kwargs):
+        splitting.set()
+        release.wait(timeout=5)
+        yield AudioChunk(audio_path, 0.0, 60.0)
+
+    mock_chunks.side_effect = split
+    task = asyncio.create_task(process_audio_pipeline("U_user", "msg_123", final_attempt=False))
+    await asyncio.get_running_loop().run_in_executor(None, splitting.wait, 5)
+    task.cancel()
+    await asyncio.sleep(0.05)
+    release.set()
+
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    mock_send.assert_not_called()
+    assert [p.name for p in workspace_root.iterdir()] == ["msg_123"]
+
+
+@patch("app.pipeline.send_text_to_user")
+@patch("app.pipeline.stream_audio_to_file")
+@patch("app.pipeline.AsyncMessagingApi")
+@patch("app.pipeline.AsyncApiClient")
+@patch("app.pipeline.Configuration")
+@patch("app.pipeline.get_settings")
+@pytest.mark.asyncio
+async def test_pipeline_other_value_error_is_not_reported_as_bad_audio(
+    mock_settings, mock_config, mock_api_client, mock_messaging_api, mock_stream, mock_send,
+):
+    """Only AudioValidationError is the user's fault; other errors are retried."""
+    mock_settings.return_value = _make_settings()
+    mock_stream.side_effect = ValueError("Unsupported upload codec: x")
+
+    with pytest.raises(ValueError):
+        await process_audio_pipeline("U_user", "msg_123", final_attempt=False)
+    mock_send.assert_not_called()
@@ -0,0 +1,156 @@
+"""Tests for rate_limit module."""
+
+import time
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import pytest
+
+from app.config import Settings
+from app.rate_limit import (
+    RateLimiter,
+    _parse_reset,
+    close_rate_limiters,
+    get_rate_limiter,
+    init_rate_limiters,
+    parse_retry_after,
+    rate_limited,
+)
+
+
+class _StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+@pytest.mark.asyncio
+async def test_waits_for_request_budget():
+    """A call over the request quota is queued until the bucket refills."""
+    limiter = RateLimiter("test", requests_per_minute=6000)
+    limiter.requests.level = 0
+
+    started = time.monotonic()
+    await limiter.acquire()
+
+    assert time.monotonic() - started >= 0.009
+    assert limiter.stats()["throttled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_oversized_token_request_waits_for_full_bucket_only():
+    limiter = RateLimiter("test", tokens_per_minute=60_000)
+    await limiter.acquire(tokens=10**9)
+    assert limiter.tokens.level <= 0
+
+
+@pytest.mark.asyncio
+async def test_retries_after_retry_after():
+    """A 429 is retried once the upstream's Retry-After has passed."""
+    limiter = RateLimiter("test")
+    calls = []
+
+    async def call():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise _StatusError(429, {"Retry-After": "0.05"})
+        return "ok"
+
+    assert await limiter.call(call) == "ok"
+    assert calls[1] - calls[0] >= 0.05
+    assert limiter.stats()["retries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_client_errors_and_unretryable_calls_are_raised():
+    limiter = RateLimiter("test", base_delay_seconds=0.001)
+
+    async def bad_request():
+        raise _StatusError(400)
+
+    async def overloaded():
+        raise _StatusError(529)
+
+    with pytest.raises(_StatusError):
+        await limiter.call(bad_request)
+    with pytest.raises(_StatusError):
+        await limiter.call(overloaded, retryable=lambda: False)
+    assert limiter.stats()["retries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_retries():
+    limiter = RateLimiter("test", max_retries=2, base_delay_seconds=0.001)
+    attempts = []
+
+    async def overloaded():
+        attempts.append(1)
+        raise _StatusError(503)
+
+    with pytest.raises(_StatusError):
+        await limiter.call(overloaded)
+    assert len(attempts) == 3
+
+
+@pytest.mark.asyncio
+async def test_exhausted_quota_header_pauses_callers():
+    limiter = RateLimiter("test", requests_per_minute=500)
+    limiter.observe({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "50ms"})
+
+    started = time.monotonic()
+    await limiter.acquire()
+
+    assert time.monotonic() - started >= 0.04
+
+
+def test_anthropic_headers_lower_token_budget():
+    limiter = RateLimiter("test", requests_per_minute=50, tokens_per_minute=40_000)
+    limiter.observe({"anthropic-ratelimit-tokens-remaining": "1200", "anthropic-ratelimit-requests-remaining": "7"})
+
+    assert limiter.tokens.level == 1200
+    assert limiter.requests.level == 7
+
+
+def test_backoff_is_jittered_and_capped():
+    limiter = RateLimiter("test", base_delay_seconds=1.0, max_delay_seconds=5.0)
+    assert 2.0 <= limiter.backoff(2) <= 4.0
+    assert limiter.backoff(10) <= 5.0
+
+
+def test_parse_retry_after_forms():
+    assert parse_retry_after({"retry-after-ms": "250"}) == 0.25
+    assert parse_retry_after({"Retry-After": "3"}) == 3.0
+    assert 8 <= parse_retry_after({"retry-after": formatdate(time.time() + 10, usegmt=True)}) <= 10
+    assert parse_retry_after({}) is None
+
+
+def test_parse_reset_forms():
+    assert _parse_reset("1m30s") == 90.0
+    assert _parse_reset("20ms") == 0.02
+    assert _parse_reset("2000-01-01T00:00:00Z") == 0.0
+    assert _parse_reset("soon") is None
+
+
+@pytest.mark.asyncio
+async def test_registry_per_upstream():
+    settings = Settings(
+        _env_file=None,
+        line_channel_secret="secret",
+        line_channel_access_token="token",
+        anthropic_api_key="key",
+        openai_api_key="openai-key",
+    )
+
+    async def call():
+        return "direct"
+
+    assert await rate_limited("openai", call) == "direct"
+    init_rate_limiters(settings)
+    try:
+        assert get_rate_limiter("anthropic").tokens.capacity == settings.anthropic_tpm
+        assert await rate_limited("openai", call) == "direct"
+        assert get_rate_limiter("openai").stats()["calls"] == 1
+    finally:
+        close_rate_limiters()
+    assert get_rate_limiter("line") is None
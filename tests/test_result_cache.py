@@ -0,0 +1,59 @@
+"""Tests for result_cache module."""
+
+from app.result_cache import ResultCache
+
+
+def test_notes_only_reused_for_same_model_and_prompt():
+    """The transcript is reusable on its own; notes need a matching model and prompt version."""
+    cache = ResultCache(":memory:", max_bytes=10_000)
+    cache.put("sha", ["第一段", "第二段"], "## 會議摘要", "model-a", "v1")
+
+    assert cache.get_transcripts("sha") == ["第一段", "第二段"]
+    assert cache.get_notes("sha", "model-a", "v1") == "## 會議摘要"
+    assert cache.get_transcripts("sha") == ["第一段", "第二段"]
+    assert cache.get_notes("sha", "model-b", "v1") is None
+    assert cache.get_notes("sha", "model-a", "v2") is None
+    assert cache.get_transcripts("other") is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["transcript_hits"], stats["misses"]) == (1, 1, 1)
+    assert stats["hit_rate"] == 0.333
+    assert stats["entries"] == 1
+
+
+def test_transcript_lookup_alone_counts_as_transcript_hit():
+    """Batches only reuse transcripts and never ask for notes."""
+    cache = ResultCache(":memory:", max_bytes=10_000)
+    cache.put("sha", ["第一段"], "## 會議摘要", "model-a", "v1")
+
+    cache.get_transcripts("sha")
+
+    assert cache.stats()["transcript_hits"] == 1
+
+
+def test_evicts_least_recently_used():
+    cache = ResultCache(":memory:", max_bytes=100)
+    cache.put("a", ["x" * 30], "n", "m", "v")
+    cache.put("b", ["y" * 30], "n", "m", "v")
+    cache.get_transcripts("a")
+
+    cache.put("c", ["z" * 30], "n", "m", "v")
+
+    assert cache.get_transcripts("a") is not None
+    assert cache.get_transcripts("b") is None
+    assert cache.get_transcripts("c") is not None
+    assert cache.stats()["bytes"] <= 100
+
+
+def test_skips_entries_larger_than_cache():
+    cache = ResultCache(":memory:", max_bytes=10)
+    cache.put("a", ["x" * 30], "n", "m", "v")
+
+    assert cache.get_transcripts("a") is None
+
+
+def test_survives_reopening(tmp_path):
+    db_path = str(tmp_path / "results.db")
+    ResultCache(db_path, max_bytes=10_000).put("sha", ["逐字稿"], "## 會議摘要", "m", "v")
+
+    assert ResultCache(db_path, max_bytes=10_000).get_notes("sha", "m", "v") == "## 會議摘要"
@@ -0,0 +1,128 @@
+"""Tests for stages module."""
+
+import asyncio
+
+import pytest
+
+from app.stages import Stage, run_stages
+
+
+async def _items(values):
+    for value in values:
+        yield value
+
+
+@pytest.mark.asyncio
+async def test_results_in_source_order():
+    """Outputs are returned in source order even if items finish out of order."""
+    async def slow_first(x):
+        await asyncio.sleep(0.05 if x == 0 else 0)
+        return x * 10
+
+    async def add_one(x):
+        return x + 1
+
+    result = await run_stages(_items(range(4)), [Stage("a", slow_first, workers=4), Stage("b", add_one)])
+
+    assert result == [1, 11, 21, 31]
+
+
+@pytest.mark.asyncio
+async def test_stages_overlap():
+    """A later stage starts on the first item before the source is exhausted."""
+    first_done = asyncio.Event()
+    order = []
+
+    async def source():
+        for i in range(3):
+            if i == 2:
+                await asyncio.wait_for(first_done.wait(), timeout=2)
+            order.append(f"produce-{i}")
+            yield i
+
+    async def passthrough(x):
+        return x
+
+    async def finish(x):
+        order.append(f"finish-{x}")
+        first_done.set()
+        return x
+
+    result = await run_stages(source(), [Stage("a", passthrough), Stage("b", finish)], queue_size=1)
+
+    assert result == [0, 1, 2]
+    assert order.index("finish-0") < order.index("produce-2")
+
+
+@pytest.mark.asyncio
+async def test_workers_bounded():
+    """A stage never runs more than its worker count at once."""
+    state = {"active": 0, "peak": 0}
+
+    async def work(x):
+        state["active"] += 1
+        state["peak"] = max(state["peak"], state["active"])
+        await asyncio.sleep(0.02)
+        state["active"] -= 1
+        return x
+
+    await run_stages(_items(range(8)), [Stage("a", work, workers=2)], queue_size=8)
+
+    assert state["peak"] == 2
+
+
+@pytest.mark.asyncio
+async def test_stage_error_propagates():
+    """The first stage failure cancels the run and is re-raised."""
+    async def boom(x):
+        if x == 1:
+            raise RuntimeError("whisper down")
+        return x
+
+    async def passthrough(x):
+        return x
+
+    with pytest.raises(RuntimeError, match="whisper down"):
+        await run_stages(
+            _items(range(20)), [Stage("a", boom, workers=2), Stage("b", passthrough)], queue_size=1
+        )
+
+
+@pytest.mark.asyncio
+async def test_source_error_propagates():
+    """An exception from the source is re-raised after workers stop."""
+    async def source():
+        yield 1
+        raise ValueError("bad audio")
+
+    async def passthrough(x):
+        return x
+
+    with pytest.raises(ValueError, match="bad audio"):
+        await run_stages(source(), [Stage("a", passthrough)])
+
+
+@pytest.mark.asyncio
+async def test_cancellation_stops_workers():
+    """Cancelling the caller cancels in-flight stage work too."""
+    cancelled = asyncio.Event()
+
+    async def hang(x):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def source():
+        yield 1
+        await asyncio.sleep(60)
+        yield 2
+
+    task = asyncio.create_task(run_stages(source(), [Stage("a", hang)]))
+    await asyncio.sleep(0.05)
+    task.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert cancelled.is_set()
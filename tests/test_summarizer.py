@@ -1,23 +1,37 @@
+from collections import deque
+
 import pytest
-from unittest.mock import MagicMock, patch, Mock
+from unittest.mock import AsyncMock, MagicMock, patch, Mock
 
+from app.rate_limit import RateLimiter, _limiters
 from app.summarizer import (
+    MEETING_NOTES_SYSTEM_PROMPT,
+    MERGE_NOTES_SYSTEM_PROMPT,
+    SectionSplitter,
+    estimate_tokens,
     generate_meeting_notes,
     generate_meeting_notes_from_chunks,
+    merge_chunk_notes,
+    pack_transcripts,
+    record_routing,
+    route_model,
+    routing_stats,
+    ModelRoute,
     _merge_meeting_notes,
 )
 
 
-@patch("app.summarizer.anthropic.Anthropic")
-def test_generate_meeting_notes_success(mock_anthropic_cls):
+@patch("app.summarizer.anthropic.AsyncAnthropic")
+@pytest.mark.asyncio
+async def test_generate_meeting_notes_success(mock_anthropic_cls):
     mock_client = MagicMock()
-    mock_anthropic_cls.return_value = mock_client
+    mock_anthropic_cls.return_value.__aenter__.return_value = mock_client
 
     mock_response = MagicMock()
     mock_response.content = [Mock(type="text", text="## 會議摘要\n測試內容")]
-    mock_client.messages.create.return_value = mock_response
+    mock_client.messages.create = AsyncMock(return_value=mock_response)
 
-    result = generate_meeting_notes(
+    result = await generate_meeting_notes(
         transcript="這是一段測試轉錄文字",
         model="claude-sonnet-4-20250514",
         max_tokens=4096,
@@ -30,16 +44,45 @@ def test_generate_meeting_notes_success(mock_anthropic_cls):
     mock_client.messages.create.assert_called_once()
 
 
-@patch("app.summarizer.anthropic.Anthropic")
-def test_generate_meeting_notes_empty_response(mock_anthropic_cls):
+class _DictStore(dict):
+    def load_notes(self, key):
+        return self.get(key)
+
+    def save_notes(self, key, notes):
+        self[key] = notes
+
+
+@patch("app.summarizer.anthropic.AsyncAnthropic")
+@pytest.mark.asyncio
+async def test_generate_meeting_notes_reuses_stored_notes(mock_anthropic_cls):
+    """Notes saved by an earlier attempt are returned without calling Claude again."""
     mock_client = MagicMock()
-    mock_anthropic_cls.return_value = mock_client
+    mock_anthropic_cls.return_value.__aenter__.return_value = mock_client
+    mock_response = MagicMock()
+    mock_response.content = [Mock(type="text", text="## 會議摘要\n測試內容")]
+    mock_client.messages.create = AsyncMock(return_value=mock_response)
+    store = _DictStore()
+
+    first = await generate_meeting_notes("逐字稿", "model", 4096, "test-key", store=store)
+    again = await generate_meeting_notes("逐字稿", "model", 4096, "test-key", store=store)
+    other_model = await generate_meeting_notes("逐字稿", "other-model", 4096, "test-key", store=store)
+
+    assert first == again == other_model == "## 會議摘要\n測試內容"
+    assert mock_client.messages.create.call_count == 2
+    assert len(store) == 2
+
+
+@patch("app.summarizer.anthropic.AsyncAnthropic")
+@pytest.mark.asyncio
+async def test_generate_meeting_notes_empty_response(mock_anthropic_cls):
+    mock_client = MagicMock()
+    mock_anthropic_cls.return_value.__aenter__.return_value = mock_client
 
     mock_response = MagicMock()
     mock_response.content = []
-    mock_client.messages.create.return_value = mock_response
+    mock_client.messages.create = AsyncMock(return_value=mock_response)
 
-    result = generate_meeting_notes(
+    result = await generate_meeting_notes(
         transcript="這是一段測試轉錄文字",
         model="claude-sonnet-4-20250514",
         max_tokens=4096,
@@ -49,16 +92,17 @@ def test_generate_meeting_notes_empty_response(mock_anthropic_cls):
     assert result == "無法生成會議記錄。"
 
 
-@patch("app.summarizer.anthropic.Anthropic")
-def test_generate_meeting_notes_prompt_structure(mock_anthropic_cls):
+@patch("app.summarizer.anthropic.AsyncAnthropic")
+@pytest.mark.asyncio
+async def test_generate_meeting_notes_prompt_structure(mock_anthropic_cls):
     mock_client = MagicMock()
-    mock_anthropic_cls.return_value = mock_client
+    mock_anthropic_cls.return_value.__aenter__.return_value = mock_client
 
     mock_response = MagicMock()
     mock_response.content = [Mock(type="text", text="notes")]
-    mock_client.messages.create.return_value = mock_response
+    mock_client.messages.create = AsyncMock(return_value=mock_response)
 
-    generate_meeting_notes(
+    await generate_meeting_notes(
         transcript="這是一段測試轉錄文字",
         model="claude-sonnet-4-20250514",
         max_tokens=4096,
@@ -76,11 +120,47 @@ def test_generate_meeting_notes_prompt_structure(mock_anthropic_cls):
     assert "這是一段測試轉錄文字" in content
 
 
-@patch("app.summarizer.generate_meeting_notes")
-def test_generate_meeting_notes_from_chunks_single(mock_generate):
+@patch("app.summarizer.anthropic.AsyncAnthropic")
+@pytest.mark.asyncio
+async def test_generate_meeting_notes_instructions_in_system_prompt(mock_anthropic_cls):
+    """Fixed instructions go in the system prompt; the user turn is just the transcript."""
+    mock_client = MagicMock()
+    mock_anthropic_cls.return_value.__aenter__.return_value = mock_client
+    mock_response = MagicMock()
+    mock_response.content = [Mock(type="text", text="notes")]
+    mock_response.usage = Mock(input_tokens=50, output_tokens=10)
+    mock_client.messages.create = AsyncMock(return_value=mock_response)
+
+    await generate_meeting_notes("逐字稿", "claude-sonnet-4-20250514", 4096, "test-key")
+
+    kwargs = mock_client.messages.create.call_args.kwargs
+    assert kwargs["system"] == MEETING_NOTES_SYSTEM_PROMPT
+    assert kwargs["messages"] == [{"role": "user", "content": "逐字稿"}]
+
+
+@patch("app.summarizer.anthropic.AsyncAnthropic")
+@pytest.mark.asyncio
+async def test_merge_meeting_notes_instructions_in_system_prompt(mock_anthropic_cls):
+    mock_client = MagicMock()
+    mock_anthropic_cls.return_value.__aenter__.return_value = mock_client
+    mock_response = MagicMock()
+    mock_response.content = [Mock(type="text", text="merged")]
+    mock_client.messages.create = AsyncMock(return_value=mock_response)
+
+    result = await _merge_meeting_notes(["a", "b"], "claude-sonnet-4-20250514", 4096, "test-key")
+
+    kwargs = mock_client.messages.create.call_args.kwargs
+    assert result == "merged"
+    assert kwargs["system"] == MERGE_NOTES_SYSTEM_PROMPT
+    assert kwargs["messages"] == [{"role": "user", "content": "a---\nb"}]
+
+
+@patch("app.summarizer.generate_meeting_notes", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_generate_meeting_notes_from_chunks_single(mock_generate):
     mock_generate.return_value = "## 會議摘要\n單一段落內容"
 
-    result = generate_meeting_notes_from_chunks(
+    result = await generate_meeting_notes_from_chunks(
         transcripts=["轉錄文字片段一"],
         model="claude-sonnet-4-20250514",
         max_tokens=4096,
@@ -91,20 +171,45 @@ def test_generate_meeting_notes_from_chunks_single(mock_generate):
     mock_generate.assert_called_once()
 
 
-@patch("app.summarizer._merge_meeting_notes")
-@patch("app.summarizer.generate_meeting_notes")
-def test_generate_meeting_notes_from_chunks_multiple(mock_generate, mock_merge):
-    mock_generate.side_effect = [
-        "## 會議摘要\n第一段內容",
-        "## 會議摘要\n第二段內容",
-    ]
+@patch("app.summarizer._merge_meeting_notes", new_callable=AsyncMock)
+@patch("app.summarizer.generate_meeting_notes", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_generate_meeting_notes_from_chunks_fits_single_call(mock_generate, mock_merge):
+    """Chunks that fit the token budget together are summarized in one call."""
+    mock_generate.return_value = "## 會議摘要\n完整內容"
+
+    result = await generate_meeting_notes_from_chunks(
+        transcripts=["轉錄文字片段一", "轉錄文字片段二"],
+        model="claude-sonnet-4-20250514",
+        max_tokens=4096,
+        api_key="test-key",
+    )
+
+    mock_generate.assert_called_once_with(
+        "轉錄文字片段一\n轉錄文字片段二", "claude-sonnet-4-20250514", 4096, "test-key", on_section=None, store=None
+    )
+    mock_merge.assert_not_called()
+    assert result == "## 會議摘要\n完整內容"
+
+
+@patch("app.summarizer._merge_meeting_notes", new_callable=AsyncMock)
+@patch("app.summarizer.generate_meeting_notes", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_generate_meeting_notes_from_chunks_multiple(mock_generate, mock_merge):
+    """Transcripts over the budget are summarized per window, then merged."""
+    outputs = {
+        "轉錄文字片段一": "## 會議摘要\n第一段內容",
+        "轉錄文字片段二": "## 會議摘要\n第二段內容",
+    }
+    mock_generate.side_effect = lambda transcript, *args, **kwargs: outputs[transcript]
     mock_merge.return_value = "## 會議摘要\n合併後的完整內容"
 
-    result = generate_meeting_notes_from_chunks(
+    result = await generate_meeting_notes_from_chunks(
         transcripts=["轉錄文字片段一", "轉錄文字片段二"],
         model="claude-sonnet-4-20250514",
         max_tokens=4096,
         api_key="test-key",
+        transcript_token_budget=10,
     )
 
     assert mock_generate.call_count == 2
@@ -113,5 +218,221 @@ def test_generate_meeting_notes_from_chunks_multiple(mock_generate, mock_merge):
         "claude-sonnet-4-20250514",
         4096,
         "test-key",
+        on_section=None,
+        store=None,
     )
     assert result == "## 會議摘要\n合併後的完整內容"
+
+
+def test_pack_transcripts_fewest_windows():
+    """Consecutive transcripts are greedily packed into budget-sized windows."""
+    transcripts = ["a" * 40, "b" * 40, "c" * 40, "d" * 40]  # 10 tokens each
+
+    assert pack_transcripts(transcripts, token_budget=25) == [
+        "a" * 40 + "\n" + "b" * 40,
+        "c" * 40 + "\n" + "d" * 40,
+    ]
+    assert len(pack_transcripts(transcripts, token_budget=1000)) == 1
+
+
+def test_pack_transcripts_splits_oversized_chunk():
+    """A single transcript over the budget is split at sentence ends."""
+    transcript = "第一句話。" * 10  # 50 tokens
+
+    windows = pack_transcripts([transcript], token_budget=20)
+
+    assert "".join(windows) == transcript
+    assert all(estimate_tokens(w) <= 20 for w in windows)
+    assert all(w.endswith("。") for w in windows)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("會議記錄") == 4
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("會議 notes") == 2 + 2
+
+
+@patch("app.summarizer._merge_meeting_notes", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_merge_chunk_notes_single_skips_claude(mock_merge):
+    assert await merge_chunk_notes(["只有一段"], "model", 4096, "key") == "只有一段"
+    mock_merge.assert_not_called()
+
+
+@patch("app.summarizer._merge_meeting_notes", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_merge_chunk_notes_tree_reduce(mock_merge):
+    """Eight notes over a small budget are merged level by level: 8 -> 4 -> 2 -> 1."""
+    mock_merge.side_effect = lambda group, *args, **kwargs: "+".join(group)
+    notes = [f"n{i}" * 10 for i in range(8)]  # ~5 tokens each
+
+    result = await merge_chunk_notes(notes, "model", 4096, "key", token_budget=10)
+
+    assert mock_merge.call_count == 4 + 2 + 1
+    assert result == "+".join(notes)
+    assert all(len(call[0][0]) == 2 for call in mock_merge.call_args_list)
+
+
+@patch("app.summarizer._merge_meeting_notes", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_merge_chunk_notes_large_budget_single_merge(mock_merge):
+    """Notes that fit the budget together are merged in one call."""
+    mock_merge.return_value = "merged"
+
+    result = await merge_chunk_notes(["a", "b", "c"], "model", 4096, "key", token_budget=1000)
+
+    assert result == "merged"
+    mock_merge.assert_called_once_with(["a", "b", "c"], "model", 4096, "key", on_section=None, store=None)
+
+
+class TestSectionSplitter:
+    def test_sections_emitted_when_next_heading_starts(self):
+        """Each section is returned once the following heading arrives, even if split across deltas."""
+        splitter = SectionSplitter()
+        sections = []
+
+        for delta in ["## 會議摘要\n摘要內容\n", "\n#", "# 決議事項\n", "決議內容"]:
+            sections.extend(splitter.feed(delta))
+            if delta == "\n#":
+                assert sections == []
+
+        assert sections == ["## 會議摘要\n摘要內容"]
+        sections.extend(splitter.close())
+        assert sections == ["## 會議摘要\n摘要內容", "## 決議事項\n決議內容"]
+        assert splitter.text == "## 會議摘要\n摘要內容\n\n## 決議事項\n決議內容"
+
+    def test_preamble_and_empty_sections(self):
+        splitter = SectionSplitter()
+
+        sections = splitter.feed("前言\n## A\n\n## B\nb") + splitter.close()
+
+        assert sections == ["前言", "## A", "## B\nb"]
+
+
+async def _deltas(*texts):
+    for text in texts:
+        yield text
+
+
+@patch("app.summarizer.anthropic.AsyncAnthropic")
+@pytest.mark.asyncio
+async def test_generate_meeting_notes_streaming(mock_anthropic_cls):
+    """With on_section, the streaming API is used and sections arrive progressively."""
+    mock_client = MagicMock()
+    mock_client.messages.create = AsyncMock()
+    mock_anthropic_cls.return_value.__aenter__.return_value = mock_client
+    stream = MagicMock()
+    stream.text_stream = _deltas("## 會議摘要\n摘要", "\n## 待辦事項\n", "- 寄信")
+    stream.get_final_message = AsyncMock()
+    mock_client.messages.stream.return_value.__aenter__.return_value = stream
+
+    sections = []
+
+    async def on_section(section):
+        sections.append(section)
+
+    result = await generate_meeting_notes("逐字稿", "model", 4096, "key", on_section=on_section)
+
+    mock_client.messages.create.assert_not_called()
+    assert mock_client.messages.stream.call_args.kwargs["messages"] == [{"role": "user", "content": "逐字稿"}]
+    assert sections == ["## 會議摘要\n摘要", "## 待辦事項\n- 寄信"]
+    assert result == "## 會議摘要\n摘要\n## 待辦事項\n- 寄信"
+
+
+class _Overloaded(Exception):
+    status_code = 529
+
+
+async def _failing_deltas(*texts):
+    for text in texts:
+        yield text
+    raise _Overloaded("overloaded")
+
+
+class _RewindableHandler:
+    def __init__(self, can_rewind):
+        self.sections = []
+        self.can_rewind = can_rewind
+
+    async def __call__(self, section):
+        self.sections.append(section)
+
+    def rewind(self):
+        if self.can_rewind:
+            self.sections.clear()
+        return self.can_rewind
+
+
+@pytest.mark.parametrize("can_rewind", [True, False])
+@patch("app.summarizer.anthropic.AsyncAnthropic")
+@pytest.mark.asyncio
+async def test_streamed_call_retried_only_if_sections_rewound(mock_anthropic_cls, monkeypatch, can_rewind):
+    """A stream that fails after handing on a section is retried only once the handler has taken it back."""
+    monkeypatch.setitem(_limiters, "anthropic", RateLimiter("anthropic", base_delay_seconds=0.001))
+    mock_client = MagicMock()
+    mock_anthropic_cls.return_value.__aenter__.return_value = mock_client
+    failed, succeeded = MagicMock(), MagicMock()
+    failed.text_stream = _failing_deltas("## 會議摘要\n半", "\n## 待辦")
+    succeeded.text_stream = _deltas("## 會議摘要\n摘要\n## 待辦事項\n- 寄信")
+    succeeded.get_final_message = AsyncMock()
+    mock_client.messages.stream.return_value.__aenter__.side_effect = [failed, succeeded]
+    handler = _RewindableHandler(can_rewind)
+
+    if not can_rewind:
+        with pytest.raises(_Overloaded):
+            await generate_meeting_notes("逐字稿", "model", 4096, "key", on_section=handler)
+        assert handler.sections == ["## 會議摘要\n半"]
+        return
+
+    result = await generate_meeting_notes("逐字稿", "model", 4096, "key", on_section=handler)
+
+    assert handler.sections == ["## 會議摘要\n摘要", "## 待辦事項\n- 寄信"]
+    assert result == "## 會議摘要\n摘要\n## 待辦事項\n- 寄信"
+
+
+@patch("app.summarizer._merge_meeting_notes", new_callable=AsyncMock)
+@pytest.mark.asyncio
+async def test_merge_chunk_notes_streams_only_final_merge(mock_merge):
+    """Intermediate merges are not streamed; the top-level merge is."""
+    mock_merge.side_effect = lambda group, *args, **kwargs: "+".join(group)
+    handler = MagicMock()
+
+    await merge_chunk_notes([f"n{i}" * 10 for i in range(4)], "model", 4096, "key", token_budget=10, on_section=handler)
+
+    handlers = [call.kwargs["on_section"] for call in mock_merge.call_args_list]
+    assert handlers == [None, None, handler]
+
+
+class TestRouteModel:
+    ROUTES = dict(
+        strong_model="strong", strong_max_tokens=4096,
+        fast_model="fast", fast_max_tokens=1024, fast_route_max_tokens=4000,
+    )
+
+    def test_short_memo_goes_to_fast_tier(self):
+        assert route_model(500, "normal", **self.ROUTES) == ModelRoute("fast", "fast", 1024)
+
+    def test_long_meeting_goes_to_strong_tier(self):
+        assert route_model(60000, "normal", **self.ROUTES) == ModelRoute("strong", "strong", 4096)
+
+    def test_high_priority_always_strong(self):
+        assert route_model(500, "high", **self.ROUTES).tier == "strong"
+
+    def test_low_priority_stretches_fast_tier(self):
+        assert route_model(10000, "normal", **self.ROUTES).tier == "strong"
+        assert route_model(10000, "low", **self.ROUTES).tier == "fast"
+
+
+def test_routing_stats_per_tier():
+    """Recorded decisions are aggregated per tier."""
+    with patch("app.summarizer._routing_log", deque()):
+        record_routing(ModelRoute("fast", "haiku", 1024), "normal", 400, 2.0)
+        record_routing(ModelRoute("fast", "haiku", 1024), "normal", 600, 4.0)
+        record_routing(ModelRoute("strong", "sonnet", 4096), "high", 50000, 30.0)
+
+        stats = routing_stats()
+
+    assert stats["fast"]["jobs"] == 2
+    assert stats["fast"]["latency_p50_seconds"] == 3.0
+    assert stats["fast"]["transcript_tokens_total"] == 1000
+    assert stats["strong"]["models"] == ["sonnet"]
@@ -0,0 +1,78 @@
+"""Tests for transcriber module."""
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+import openai
+import pytest
+
+from app.rate_limit import RateLimiter, _limiters
+from app.transcriber import transcribe_audio, transcribe_with_retry
+
+
+@pytest.mark.asyncio
+@patch("app.transcriber.openai.AsyncOpenAI")
+async def test_transcribe_audio(mock_openai_cls, tmp_audio_file):
+    mock_client = MagicMock()
+    mock_openai_cls.return_value.__aenter__.return_value = mock_client
+    mock_client.audio.transcriptions.create = AsyncMock(return_value=MagicMock(text="轉錄結果"))
+
+    result = await transcribe_audio(tmp_audio_file, "test-key")
+
+    assert result == "轉錄結果"
+    mock_openai_cls.assert_called_once_with(api_key="test-key")
+    assert mock_client.audio.transcriptions.create.call_args.kwargs["model"] == "whisper-1"
+
+
+def _status_error(cls, status_code: int):
+    request = httpx.Request("POST", "https://api.openai.com/v1/audio/transcriptions")
+    return cls("error", response=httpx.Response(status_code, request=request), body=None)
+
+
+class TestTranscribeWithRetry:
+    @pytest.mark.asyncio
+    @patch("app.transcriber.RETRY_BASE_DELAY_SECONDS", 0)
+    @patch("app.transcriber.transcribe_audio", new_callable=AsyncMock)
+    async def test_retry_then_success(self, mock_transcribe):
+        """A transient failure is retried and the transcript returned."""
+        mock_transcribe.side_effect = [openai.APITimeoutError(request=MagicMock()), "轉錄結果"]
+
+        assert await transcribe_with_retry("c0", "key", max_retries=2) == "轉錄結果"
+        assert mock_transcribe.call_count == 2
+
+    @pytest.mark.asyncio
+    @patch("app.transcriber.RETRY_BASE_DELAY_SECONDS", 0)
+    @patch("app.transcriber.transcribe_audio", new_callable=AsyncMock)
+    async def test_retries_exhausted(self, mock_transcribe):
+        """A chunk that keeps failing raises its last error."""
+        mock_transcribe.side_effect = _status_error(openai.InternalServerError, 503)
+
+        with pytest.raises(openai.InternalServerError):
+            await transcribe_with_retry("c0", "key", max_retries=1)
+
+        assert mock_transcribe.call_count == 2
+
+    @pytest.mark.asyncio
+    @patch("app.transcriber.RETRY_BASE_DELAY_SECONDS", 0)
+    @patch("app.transcriber.transcribe_audio", new_callable=AsyncMock)
+    async def test_client_error_not_retried(self, mock_transcribe):
+        """A 400 for a bad file fails on the first attempt."""
+        mock_transcribe.side_effect = _status_error(openai.BadRequestError, 400)
+
+        with pytest.raises(openai.BadRequestError):
+            await transcribe_with_retry("c0", "key", max_retries=2)
+
+        assert mock_transcribe.call_count == 1
+
+    @pytest.mark.asyncio
+    @patch("app.transcriber.RETRY_BASE_DELAY_SECONDS", 0)
+    @patch("app.transcriber.transcribe_audio", new_callable=AsyncMock)
+    async def test_no_retry_on_top_of_rate_limiter(self, mock_transcribe, monkeypatch):
+        """With the rate limiter on, its retries are the only ones."""
+        monkeypatch.setitem(_limiters, "openai", RateLimiter("openai"))
+        mock_transcribe.side_effect = _status_error(openai.InternalServerError, 503)
+
+        with pytest.raises(openai.InternalServerError):
+            await transcribe_with_retry("c0", "key", max_retries=2)
+
+        assert mock_transcribe.call_count == 1
@@ -0,0 +1,108 @@
+"""Tests for vad module."""
+
+import subprocess
+from unittest.mock import patch
+
+import numpy as np
+
+from app.vad import OffsetMap, detect_speech_spans, trim_silence
+
+
+def _envelope(*runs):
+    """Build a 50ms-frame energy envelope from (seconds, rms) runs."""
+    return np.concatenate([np.full(int(seconds / 0.05), rms, dtype=np.float32) for seconds, rms in runs])
+
+
+class TestDetectSpeechSpans:
+    def test_long_silence_removed_with_padding(self):
+        """A 10s gap between speech is cut down to padding on each side."""
+        energy = _envelope((5, 3000), (10, 10), (5, 3000))
+
+        spans = detect_speech_spans(energy, min_silence_seconds=2.0)
+
+        assert spans == [(0.0, 5.3), (14.7, 20.0)]
+
+    def test_short_pause_kept(self):
+        """Pauses shorter than the minimum are left in place."""
+        energy = _envelope((5, 3000), (1, 10), (5, 3000))
+
+        assert detect_speech_spans(energy, min_silence_seconds=2.0) == [(0.0, 11.0)]
+
+    def test_leading_and_trailing_silence_removed(self):
+        """Silence at the edges of the file is removed without padding."""
+        energy = _envelope((30, 10), (5, 3000), (30, 10))
+
+        assert detect_speech_spans(energy, min_silence_seconds=2.0) == [(29.7, 35.3)]
+
+    def test_no_speech(self):
+        """A recording of pure background noise yields no spans."""
+        energy = _envelope((30, 10))
+
+        assert detect_speech_spans(energy, min_silence_seconds=2.0) == []
+
+
+class TestOffsetMap:
+    def test_to_original(self):
+        """Trimmed timestamps map back across removed gaps."""
+        offsets = OffsetMap([(0.0, 0.0, 5.3), (5.3, 14.7, 5.3)])
+
+        assert offsets.to_original(1.0) == 1.0
+        assert offsets.to_original(6.3) == 15.7
+
+    def test_empty_map_is_identity(self):
+        assert OffsetMap().to_original(42.0) == 42.0
+
+    def test_shifted_maps_into_whole_recording(self):
+        """A chunk-relative map shifted by the chunk start maps into the full recording."""
+        offsets = OffsetMap([(0.0, 0.0, 5.3), (5.3, 14.7, 5.3)]).shifted(600.0)
+
+        assert offsets.to_original(1.0) == 601.0
+        assert offsets.to_original(6.3) == 615.7
+
+
+class TestTrimSilence:
+    def test_trim_silence_writes_trimmed_file(self, tmp_audio_file):
+        """Silence is cut with an aselect filter and savings are reported."""
+        energy = _envelope((5, 3000), (10, 10), (5, 3000))
+
+        with patch("app.vad.compute_energy_envelope", return_value=energy), \
+                patch("app.vad.subprocess.run") as mock_run:
+            mock_run.return_value = subprocess.CompletedProcess([], 0)
+            result = trim_silence(tmp_audio_file, min_silence_seconds=2.0)
+
+        cmd = mock_run.call_args[0][0]
+        assert "between(t,0.000,5.300)+between(t,14.700,20.000)" in cmd[cmd.index("-af") + 1]
+        assert result.audio_path.endswith("_vad.m4a")
+        assert result.original_seconds == 20.0
+        assert result.trimmed_seconds == 10.6
+        assert round(result.saved_seconds, 3) == 9.4
+        assert result.offset_map.to_original(6.3) == 15.7
+
+    def test_trim_silence_encodes_in_requested_profile(self, tmp_audio_file):
+        """The trimmed file is written directly with the requested encoder."""
+        energy = _envelope((5, 3000), (10, 10), (5, 3000))
+
+        with patch("app.vad.compute_energy_envelope", return_value=energy), \
+                patch("app.vad.subprocess.run") as mock_run:
+            mock_run.return_value = subprocess.CompletedProcess([], 0)
+            result = trim_silence(
+                tmp_audio_file, min_silence_seconds=2.0, codec="libopus", bitrate_kbps=24, sample_rate=16000
+            )
+
+        cmd = mock_run.call_args[0][0]
+        assert result.audio_path.endswith("_vad.ogg")
+        assert cmd[cmd.index("-c:a") + 1] == "libopus"
+        assert cmd[cmd.index("-b:a") + 1] == "24k"
+        assert cmd[cmd.index("-ar") + 1] == "16000"
+
+    def test_trim_silence_nothing_to_trim(self, tmp_audio_file):
+        """Continuous speech returns the original file without running ffmpeg."""
+        energy = _envelope((20, 3000))
+
+        with patch("app.vad.compute_energy_envelope", return_value=energy), \
+                patch("app.vad.subprocess.run") as mock_run:
+            result = trim_silence(tmp_audio_file, min_silence_seconds=2.0)
+
+        mock_run.assert_not_called()
+        assert result.audio_path == tmp_audio_file
+        assert result.saved_seconds == 0
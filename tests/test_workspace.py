@@ -0,0 +1,61 @@
+"""Tests for workspace module."""
+
+import os
+import time
+
+from app.audio_processor import AudioChunk
+from app.workspace import JobWorkspace, sweep_workspaces
+
+
+def test_checkpoints_survive_reopening(tmp_path):
+    """A second workspace for the same message sees what the first saved."""
+    first = JobWorkspace(str(tmp_path), "msg_1")
+    with open(first.audio_path, "wb") as f:
+        f.write(b"audio")
+    first.save_audio(5, "cafe")
+    chunk_path = os.path.join(first.path, "chunk_0.m4a")
+    with open(chunk_path, "wb") as f:
+        f.write(b"chunk")
+    first.save_chunks([AudioChunk(chunk_path, 0.0, 600.0)])
+    first.save_transcript(0, 0.0, "逐字稿")
+    first.save_notes("abc", "## 會議摘要")
+
+    again = JobWorkspace(str(tmp_path), "msg_1")
+
+    assert again.load_audio_size() == 5
+    assert again.load_audio_sha256() == "cafe"
+    assert again.load_chunks() == [AudioChunk(chunk_path, 0.0, 600.0)]
+    assert again.load_transcript(0, 0.0) == "逐字稿"
+    assert again.load_notes("abc") == "## 會議摘要"
+
+
+def test_missing_or_stale_checkpoints(tmp_path):
+    workspace = JobWorkspace(str(tmp_path), "msg_1")
+    workspace.save_audio(5, "cafe")
+    workspace.save_chunks([AudioChunk("/nonexistent/chunk_0.m4a", 0.0, 600.0)])
+    workspace.save_transcript(1, 600.0, "逐字稿")
+
+    assert workspace.load_audio_size() is None
+    assert workspace.load_chunks() is None
+    assert workspace.load_transcript(1, 590.0) is None
+    assert workspace.load_transcript(2, 1200.0) is None
+    assert workspace.load_notes("abc") is None
+
+
+def test_message_id_cannot_escape_root(tmp_path):
+    workspace = JobWorkspace(str(tmp_path / "root"), "../../etc")
+
+    assert os.path.dirname(workspace.path) == str(tmp_path / "root")
+
+
+def test_remove_and_sweep(tmp_path):
+    done = JobWorkspace(str(tmp_path), "done")
+    stale = JobWorkspace(str(tmp_path), "stale")
+    fresh = JobWorkspace(str(tmp_path), "fresh")
+    old = time.time() - 3600
+    os.utime(stale.path, (old, old))
+
+    done.remove()
+
+    assert sweep_workspaces(str(tmp_path), max_age_seconds=60) == 1
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(fresh.path)]